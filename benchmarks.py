@@ -0,0 +1,250 @@
+"""
+Micro-benchmarks for the bundled transcoders.
+
+Run this module directly to print the results::
+
+   $ python benchmarks.py
+
+Each benchmark reports the best per-call time over a number of
+repeats so that the numbers are comparable between runs on the
+same machine.  Memory benchmarks report the memory that a decoded
+document holds on to.
+
+"""
+import json
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from ietfparse import headers
+
+from sprockets.mixins.mediatype import (content, converters, schemas,
+                                        transcoders)
+
+
+SMALL_PAYLOAD = {'id': 12345, 'name': 'widget', 'active': True,
+                 'tags': ['a', 'b'], 'ratio': 0.25}
+
+
+def best_of(statement, number=20000, repeat=5):
+    """Return the best per-call time of `statement` in nanoseconds."""
+    timer = timeit.Timer(statement)
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def bench_json_small_payloads():
+    """Per-call overhead of JSON encoding & decoding small payloads."""
+    transcoder = transcoders.JSONTranscoder()
+    transcoder.load_options = {'parse_float': float}
+    encoded = transcoder.dumps(SMALL_PAYLOAD)
+    return [
+        ('json.dumps(**dump_options)',
+         best_of(lambda: json.dumps(SMALL_PAYLOAD,
+                                    **transcoder.dump_options)), 'ns'),
+        ('JSONTranscoder.dumps',
+         best_of(lambda: transcoder.dumps(SMALL_PAYLOAD)), 'ns'),
+        ('json.loads(**load_options)',
+         best_of(lambda: json.loads(encoded, **transcoder.load_options)),
+         'ns'),
+        ('JSONTranscoder.loads',
+         best_of(lambda: transcoder.loads(encoded)), 'ns'),
+    ]
+
+
+def bench_content_type_lookup():
+    """Per-request cost of parsing a Content-Type header."""
+    header = 'application/json; charset=utf-8'
+    return [
+        ('headers.parse_content_type',
+         best_of(lambda: headers.parse_content_type(header)), 'ns'),
+        ('content._parse_content_type',
+         best_of(lambda: content._parse_content_type(header)), 'ns'),
+    ]
+
+
+def bench_cross_format_conversion():
+    """Converting a document between JSON and msgpack."""
+    json_transcoder = transcoders.JSONTranscoder()
+    msgpack_transcoder = transcoders.MsgPackTranscoder()
+    document = {'items': [dict(SMALL_PAYLOAD, id=index)
+                          for index in range(100)]}
+    _, json_bytes = json_transcoder.to_bytes(document)
+    _, msgpack_bytes = msgpack_transcoder.to_bytes(document)
+    return [
+        ('msgpack decode + JSON encode',
+         best_of(lambda: json_transcoder.to_bytes(
+             msgpack_transcoder.from_bytes(msgpack_bytes)), number=200),
+         'ns'),
+        ('converters.msgpack_to_json',
+         best_of(lambda: converters.msgpack_to_json(msgpack_bytes),
+                 number=200), 'ns'),
+        ('JSON decode + msgpack encode',
+         best_of(lambda: msgpack_transcoder.to_bytes(
+             json_transcoder.from_bytes(json_bytes)), number=200), 'ns'),
+        ('converters.json_to_msgpack',
+         best_of(lambda: converters.json_to_msgpack(json_bytes),
+                 number=200), 'ns'),
+    ]
+
+
+def bench_lazy_projection():
+    """Reading one member of a large request body."""
+    json_transcoder = transcoders.JSONTranscoder()
+    msgpack_transcoder = transcoders.MsgPackTranscoder()
+    document = {'action': 'update',
+                'items': [dict(SMALL_PAYLOAD, id=index)
+                          for index in range(1000)]}
+    _, json_bytes = json_transcoder.to_bytes(document)
+    _, msgpack_bytes = msgpack_transcoder.to_bytes(document)
+    return [
+        ('JSONTranscoder.from_bytes',
+         best_of(lambda: json_transcoder.from_bytes(json_bytes)['action'],
+                 number=100), 'ns'),
+        ('JSONTranscoder.lazy_from_bytes',
+         best_of(lambda: json_transcoder.lazy_from_bytes(
+             json_bytes)['action'], number=100), 'ns'),
+        ('MsgPackTranscoder.from_bytes',
+         best_of(lambda: msgpack_transcoder.from_bytes(
+             msgpack_bytes)['action'], number=100), 'ns'),
+        ('MsgPackTranscoder.lazy_from_bytes',
+         best_of(lambda: msgpack_transcoder.lazy_from_bytes(
+             msgpack_bytes)['action'], number=100), 'ns'),
+    ]
+
+
+def bench_schema_validation():
+    """Validating a decoded request body against a schema."""
+    transcoder = transcoders.JSONTranscoder()
+    schema = schemas.Schema({
+        'type': 'object', 'required': ['items'],
+        'properties': {'items': {'type': 'array', 'items': {
+            'type': 'object', 'required': ['id', 'name'],
+            'properties': {'id': {'type': 'integer', 'minimum': 0},
+                           'name': {'type': 'string', 'maxLength': 20},
+                           'active': {'type': 'boolean'},
+                           'tags': {'type': 'array',
+                                    'items': {'type': 'string'}},
+                           'ratio': {'type': 'number'}}}}}})
+    document = {'items': [dict(SMALL_PAYLOAD, id=index)
+                          for index in range(100)]}
+    _, encoded = transcoder.to_bytes(document)
+    invalid = {'items': [dict(SMALL_PAYLOAD, id=-1)] + document['items']}
+
+    def validate_invalid():
+        try:
+            schema.validate(invalid)
+        except schemas.ValidationError:
+            pass
+
+    return [
+        ('JSONTranscoder.from_bytes',
+         best_of(lambda: transcoder.from_bytes(encoded), number=500), 'ns'),
+        ('Schema.validate',
+         best_of(lambda: schema.validate(document), number=500), 'ns'),
+        ('Schema.validate (first item invalid)',
+         best_of(validate_invalid, number=500), 'ns'),
+    ]
+
+
+def bench_numpy_arrays():
+    """Encoding a NumPy array compared to the equivalent list."""
+    try:
+        import numpy
+    except ImportError:
+        return []
+    json_transcoder = transcoders.JSONTranscoder()
+    msgpack_transcoder = transcoders.MsgPackTranscoder()
+    array = numpy.linspace(0, 1, 10000)
+    values = array.tolist()
+    return [
+        ('JSONTranscoder.to_bytes(list)',
+         best_of(lambda: json_transcoder.to_bytes(values), number=50), 'ns'),
+        ('JSONTranscoder.to_bytes(ndarray)',
+         best_of(lambda: json_transcoder.to_bytes(array), number=50), 'ns'),
+        ('MsgPackTranscoder.to_bytes(list)',
+         best_of(lambda: msgpack_transcoder.to_bytes(values), number=50),
+         'ns'),
+        ('MsgPackTranscoder.to_bytes(ndarray)',
+         best_of(lambda: msgpack_transcoder.to_bytes(array), number=50),
+         'ns'),
+    ]
+
+
+def retained_bytes(statement):
+    """Return the memory that the result of `statement` holds on to."""
+    tracemalloc.start()
+    try:
+        result = statement()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained / 1024
+
+
+def bench_record_memory():
+    """Memory held by a decoded list of 10000 records."""
+    document = [dict(SMALL_PAYLOAD, id=index) for index in range(10000)]
+    _, json_bytes = transcoders.JSONTranscoder().to_bytes(document)
+    _, msgpack_bytes = transcoders.MsgPackTranscoder().to_bytes(document)
+    results = []
+    for records in (None, 'rows', 'columns'):
+        transcoder = transcoders.JSONTranscoder(records=records)
+        results.append((
+            'JSONTranscoder(records={!r})'.format(records),
+            retained_bytes(lambda: transcoder.from_bytes(json_bytes)), 'KiB'))
+    for intern_keys, records in ((False, None), (True, None),
+                                 (True, 'rows')):
+        transcoder = transcoders.MsgPackTranscoder(intern_keys=intern_keys,
+                                                   records=records)
+        results.append((
+            'MsgPackTranscoder({}, {!r})'.format(intern_keys, records),
+            retained_bytes(lambda: transcoder.from_bytes(msgpack_bytes)),
+            'KiB'))
+    return results
+
+
+def import_profile(module_name):
+    """
+    Import `module_name` in a fresh interpreter and profile it.
+
+    :param str module_name: the module to import
+    :returns: :class:`dict` that maps the name of each module that
+        was imported to its cumulative import time in microseconds
+
+    This uses the ``-X importtime`` option so the result only includes
+    modules that were not already imported by the interpreter itself.
+
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True)
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        profile[name.strip()] = int(cumulative)
+    return profile
+
+
+def bench_import_time():
+    """Cumulative import time of the package modules."""
+    return [(name, import_profile(name)[name], 'us')
+            for name in ('sprockets.mixins.mediatype',
+                         'sprockets.mixins.mediatype.transcoders',
+                         'sprockets.mixins.mediatype.content')]
+
+
+BENCHMARKS = [bench_json_small_payloads, bench_content_type_lookup,
+              bench_cross_format_conversion, bench_lazy_projection,
+              bench_schema_validation, bench_numpy_arrays,
+              bench_record_memory, bench_import_time]
+
+
+if __name__ == '__main__':
+    for benchmark in BENCHMARKS:
+        print(benchmark.__doc__)
+        for name, elapsed, unit in benchmark():
+            print('  {:<40s} {:10.1f} {}'.format(name, elapsed, unit))
@@ -1,8 +1,9 @@
+import gc
 import logging
 import signal
 
 from sprockets.mixins.mediatype import content, transcoders
-from tornado import ioloop, web
+from tornado import httpserver, ioloop, netutil, process, web
 
 
 class SimpleHandler(content.ContentMixin, web.RequestHandler):
@@ -22,6 +23,29 @@ def make_application(**settings):
     return application
 
 
+def run_forked(port=8000, num_processes=None):
+    """
+    Run the application in pre-forked worker processes.
+
+    The content settings are preloaded and the garbage collector is
+    frozen before forking so that every worker starts with the fully
+    built settings and shares the memory pages with the parent until
+    they are written to.  Note that the IOLoop is created *after* the
+    fork and that the application must not run in debug mode.
+
+    """
+    application = make_application()
+    content.preload(application)
+    sockets = netutil.bind_sockets(port)
+    gc.freeze()
+    process.fork_processes(num_processes)
+    server = httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    signal.signal(signal.SIGINT, _signal_handler)
+    signal.signal(signal.SIGTERM, _signal_handler)
+    ioloop.IOLoop.current().start()
+
+
 def _signal_handler(signo, _):
     logging.info('received signal %d, stopping application', signo)
     iol = ioloop.IOLoop.instance()
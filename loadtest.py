@@ -0,0 +1,306 @@
+"""
+Load test for the content handling mixins.
+
+This boots an application that is built like the one in *examples.py*
+on localhost and drives it with an asynchronous HTTP client::
+
+   $ python loadtest.py --concurrency 50 --requests 5000 \\
+        --formats json=3,msgpack=1 --payloads small=8,large=1
+
+Each request picks a response format (the :http:header:`Accept` and
+:http:header:`Content-Type` headers), a payload size, and whether to
+GET the payload or POST it to be echoed back.  The choices are weighted
+by the mixes given on the command line.  The server runs in a separate
+process by default so that the client does not compete with it for the
+interpreter.  Use ``--in-process`` to run both on the same IOLoop.
+
+Requests per second, latency percentiles for every format and payload
+combination, and a histogram of all latencies are printed at the end.
+
+"""
+import argparse
+import asyncio
+import collections
+import math
+import multiprocessing
+import random
+import sys
+import time
+
+from tornado import httpclient, httpserver, netutil, web
+import umsgpack
+
+from sprockets.mixins.mediatype import content, transcoders
+import examples
+
+FORMATS = {'json': 'application/json', 'msgpack': 'application/msgpack'}
+PAYLOADS = {
+    'small': {'id': 12345, 'name': 'widget', 'active': True,
+              'tags': ['a', 'b'], 'ratio': 0.25},
+    'medium': {'items': [{'id': index, 'name': 'item {}'.format(index),
+                          'price': index * 1.25, 'tags': ['a', 'b', 'c']}
+                         for index in range(100)]},
+    'large': {'items': [{'id': index, 'name': 'item {}'.format(index),
+                         'price': index * 1.25, 'tags': ['a', 'b', 'c'],
+                         'description': 'x' * 200}
+                        for index in range(2000)]},
+}
+
+Sample = collections.namedtuple(
+    'Sample', ['format', 'payload', 'method', 'status', 'latency_ns'])
+
+
+class PayloadHandler(content.ContentMixin, web.RequestHandler):
+
+    def get(self, payload):
+        self.send_response(PAYLOADS[payload])
+
+    def post(self, payload):
+        self.send_response(self.get_request_body())
+
+
+def make_application(**settings):
+    application = examples.make_application(**settings)
+    application.add_handlers(r'.*', [(r'/load/(\w+)', PayloadHandler)])
+    return application
+
+
+def parse_mix(value, choices):
+    """
+    Parse a weighted mix such as ``json=3,msgpack=1``.
+
+    :param str value: comma separated names with optional weights
+    :param choices: the names that are allowed
+    :returns: :class:`list` of ``(name, weight)`` tuples
+    :raises ValueError: if a name is unknown or a weight is invalid
+
+    """
+    mix = []
+    for item in value.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in choices:
+            raise ValueError('unknown choice {!r}, expected one of {}'.format(
+                name, ', '.join(sorted(choices))))
+        weight = float(weight) if weight else 1.0
+        if weight <= 0:
+            raise ValueError('weight of {} must be positive'.format(name))
+        mix.append((name, weight))
+    return mix
+
+
+def make_plan(num_requests, formats, payloads, post_ratio, seed=None):
+    """
+    Choose the format, payload, and method of each request.
+
+    :param int num_requests: the number of requests to make
+    :param formats: weighted mix of :data:`FORMATS` names
+    :param payloads: weighted mix of :data:`PAYLOADS` names
+    :param float post_ratio: fraction of requests that POST the payload
+    :param seed: seed for the random choices
+    :returns: :class:`list` of ``(format, payload, method)`` tuples
+
+    """
+    rng = random.Random(seed)
+    format_names, format_weights = zip(*formats)
+    payload_names, payload_weights = zip(*payloads)
+    return [(rng.choices(format_names, format_weights)[0],
+             rng.choices(payload_names, payload_weights)[0],
+             'POST' if rng.random() < post_ratio else 'GET')
+            for _ in range(num_requests)]
+
+
+def encode_bodies():
+    """Encode every payload in every format for POST requests."""
+    json_transcoder = transcoders.JSONTranscoder()
+    bodies = {}
+    for payload, document in PAYLOADS.items():
+        bodies['json', payload] = json_transcoder.to_bytes(document)[1]
+        bodies['msgpack', payload] = umsgpack.packb(document)
+    return bodies
+
+
+async def run_load(base_url, plan, concurrency):
+    """
+    Make the requests in `plan` with `concurrency` requests in flight.
+
+    :param str base_url: URL of the server without a trailing slash
+    :param list plan: the requests to make as returned by
+        :func:`make_plan`
+    :param int concurrency: the number of requests in flight
+    :returns: :class:`tuple` of the :class:`Sample` for each request
+        and the elapsed time in seconds
+
+    """
+    client = httpclient.AsyncHTTPClient(force_instance=True,
+                                        max_clients=concurrency)
+    bodies = encode_bodies()
+    pending = iter(plan)
+    samples = []
+
+    async def worker():
+        for format_name, payload, method in pending:
+            media_type = FORMATS[format_name]
+            request_headers = {'Accept': media_type}
+            body = None
+            if method == 'POST':
+                request_headers['Content-Type'] = media_type
+                body = bodies[format_name, payload]
+            start = time.perf_counter_ns()
+            response = await client.fetch(
+                '{}/load/{}'.format(base_url, payload), method=method,
+                headers=request_headers, body=body, raise_error=False)
+            samples.append(Sample(format_name, payload, method,
+                                  response.code,
+                                  time.perf_counter_ns() - start))
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        client.close()
+    return samples, time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile of a sorted sequence."""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(round(fraction * len(sorted_values), 9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def histogram(latencies_ns, num_buckets=16):
+    """
+    Count latencies in logarithmic buckets.
+
+    :param latencies_ns: latencies in nanoseconds
+    :param int num_buckets: the maximum number of buckets
+    :returns: :class:`list` of ``(upper_bound_ns, count)`` tuples.
+        Each bucket is twice as wide as the one before it and the
+        last bucket counts everything that is slower.
+
+    """
+    if not latencies_ns:
+        return []
+    lowest = max(min(latencies_ns), 1)
+    bounds = [lowest * 2 ** (index + 1) for index in range(num_buckets)]
+    counts = [0] * num_buckets
+    for latency in latencies_ns:
+        for index, bound in enumerate(bounds):
+            if latency < bound or index == num_buckets - 1:
+                counts[index] += 1
+                break
+    while counts and not counts[-1]:
+        bounds.pop()
+        counts.pop()
+    return list(zip(bounds, counts))
+
+
+def report(samples, elapsed, out=sys.stdout):
+    """Print the throughput, latency percentiles, and histogram."""
+    latencies = sorted(sample.latency_ns for sample in samples)
+    errors = sum(1 for sample in samples if sample.status != 200)
+    print('{} requests in {:.2f}s, {:.1f} requests/second, {} errors'.format(
+        len(samples), elapsed, len(samples) / elapsed, errors), file=out)
+
+    groups = collections.defaultdict(list)
+    for sample in samples:
+        groups[sample.format, sample.payload].append(sample.latency_ns)
+    groups['all', ''] = latencies
+    print('  {:<8s} {:<7s} {:>7s} {:>9s} {:>9s} {:>9s}'.format(
+        'format', 'payload', 'count', 'p50 ms', 'p99 ms', 'max ms'),
+        file=out)
+    for (format_name, payload), values in sorted(groups.items()):
+        values = sorted(values)
+        print('  {:<8s} {:<7s} {:>7d} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            format_name, payload, len(values),
+            percentile(values, 0.50) / 1e6, percentile(values, 0.99) / 1e6,
+            values[-1] / 1e6), file=out)
+
+    buckets = histogram(latencies)
+    widest = max((count for _, count in buckets), default=0)
+    print('latency histogram', file=out)
+    for bound, count in buckets:
+        print('  < {:9.2f} ms {:>7d} {}'.format(
+            bound / 1e6, count, '#' * round(40 * count / widest)), file=out)
+
+
+def serve(sockets, ready):
+    """Run the load test application on `sockets` until terminated."""
+    async def main():
+        server = httpserver.HTTPServer(make_application())
+        server.add_sockets(sockets)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def drive(args, base_url):
+    plan = make_plan(args.requests, args.formats, args.payloads,
+                     args.post_ratio, args.seed)
+    if args.warmup:
+        await run_load(base_url, plan[:args.warmup], args.concurrency)
+    samples, elapsed = await run_load(base_url, plan, args.concurrency)
+    report(samples, elapsed)
+
+
+async def serve_and_drive(args, sockets, base_url):
+    server = httpserver.HTTPServer(make_application())
+    server.add_sockets(sockets)
+    try:
+        await drive(args, base_url)
+    finally:
+        server.stop()
+
+
+def main(args):
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    base_url = 'http://127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+    if args.in_process:
+        asyncio.run(serve_and_drive(args, sockets, base_url))
+        return
+
+    # fork before the client creates its IOLoop
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    server_process = context.Process(target=serve, args=(sockets, ready),
+                                     daemon=True)
+    server_process.start()
+    for sock in sockets:
+        sock.close()
+    try:
+        ready.wait()
+        asyncio.run(drive(args, base_url))
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='requests in flight (default: %(default)s)')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='number of requests (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=100,
+                        help='untimed requests to make first '
+                             '(default: %(default)s)')
+    parser.add_argument('--formats', default='json,msgpack',
+                        type=lambda value: parse_mix(value, FORMATS),
+                        help='weighted formats (default: %(default)s)')
+    parser.add_argument('--payloads', default='small=8,medium=2,large=1',
+                        type=lambda value: parse_mix(value, PAYLOADS),
+                        help='weighted payloads (default: %(default)s)')
+    parser.add_argument('--post-ratio', type=float, default=0.5,
+                        help='fraction of requests that POST a body '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the request mix')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run the server on the same IOLoop')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_arguments())
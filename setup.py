@@ -48,7 +48,8 @@ setuptools.setup(
     install_requires=read_requirements('requires/installation.txt'),
     tests_require=read_requirements('requires/testing.txt'),
     extras_require={
-        'msgpack': ['u-msgpack-python>=2.5.0,<3']
+        'msgpack': ['u-msgpack-python>=2.5.0,<3'],
+        'numpy': ['numpy'],
     },
     namespace_packages=['sprockets', 'sprockets.mixins'],
     test_suite='nose.collector',
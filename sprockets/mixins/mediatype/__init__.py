@@ -1,24 +1,41 @@
 """
 sprockets.mixins.mediatype
 
+The names exported from this package are resolved from the
+:mod:`~sprockets.mixins.mediatype.content` module the first time
+that they are accessed so that importing the package does not pull
+in :mod:`tornado.web` and :mod:`ietfparse`.
+
 """
-try:
-    from .content import (ContentMixin, ContentSettings,
-                          add_binary_content_type, add_text_content_type,
-                          set_default_content_type)
-except ImportError as error:  # noqa: F841  # pragma no cover
-    def _error_closure(*args, **kwargs):
-        raise error  # noqa: F821
+_CONTENT_EXPORTS = ('ContentMixin', 'ContentSettings',
+                    'add_binary_content_type', 'add_text_content_type',
+                    'set_default_content_type')
+
+
+def __getattr__(name):
+    if name not in _CONTENT_EXPORTS:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+
+    try:
+        from . import content
+        value = getattr(content, name)
+    except ImportError as error:  # pragma no cover
+        value = _error_closure(name, error)
+
+    globals()[name] = value
+    return value
+
+
+def _error_closure(name, error):  # pragma no cover
+    def error_closure(*args, **kwargs):
+        raise error
 
     class ErrorClosureClass(object):
         def __init__(self, *args, **kwargs):
-            raise error  # noqa: F821
+            raise error
 
-    ContentMixin = ErrorClosureClass
-    ContentSettings = ErrorClosureClass
-    add_binary_content_type = _error_closure
-    add_text_content_type = _error_closure
-    set_default_content_type = _error_closure
+    return ErrorClosureClass if name[0].isupper() else error_closure
 
 
 version_info = (3, 0, 3)
@@ -0,0 +1,35 @@
+"""
+msgpack type codes that are shared by the token level readers.
+
+The :mod:`~sprockets.mixins.mediatype.converters` and
+:mod:`~sprockets.mixins.mediatype.lazy` modules walk msgpack documents
+without unpacking them.  These tables map the type codes to the
+:class:`struct.Struct` that reads the value or length that follows.
+
+"""
+import struct
+
+FIXED_WIDTH = {
+    0xca: struct.Struct('>f'), 0xcb: struct.Struct('>d'),
+    0xcc: struct.Struct('>B'), 0xcd: struct.Struct('>H'),
+    0xce: struct.Struct('>I'), 0xcf: struct.Struct('>Q'),
+    0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'),
+    0xd2: struct.Struct('>i'), 0xd3: struct.Struct('>q'),
+}
+"""Numbers: the code is followed by the packed value."""
+
+LENGTHS = {
+    0xc4: struct.Struct('>B'), 0xc5: struct.Struct('>H'),
+    0xc6: struct.Struct('>I'), 0xd9: struct.Struct('>B'),
+    0xda: struct.Struct('>H'), 0xdb: struct.Struct('>I'),
+    0xdc: struct.Struct('>H'), 0xdd: struct.Struct('>I'),
+    0xde: struct.Struct('>H'), 0xdf: struct.Struct('>I'),
+}
+"""bin, str, array and map: the code is followed by the length."""
+
+FIXED_EXT = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+"""fixext: the code is followed by the type and this many bytes."""
+
+EXT_LENGTHS = {0xc7: struct.Struct('>B'), 0xc8: struct.Struct('>H'),
+               0xc9: struct.Struct('>I')}
+"""ext: the code is followed by the length, the type and the data."""
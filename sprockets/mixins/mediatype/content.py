@@ -13,6 +13,17 @@ Content handling for Tornado.
   content type
 - :func:`.add_transcoder` register a custom transcoder instance
   for a content type
+- :func:`.add_converter` register a converter that translates
+  directly between two content types
+- :func:`.preload` build the lazily created state of the registered
+  transcoders before the application forks worker processes
+- :func:`.set_encode_cost_policy` select among equally acceptable
+  content types based on measured encoding cost
+- :func:`.set_allocation_profiler` measure the memory allocated while
+  decoding and encoding bodies
+- :func:`.set_buffer_pool` encode response bodies into reusable buffers
+- :func:`.format_sse_event` frames an encoded body as a server-sent
+  event
 
 - :class:`.ContentSettings` an instance of this is attached to
   :class:`tornado.web.Application` to hold the content mapping
@@ -20,6 +31,16 @@ Content handling for Tornado.
 - :class:`.ContentMixin` attaches a :class:`.ContentSettings`
   instance to the application and implements request decoding &
   response encoding methods
+- :class:`.AsyncContentMixin` is a :class:`.ContentMixin` whose
+  decoding & encoding methods are coroutines
+- :class:`.WebSocketContentMixin` negotiates the message format of
+  a :class:`tornado.websocket.WebSocketHandler`
+- :class:`.EncodedBody` wraps a pre-encoded response body
+- :class:`.EncodeCostPolicy` learns the encoding cost of each content
+  type from live traffic
+- :class:`.AllocationProfiler` samples the memory that transcoding
+  allocates
+- :class:`.BufferPool` keeps a bounded number of output buffers
 
 This module is the primary interface for this library.  It exposes
 functions for registering new content handlers and a mix-in that
@@ -27,12 +48,26 @@ adds content handling methods to :class:`~tornado.web.RequestHandler`
 instances.
 
 """
+import asyncio
+from collections import abc
+import contextlib
+import functools
+import inspect
+import io
 import logging
+import mmap
+import operator
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
 
 from ietfparse import algorithms, errors, headers
-from tornado import web
+from tornado import escape, web
 
-from . import handlers
+from . import handlers, schemas
 
 
 logger = logging.getLogger(__name__)
@@ -41,6 +76,16 @@ SETTINGS_KEY = 'sprockets.mixins.mediatype.ContentSettings'
 
 _warning_issued = False
 
+_LINE_BREAK = re.compile(r'\r\n|\r|\n')
+_LINE_BREAK_BYTES = re.compile(rb'\r\n|\r|\n')
+
+_OVERRIDABLE_SETTINGS = frozenset(
+    ['content_types', 'default_content_type', 'default_encoding'])
+_VIEW_ATTRIBUTES = frozenset(['default_content_type', 'default_encoding',
+                              'encode_cost_policy',
+                              'request_decode_executor', 'server_timing',
+                              'allocation_profiler', 'buffer_pool'])
+
 
 class ContentSettings:
     """
@@ -86,31 +131,392 @@ class ContentSettings:
     Of course, that is quite tedious, so use the :class:`.ContentMixin`
     instead.
 
+    Handlers and routes can override some of the settings.  See
+    :meth:`.for_handler` for the details.
+
+    The registered content types are published as an immutable
+    snapshot that is replaced as a whole when they change, so request
+    handlers and transcoders running on executor threads read them
+    without locking while another thread registers content types.
+    Changes are serialized by a lock and each lookup sees either the
+    old or the new registrations, never a mix of both.
+
     """
 
+    max_rankings = 1024
+    """Maximum number of ``Accept`` headers that :meth:`negotiate` caches."""
+
     def __init__(self):
-        self._handlers = {}
-        self._available_types = []
+        self._lock = threading.Lock()
+        self._snapshot = _Snapshot({}, (), {}, {}, {})
         self.default_content_type = None
         self.default_encoding = None
+        self.encode_cost_policy = None
+        self.request_decode_executor = None
+        self.server_timing = False
+        self.allocation_profiler = None
+        self.buffer_pool = None
 
     def __getitem__(self, content_type):
-        parsed = headers.parse_content_type(content_type)
-        return self._handlers[str(parsed)]
+        return self._snapshot.handlers[
+            _parse_content_type(content_type).normalized]
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in _VIEW_ATTRIBUTES:
+            with self._lock:
+                self._snapshot = self._snapshot.replace()
 
     def __setitem__(self, content_type, handler):
+        self.register(content_type, handler)
+
+    def get(self, content_type, default=None):
+        return self._snapshot.handlers.get(content_type, default)
+
+    def schema_for(self, content_type):
+        """
+        Get the schema that was registered for `content_type`.
+
+        :param str content_type: the content type of a request body
+        :returns: the :class:`~sprockets.mixins.mediatype.schemas.Schema`
+            or :data:`None` if request bodies of `content_type` are not
+            validated
+
+        """
+        registered = self._snapshot.schemas
+        if not registered:
+            return None
+        return registered.get(_parse_content_type(content_type).normalized)
+
+    def register(self, content_type, handler, qs=1.0, schema=None):
+        """
+        Register `handler` for `content_type`.
+
+        :param str content_type: the content type to register
+        :param handler: the transcoder to use for `content_type`
+        :param float qs: the server-side quality of `content_type`
+            between 0.0 and 1.0.  See :meth:`negotiate` for details.
+        :param schema: :class:`~sprockets.mixins.mediatype.schemas.Schema`
+            or schema :class:`dict` that every request body of
+            `content_type` is validated against
+        :raises ValueError: if `qs` is out of range or `schema` is
+            invalid
+
+        If a handler is already registered for `content_type`, then
+        a warning is logged and the settings are left unchanged.  This
+        is what assigning to the mapping does.
+
+        """
+        if not 0.0 <= qs <= 1.0:
+            raise ValueError('qs must be between 0.0 and 1.0')
+
+        schema = _as_schema(schema)
         parsed = headers.parse_content_type(content_type)
         content_type = str(parsed)
-        if content_type in self._handlers:
-            logger.warning('handler for %s already set to %r',
-                           content_type, self._handlers[content_type])
-            return
+        with self._lock:
+            snapshot = self._snapshot
+            if content_type in snapshot.handlers:
+                logger.warning('handler for %s already set to %r',
+                               content_type, snapshot.handlers[content_type])
+                return
+
+            changes = {}
+            if schema is not None:
+                changes['schemas'] = {**snapshot.schemas,
+                                      content_type: schema}
+            self._snapshot = snapshot.replace(
+                handlers={**snapshot.handlers, content_type: handler},
+                available_types=snapshot.available_types + (parsed,),
+                qualities={**snapshot.qualities, content_type: qs},
+                **changes)
+
+    def for_handler(self, handler_class, overrides=None):
+        """
+        Get the settings that apply to a request handler.
+
+        :param type handler_class: the request handler class
+        :param dict overrides: route specific overrides that take
+            precedence over the ``content_settings`` attribute of
+            `handler_class`
+        :returns: this instance if nothing is overridden, otherwise a
+            :class:`.ContentSettings` instance with the overrides
+            applied
+        :raises ValueError: if an override is unknown, names a content
+            type that is not registered, or sets a default content type
+            that is not one of the ``content_types``
+
+        The following settings can be overridden:
+
+        - ``content_types``: the registered content types that the
+          handler accepts and produces.  If the application's default
+          content type is not one of them, the first one is the default.
+        - ``default_content_type`` and ``default_encoding``: the values
+          that :func:`.set_default_content_type` sets
+
+        The result is calculated once for each handler class and set
+        of equal route overrides and cached until these settings change.
 
-        self._available_types.append(parsed)
-        self._handlers[content_type] = handler
+        """
+        snapshot = self._snapshot
+        key = handler_class, _freeze_overrides(overrides)
+        try:
+            return snapshot.views[key]
+        except KeyError:
+            pass
+
+        merged = dict(getattr(handler_class, 'content_settings', None) or {})
+        merged.update(overrides or {})
+        view = self._compile_view(snapshot, merged) if merged else self
+        snapshot.views[key] = view
+        return view
+
+    def _compile_view(self, snapshot, overrides):
+        unknown = set(overrides) - _OVERRIDABLE_SETTINGS
+        if unknown:
+            raise ValueError('unknown content settings: {}'.format(
+                ', '.join(sorted(unknown))))
+
+        selected = None
+        if overrides.get('content_types') is not None:
+            selected = {}
+            for content_type in overrides['content_types']:
+                normalized = _parse_content_type(content_type).normalized
+                if normalized not in snapshot.handlers:
+                    raise ValueError(
+                        '{} is not registered'.format(content_type))
+                selected[normalized] = content_type
+
+        default_content_type = overrides.get('default_content_type',
+                                             self.default_content_type)
+        if selected is not None and default_content_type is not None and (
+                _parse_content_type(default_content_type).normalized
+                not in selected):
+            if 'default_content_type' in overrides:
+                raise ValueError(
+                    'default content type {} is not one of {}'.format(
+                        default_content_type,
+                        ', '.join(overrides['content_types'])))
+            default_content_type = next(iter(selected.values()), None)
+
+        view = ContentSettings()
+        for parsed in snapshot.available_types:
+            content_type = str(parsed)
+            if selected is None or content_type in selected:
+                view.register(content_type, snapshot.handlers[content_type],
+                              snapshot.qualities[content_type],
+                              snapshot.schemas.get(content_type))
+        view._snapshot = view._snapshot.replace(
+            converters=snapshot.converters)
+        view.default_content_type = default_content_type
+        view.default_encoding = overrides.get('default_encoding',
+                                              self.default_encoding)
+        view.encode_cost_policy = self.encode_cost_policy
+        view.request_decode_executor = self.request_decode_executor
+        view.server_timing = self.server_timing
+        view.allocation_profiler = self.allocation_profiler
+        view.buffer_pool = self.buffer_pool
+        return view
+
+    def negotiate(self, accept):
+        """
+        Rank the available content types for an ``Accept`` header.
+
+        :param str accept: the :http:header:`Accept` header value
+        :returns: :class:`tuple` of the best matching content types
+            without parameters.  The first one is the selected type
+            and the rest are equally acceptable alternatives.  The
+            tuple is empty if nothing matches.
+
+        When every registered content type has the same server-side
+        quality (*qs*), the selection is made by
+        :func:`ietfparse.algorithms.select_content_type`.  Otherwise
+        each available type is scored by multiplying its *qs* by the
+        client's quality for the most specific matching media range
+        and the selection is made from the highest scoring types.  For
+        example, registering ``application/json`` with a *qs* of 0.9
+        steers clients that accept JSON and msgpack equally to msgpack.
+
+        The result is cached for each distinct header value so the
+        ranking is only calculated once per header.  Registering a
+        content type clears the cache.
 
-    def get(self, content_type, default=None):
-        return self._handlers.get(content_type, default)
+        """
+        snapshot = self._snapshot
+        rankings = snapshot.rankings
+        try:
+            return rankings[accept]
+        except KeyError:
+            pass
+
+        ranking = self._rank(snapshot, headers.parse_accept(accept))
+        if len(rankings) >= self.max_rankings:
+            try:
+                rankings.pop(next(iter(rankings)), None)
+            except (RuntimeError, StopIteration):  # changed by another thread
+                pass
+        rankings[accept] = ranking
+        return ranking
+
+    def add_converter(self, converter):
+        """
+        Register a converter between two content types.
+
+        :param converter: the converter to register.  See
+            :func:`.add_converter` for the required interface.
+
+        """
+        source = _parse_content_type(converter.source_type).media_type
+        target = _parse_content_type(converter.target_type).media_type
+        with self._lock:
+            snapshot = self._snapshot
+            self._snapshot = snapshot.replace(converters={
+                **snapshot.converters, (source, target): converter})
+
+    def convert(self, data, source_type, target_type):
+        """
+        Convert an encoded body into another content type.
+
+        :param bytes data: the encoded body
+        :param str source_type: the content type of `data`
+        :param str target_type: the content type to convert to
+        :returns: :class:`tuple` of the content type and the encoded
+            body just like a transcoder's ``to_bytes`` method
+        :raises KeyError: if there is no converter for the content
+            types and no transcoder for one of them
+
+        A registered converter is used when one exists.  Otherwise
+        `data` is decoded by the transcoder for `source_type` and
+        encoded by the transcoder for `target_type`.
+
+        """
+        source = _parse_content_type(source_type).media_type
+        target = _parse_content_type(target_type).media_type
+        try:
+            converter = self._snapshot.converters[source, target]
+        except KeyError:
+            return self[target].to_bytes(self[source].from_bytes(data))
+        return converter.convert(data)
+
+    def broadcast(self, body, recipients, frame=None):
+        """
+        Encode `body` once for each content type that `recipients` use.
+
+        :param body: the object to send
+        :param recipients: iterable of ``(recipient, content_type)``
+            pairs where `content_type` is the content type that the
+            recipient negotiated
+        :param frame: optional callable that is given the encoded
+            :class:`bytes` and returns the bytes to send, such as
+            :func:`.format_sse_event`.  It is called once for each
+            content type as well.
+        :returns: iterator of ``(recipient, content_type, data)``
+            tuples in the order of `recipients`
+        :raises KeyError: if a content type is not registered
+
+        This is meant for sending the same event to many WebSocket or
+        server-sent events connections.  `data` is the same immutable
+        :class:`bytes` instance for every recipient of a content type
+        so it can be handed to each connection without copying it.
+        `body` is encoded when the first recipient of a content type
+        is reached.
+
+        .. code-block:: python
+
+           for connection, _, data in settings.broadcast(
+                 event, [(connection, connection.get_response_content_type())
+                         for connection in subscribers]):
+              connection.write_message(data, binary=True)
+
+        """
+        encoded = {}
+        for recipient, content_type in recipients:
+            media_type = _parse_content_type(content_type).media_type
+            try:
+                result = encoded[media_type]
+            except KeyError:
+                response_type, data = self[media_type].to_bytes(body)
+                data = _join_buffers(data)
+                if frame is not None:
+                    data = frame(data)
+                result = encoded[media_type] = response_type, data
+            yield (recipient,) + result
+
+    def preload(self, accept_headers=()):
+        """
+        Create everything that is otherwise created on first use.
+
+        :param accept_headers: :http:header:`Accept` header values
+            to calculate the :meth:`negotiate` ranking for
+
+        This calls the optional ``preload`` method of each registered
+        transcoder and ranks the content types for `accept_headers`
+        and the default content type.  See :func:`.preload` for the
+        details.
+
+        """
+        for handler in self._snapshot.handlers.values():
+            preload_handler = getattr(handler, 'preload', None)
+            if preload_handler is not None:
+                preload_handler()
+        self.negotiate(self.default_content_type or '*/*')
+        for accept in accept_headers:
+            self.negotiate(accept)
+        self._calculate_simple_rankings(self._snapshot)
+
+    @property
+    def simple_rankings(self):
+        """
+        Rankings of the ``Accept`` values that are a single media range.
+
+        This is a :class:`dict` that maps ``*/*``, ``type/*`` and the
+        registered content types (without parameters) to the same
+        ranking that :meth:`negotiate` returns for them.  It is
+        calculated once after the registered content types change and
+        is never evicted, so the common ``Accept`` values are resolved
+        without parsing the header.
+
+        """
+        snapshot = self._snapshot
+        return (snapshot.simple_rankings
+                or self._calculate_simple_rankings(snapshot))
+
+    def _calculate_simple_rankings(self, snapshot):
+        media_ranges = ['*/*']
+        for available in snapshot.available_types:
+            media_ranges.append(available.content_type + '/*')
+            media_ranges.append(_media_type(available))
+        snapshot.simple_rankings = {
+            media_range: self._rank(snapshot,
+                                    headers.parse_accept(media_range))
+            for media_range in media_ranges}
+        return snapshot.simple_rankings
+
+    def _rank(self, snapshot, requested):
+        qualities = snapshot.qualities
+        scores = [(qualities[str(available)] *
+                   _client_quality(available, requested), available)
+                  for available in snapshot.available_types]
+        if len(set(qualities.values())) > 1:
+            best = max((score for score, _ in scores), default=0.0)
+            candidates = [available for score, available in scores
+                          if best > 0.0 and score == best]
+        else:
+            candidates = list(snapshot.available_types)
+
+        try:
+            selected, _ = algorithms.select_content_type(requested,
+                                                         candidates)
+        except errors.NoMatch:
+            return ()
+
+        selected_score = next(score for score, available in scores
+                              if available is selected)
+        ranking = [selected]
+        if selected_score > 0.0:
+            ranking.extend(available for score, available in scores
+                           if score == selected_score
+                           and available is not selected)
+        return tuple(_media_type(content_type) for content_type in ranking)
 
     @property
     def available_content_types(self):
@@ -121,10 +527,545 @@ class ContentSettings:
         instances.
 
         """
-        return self._available_types
+        return list(self._snapshot.available_types)
+
+
+class _Snapshot:
+    """
+    Registered content types of a :class:`.ContentSettings` instance.
+
+    The registrations are never modified.  :meth:`.replace` creates a
+    new snapshot instead.  The caches are filled in by readers and
+    start empty in each snapshot so that they never mix results from
+    different registrations.
+
+    """
+    __slots__ = ('handlers', 'available_types', 'qualities', 'converters',
+                 'schemas', 'rankings', 'simple_rankings', 'views')
+
+    def __init__(self, handlers, available_types, qualities, converters,
+                 schemas):
+        self.handlers = handlers
+        self.available_types = available_types
+        self.qualities = qualities
+        self.converters = converters
+        self.schemas = schemas
+        self.rankings = {}
+        self.simple_rankings = None
+        self.views = {}
+
+    def replace(self, **changes):
+        """Copy the registrations with `changes` and empty caches."""
+        return _Snapshot(changes.get('handlers', self.handlers),
+                         changes.get('available_types', self.available_types),
+                         changes.get('qualities', self.qualities),
+                         changes.get('converters', self.converters),
+                         changes.get('schemas', self.schemas))
+
+
+def _client_quality(available, requested):
+    """Client quality of `available` from its most specific media range."""
+    quality, specificity = 0.0, None
+    for pattern in requested:
+        if pattern.content_type not in ('*', available.content_type):
+            continue
+        if pattern.content_subtype != '*' and (
+                pattern.content_subtype != available.content_subtype or
+                pattern.content_suffix != available.content_suffix):
+            continue
+        if any(available.parameters.get(name) != value
+               for name, value in pattern.parameters.items()):
+            continue
+        match = (pattern.content_type != '*', pattern.content_subtype != '*',
+                 len(pattern.parameters))
+        if specificity is None or match > specificity:
+            specificity = match
+            quality = 1.0 if pattern.quality is None else pattern.quality
+    return quality
+
+
+class _ContentType(tuple):
+    """
+    Immutable and compact form of a parsed content type.
+
+    Instances are created by :func:`_parse_content_type` and shared
+    between requests so they cannot be modified.
+
+    """
+    __slots__ = ()
+
+    normalized = property(operator.itemgetter(0),
+                          doc='Normalized string form including parameters')
+    media_type = property(operator.itemgetter(1),
+                          doc='Content type without parameters')
+    parameters = property(operator.itemgetter(2),
+                          doc='Sorted tuple of (name, value) parameters')
+
+    def __new__(cls, parsed):
+        return super().__new__(cls, (str(parsed), _media_type(parsed),
+                                     tuple(sorted(parsed.parameters.items()))))
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_content_type(value):
+    """
+    Parse a content type header into an interned :class:`_ContentType`.
+
+    Each distinct header value is parsed once and the result is shared
+    until it is evicted from the bounded LRU cache.
+
+    """
+    return _ContentType(headers.parse_content_type(value))
+
+
+def _as_schema(schema):
+    """Compile `schema` unless it is already compiled."""
+    if schema is None or isinstance(schema, schemas.Schema):
+        return schema
+    return schemas.Schema(schema)
+
+
+def _freeze_overrides(overrides):
+    """Return a hashable form of content settings overrides."""
+    if not overrides:
+        return None
+    return frozenset(
+        (name, tuple(value) if isinstance(value, (list, tuple)) else value)
+        for name, value in overrides.items())
+
+
+def _media_type(content_type):
+    """Format `content_type` without its parameters."""
+    media_type = '/'.join([content_type.content_type,
+                           content_type.content_subtype])
+    if content_type.content_suffix is not None:
+        media_type = '+'.join([media_type, content_type.content_suffix])
+    return media_type
+
+
+class EncodeCostPolicy:
+    """
+    Prefer the content type that is cheapest to encode.
+
+    :param float alpha: weight of the newest measurement in the moving
+        averages
+    :param float exploration: probability of selecting a random
+        alternative instead of the cheapest one so that the costs of
+        the other content types stay current
+    :param seed: seed for the random number generator that drives
+        exploration
+    :param clock: function that returns a time in nanoseconds.  This
+        defaults to :func:`time.perf_counter_ns`.
+
+    An instance of this class is installed by calling
+    :func:`.set_encode_cost_policy`.  When the :http:header:`Accept`
+    header leaves a choice between several content types, the
+    :class:`.ContentMixin` calls :meth:`select` to make it.  Each time
+    the mixin encodes a response, it calls :meth:`record` with the time
+    spent in the transcoder.
+
+    The cost of a content type is tracked separately for each request
+    handler class as moving averages of the encoding time per byte and
+    the size of the encoded body.  Their product is the expected cost
+    of encoding the handler's typical response.  Content types that have
+    not been measured for a handler are selected before any others.
+
+    """
+
+    def __init__(self, alpha=0.1, exploration=0.05, seed=None, clock=None):
+        self.alpha = alpha
+        self.exploration = exploration
+        self.clock = time.perf_counter_ns if clock is None else clock
+        self._random = random.Random(seed)
+        self._costs = {}
+
+    def select(self, handler_name, content_types):
+        """
+        Select one of `content_types` for `handler_name`.
+
+        :param str handler_name: name of the request handler class
+        :param content_types: sequence of equally acceptable content
+            types in order of preference
+        :returns: the selected content type
+
+        """
+        costs = []
+        for content_type in content_types:
+            try:
+                costs.append((self.expected_cost(handler_name, content_type),
+                              content_type))
+            except KeyError:
+                return content_type
+        if self.exploration and self._random.random() < self.exploration:
+            return self._random.choice(content_types)
+        return min(costs, key=lambda cost: cost[0])[1]
+
+    def record(self, handler_name, content_type, elapsed, num_bytes):
+        """
+        Add a measurement to the moving averages.
+
+        :param str handler_name: name of the request handler class
+        :param str content_type: the content type that was encoded
+        :param int elapsed: encoding time in nanoseconds
+        :param int num_bytes: size of the encoded body
+
+        """
+        key = handler_name, content_type
+        ns_per_byte = elapsed / max(num_bytes, 1)
+        try:
+            avg_ns_per_byte, avg_bytes = self._costs[key]
+        except KeyError:
+            self._costs[key] = ns_per_byte, float(num_bytes)
+        else:
+            self._costs[key] = (
+                avg_ns_per_byte + self.alpha * (ns_per_byte - avg_ns_per_byte),
+                avg_bytes + self.alpha * (num_bytes - avg_bytes))
+
+    def expected_cost(self, handler_name, content_type):
+        """
+        Expected encoding time of a typical response in nanoseconds.
+
+        :raises KeyError: if `content_type` has not been measured for
+            `handler_name`
+
+        """
+        ns_per_byte, num_bytes = self._costs[handler_name, content_type]
+        return ns_per_byte * num_bytes
+
+    @property
+    def cost_table(self):
+        """
+        Copy of the current measurements.
+
+        This is a :class:`dict` that maps ``(handler_name, content_type)``
+        pairs to ``(ns_per_byte, num_bytes)`` moving averages.
+
+        """
+        return dict(self._costs)
+
+
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)  # Python 3.9+
+
+
+class AllocationProfiler:
+    """
+    Sample the memory that is allocated while transcoding bodies.
+
+    :param float sample_rate: fraction of the decode and encode calls
+        to measure between 0.0 and 1.0
+    :param seed: seed for the random number generator that selects
+        the calls to measure
+
+    An instance of this class is installed by calling
+    :func:`.set_allocation_profiler`.  The :class:`.ContentMixin`
+    measures a call to ``get_request_body`` or ``send_response`` that
+    decodes or encodes a body when :meth:`sample` selects it.
+
+    Measurements use :mod:`tracemalloc`.  Tracing starts when a
+    measured call starts and stops when the last concurrent measured
+    call ends unless it was already started by someone else, so calls
+    that are not sampled run at full speed.  While tracing is on, all
+    allocations in the process are counted.  That includes other
+    threads and the coroutines that run while an asynchronous
+    transcoder is awaited, so keep the sample rate low enough that
+    measurements rarely overlap.
+
+    Two numbers are recorded for each measured call: the memory that
+    is still allocated when the call returns, which is mostly the
+    decoded or encoded body, and the peak above the memory that was
+    allocated when the call started.  :attr:`allocation_table` has the
+    totals for each request handler class, content type, and
+    operation.  Python versions before 3.9 cannot reset the peak so it
+    is only exact for calls that start tracing.  The peak of a call
+    that overlaps another one or that runs while someone else traces
+    is the peak since tracing started which can be higher.
+
+    """
+
+    def __init__(self, sample_rate=0.01, seed=None):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError('sample_rate must be between 0.0 and 1.0')
+        self.sample_rate = sample_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._started = False
+        self._stats = {}
+
+    def sample(self):
+        """Decide whether to measure the next call."""
+        return self._random.random() < self.sample_rate
+
+    def start(self):
+        """
+        Start measuring a call.
+
+        :returns: the allocated memory in bytes to pass to :meth:`stop`
+
+        """
+        with self._lock:
+            if not self._active and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started = True
+            self._active += 1
+            if _reset_peak is not None:
+                _reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+        return current
+
+    def stop(self, baseline, handler_name, content_type, operation):
+        """
+        Stop measuring a call and record the result.
+
+        :param int baseline: the value returned by :meth:`start`
+        :param str handler_name: name of the request handler class
+        :param str content_type: the content type that was transcoded
+        :param str operation: ``decode`` or ``encode``
+
+        """
+        with self._lock:
+            current, peak = tracemalloc.get_traced_memory()
+            self._active -= 1
+            if not self._active and self._started:
+                tracemalloc.stop()
+                self._started = False
+        self.record(handler_name, content_type, operation,
+                    current - baseline, peak - baseline)
+
+    def record(self, handler_name, content_type, operation, allocated,
+               peak):
+        """
+        Add a measurement to the totals.
+
+        :param str handler_name: name of the request handler class
+        :param str content_type: the content type that was transcoded
+        :param str operation: ``decode`` or ``encode``
+        :param int allocated: bytes still allocated after the call
+        :param int peak: highest number of bytes allocated during the
+            call
+
+        """
+        key = handler_name, content_type, operation
+        with self._lock:
+            samples, total_allocated, total_peak, max_peak = \
+                self._stats.get(key, (0, 0, 0, 0))
+            self._stats[key] = (samples + 1, total_allocated + allocated,
+                                total_peak + peak, max(max_peak, peak))
+
+    @property
+    def allocation_table(self):
+        """
+        Summary of the measurements.
+
+        This is a :class:`dict` that maps ``(handler_name, content_type,
+        operation)`` tuples to a :class:`dict` with the number of
+        ``samples``, the mean ``allocated_bytes`` and ``peak_bytes``,
+        and the ``max_peak_bytes`` of any call.
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        return {key: {'samples': samples,
+                      'allocated_bytes': total_allocated / samples,
+                      'peak_bytes': total_peak / samples,
+                      'max_peak_bytes': max_peak}
+                for key, (samples, total_allocated, total_peak, max_peak)
+                in stats.items()}
+
+    def reset(self):
+        """Discard the measurements."""
+        with self._lock:
+            self._stats = {}
+
+
+class BufferPool:
+    """
+    Bounded pool of reusable output buffers.
+
+    :param int max_buffers: the number of idle buffers to keep
+    :param int buffer_size: the initial size of a new buffer in bytes
+    :param int max_buffer_size: buffers that grew beyond this many
+        bytes are discarded instead of being kept
+
+    An instance of this class is installed by calling
+    :func:`.set_buffer_pool`.  :meth:`.AsyncContentMixin.send_response`
+    then encodes bodies with the transcoder's ``to_buffer`` method into
+    a buffer from the pool, writes a view of the buffer to the
+    connection, and returns the buffer to the pool once the write has
+    completed.  Buffers are :class:`io.BytesIO` instances that keep
+    their size so a worker that sends bodies of similar sizes reuses
+    the same few allocations instead of creating a new :class:`bytes`
+    instance for every body.  Only transcoders that can encode
+    straight into a buffer implement ``to_buffer``, such as
+    :class:`~sprockets.mixins.mediatype.transcoders.MsgPackTranscoder`.
+    Copying the result of ``to_bytes`` into a buffer would cost more
+    than it saves so other transcoders send their bodies as before.
+
+    :attr:`stats` counts the buffers that were reused (``hits``), the
+    ones that had to be created (``misses``), and the ones that were
+    discarded because a body made them larger than `max_buffer_size`
+    (``oversize``).
+
+    """
+
+    def __init__(self, max_buffers=16, buffer_size=64 * 1024,
+                 max_buffer_size=1024 * 1024):
+        self.max_buffers = max_buffers
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max_buffer_size
+        self._lock = threading.Lock()
+        self._buffers = []
+        self._hits = 0
+        self._misses = 0
+        self._oversize = 0
+
+    def acquire(self):
+        """
+        Take a buffer from the pool or create one.
+
+        :returns: a :class:`io.BytesIO` instance that is positioned at
+            the first byte and belongs to the caller until it is passed
+            to :meth:`release`
+
+        """
+        with self._lock:
+            if self._buffers:
+                self._hits += 1
+                return self._buffers.pop()
+            self._misses += 1
+        return io.BytesIO(bytes(self.buffer_size))
+
+    def release(self, buffer):
+        """
+        Return a buffer that was taken by :meth:`acquire`.
+
+        :param io.BytesIO buffer: the buffer to return.  It must not be
+            used after it is released.
+
+        Buffers that views are still held of are discarded.
+
+        """
+        try:
+            buffer.write(b'')
+        except BufferError:  # the stream that held a view was closed
+            return
+        # seeking does not shrink the buffer so it keeps its allocation
+        size = buffer.seek(0, io.SEEK_END)
+        buffer.seek(0)
+        with self._lock:
+            if size > self.max_buffer_size:
+                self._oversize += 1
+            elif len(self._buffers) < self.max_buffers:
+                self._buffers.append(buffer)
+
+    @property
+    def stats(self):
+        """
+        Usage counters.
+
+        This is a :class:`dict` with the number of ``hits``, ``misses``,
+        and ``oversize`` buffers and the number of buffers that are
+        ``available`` in the pool.
+
+        """
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'oversize': self._oversize,
+                    'available': len(self._buffers)}
+
+
+class _PooledBody:
+    """Encoded body that was written into a buffer from a pool."""
+
+    def __init__(self, pool, buffer, length):
+        self.pool = pool
+        self.buffer = buffer
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    async def send(self, connection):
+        """Write the body and return the buffer once it was sent."""
+        with self.buffer.getbuffer() as view, view[:self.length] as chunk:
+            await connection.write(chunk)
+        self.pool.release(self.buffer)
+
+
+class _ResponseEncoding:
+    """Encoder that ``send_response`` selected and its result."""
+
+    def __init__(self, encode, response_type=None):
+        self.encode = encode
+        self.response_type = response_type
+        self.result = None
+
+
+def _body_length(data):
+    """Length of an encoded body in bytes."""
+    if isinstance(data, (list, tuple)):
+        return sum(memoryview(buffer).nbytes for buffer in data)
+    return len(data)
+
+
+def _as_body(data):
+    """Return a body that is a single buffer as :class:`bytes`."""
+    if isinstance(data, (list, tuple, EncodedBody, _PooledBody)):
+        return data
+    if isinstance(data, str):
+        return escape.utf8(data)
+    return _as_bytes(data)
+
+
+def _as_bytes(buffer):
+    """Return `buffer` as :class:`bytes`, copying it only if necessary."""
+    return buffer if isinstance(buffer, bytes) else memoryview(
+        buffer).tobytes()
 
 
-def install(application, default_content_type, encoding=None):
+def _encode(pool, handler, body):
+    """Encode `body` into a buffer from `pool` when possible."""
+    to_buffer = None if pool is None else getattr(handler, 'to_buffer', None)
+    if to_buffer is None:
+        return handler.to_bytes(body)
+    buffer = pool.acquire()
+    try:
+        content_type, data = to_buffer(body, buffer)
+    except Exception:
+        pool.release(buffer)
+        raise
+    if not isinstance(data, int):  # the transcoder used to_bytes
+        pool.release(buffer)
+        return content_type, data
+    return content_type, _PooledBody(pool, buffer, data)
+
+
+def _join_buffers(data):
+    """Return an encoded body as a single :class:`bytes` instance."""
+    if isinstance(data, (list, tuple)):
+        return b''.join(data)
+    return _as_body(data)
+
+
+def _format_server_timing(metrics):
+    """Format ``{name: (nanoseconds, description)}`` as a header value."""
+    entries = []
+    for name, (elapsed, description) in metrics.items():
+        entry = '{};dur={:.3f}'.format(name, elapsed / 1e6)
+        if description is not None:
+            entry += ';desc="{}"'.format(description)
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+def _handler_name(handler):
+    """Qualified class name of a request handler instance."""
+    cls = handler.__class__
+    return '.'.join([cls.__module__, cls.__qualname__])
+
+
+def install(application, default_content_type, encoding=None,
+            server_timing=False):
     """
     Install the media type management settings.
 
@@ -132,10 +1073,28 @@ def install(application, default_content_type, encoding=None):
         install a :class:`.ContentSettings` object into.
     :param str|NoneType default_content_type:
     :param str|NoneType encoding:
+    :param bool|str server_timing: :data:`True` to add a
+        :http:header:`Server-Timing` header to every response sent by
+        ``send_response`` or the name of a request header that adds it
+        to the responses of requests that include the header.
 
     :returns: the content settings instance
     :rtype: sprockets.mixins.mediatype.content.ContentSettings
 
+    The :http:header:`Server-Timing` header reports the time spent
+    negotiating the response content type (``negotiate``), decoding
+    the request body (``decode``), and encoding the response body
+    (``encode``) in milliseconds.  The description of ``decode`` and
+    ``encode`` is the size of the body in bytes::
+
+       Server-Timing: negotiate;dur=0.004,
+          decode;dur=0.110;desc="2048 bytes",
+          encode;dur=0.052;desc="1024 bytes"
+
+    Nothing is measured for requests that the header is not added to.
+    Since the header exposes details of the server, enable it with a
+    request header that only trusted clients send in production.
+
     """
     try:
         settings = application.settings[SETTINGS_KEY]
@@ -143,6 +1102,7 @@ def install(application, default_content_type, encoding=None):
         settings = application.settings[SETTINGS_KEY] = ContentSettings()
         settings.default_content_type = default_content_type
         settings.default_encoding = encoding
+        settings.server_timing = server_timing
     return settings
 
 
@@ -207,7 +1167,8 @@ def add_text_content_type(application, content_type, default_encoding,
                                                default_encoding))
 
 
-def add_transcoder(application, transcoder, content_type=None):
+def add_transcoder(application, transcoder, content_type=None, qs=1.0,
+                   schema=None):
     """
     Register a transcoder for a specific content type.
 
@@ -217,6 +1178,14 @@ def add_transcoder(application, transcoder, content_type=None):
     :param str content_type: the content type to add.  If this is
         unspecified or :data:`None`, then the transcoder's ``content_type``
         attribute is used.
+    :param float qs: the server-side quality of the content type between
+        0.0 and 1.0.  When a client accepts several content types equally,
+        the one with the highest *qs* is selected.  Use a lower value for
+        content types that are more expensive to produce.
+    :param schema: validate every request body of the content type
+        against this :class:`~sprockets.mixins.mediatype.schemas.Schema`
+        or schema :class:`dict`.  See
+        :meth:`.ContentMixin.get_request_body`.
 
     The `transcoder` instance is required to implement the following
     simple protocol:
@@ -232,15 +1201,127 @@ def add_transcoder(application, transcoder, content_type=None):
        :param str encoding: character encoding to apply or :data:`None`
        :returns: the encoded :class:`bytes` instance
 
+       Transcoders that produce large responses MAY return a sequence
+       of :class:`bytes` (or other bytes-like) buffers instead.  The
+       buffers are written and flushed one at a time so the response
+       is never joined into a single object.
+
     .. method:: transcoder.from_bytes(data_bytes, encoding=None) -> object
 
        :param bytes data_bytes: the :class:`bytes` instance to decode
        :param str encoding: character encoding to use or :data:`None`
        :returns: the decoded :class:`object` instance
 
+    The transcoder MAY also implement the following methods:
+
+    .. method:: transcoder.preload() -> None
+
+       Create any state that the transcoder would otherwise create
+       lazily.  This is called by :func:`.preload`.
+
+    .. method:: transcoder.async_to_bytes(inst_data, encoding=None)
+       :async:
+
+       Coroutine version of ``to_bytes`` that is awaited by
+       :class:`.AsyncContentMixin`.
+
+    .. method:: transcoder.async_from_bytes(data_bytes, encoding=None)
+       :async:
+
+       Coroutine version of ``from_bytes`` that is awaited by
+       :class:`.AsyncContentMixin`.
+
+    .. method:: transcoder.to_buffer(inst_data, buffer, encoding=None)
+
+       :param object inst_data: the object to encode
+       :param io.BytesIO buffer: the buffer to write the encoded body
+           to.  It is positioned at the first byte.
+       :param str encoding: character encoding to apply or :data:`None`
+       :returns: :class:`tuple` of the content type and the number of
+           bytes that were written, or the result of ``to_bytes`` when
+           the body is not written to the buffer
+
+       Version of ``to_bytes`` that is called instead of it when a
+       :class:`.BufferPool` is installed.  See :func:`.set_buffer_pool`.
+       Only implement this when the body is encoded directly into
+       `buffer` instead of being copied into it.
+
+    .. method:: transcoder.lazy_from_bytes(data_bytes, encoding=None)
+
+       Version of ``from_bytes`` that returns a mapping which decodes
+       values when they are accessed and has a ``materialize()`` method
+       that returns the fully decoded :class:`dict`, such as
+       :class:`~sprockets.mixins.mediatype.lazy.LazyDocument`.  Other
+       values are treated as fully decoded bodies.  This is called when
+       a handler calls ``get_request_body(lazy=True)``.  Transcoders
+       without it decode the entire body instead.
+
     """
     settings = get_settings(application, force_instance=True)
-    settings[content_type or transcoder.content_type] = transcoder
+    settings.register(content_type or transcoder.content_type, transcoder,
+                      qs=qs, schema=schema)
+
+
+def add_converter(application, converter):
+    """
+    Register a converter between two content types.
+
+    :param tornado.web.Application application: the application to modify
+    :param converter: object that translates encoded bodies from one
+        content type into another without decoding them into objects
+
+    Converters are used by :meth:`.ContentMixin.get_request_body_as`
+    and when :meth:`.ContentMixin.send_response` has to convert an
+    :class:`.EncodedBody`.  The
+    :mod:`~sprockets.mixins.mediatype.converters` module contains
+    converters between JSON and msgpack.  A converter implements the
+    following simple protocol:
+
+    .. attribute:: converter.source_type
+
+       :class:`str` that identifies the content type that the
+       converter reads.
+
+    .. attribute:: converter.target_type
+
+       :class:`str` that identifies the content type that the
+       converter produces.
+
+    .. method:: converter.convert(data_bytes) -> (str, bytes)
+
+       :param bytes data_bytes: the encoded body to convert
+       :returns: :class:`tuple` of the content type and the converted
+           body just like a transcoder's ``to_bytes`` method
+
+    """
+    settings = get_settings(application, force_instance=True)
+    settings.add_converter(converter)
+
+
+def preload(application, accept_headers=()):
+    """
+    Prepare the content settings to be shared by forked processes.
+
+    :param tornado.web.Application application: the application to
+        prepare
+    :param accept_headers: commonly received :http:header:`Accept`
+        header values to rank the content types for ahead of time
+    :returns: the content settings instance
+    :rtype: sprockets.mixins.mediatype.content.ContentSettings
+
+    Call this after the transcoders are registered and before calling
+    :func:`tornado.process.fork_processes`.  Everything that would be
+    created on first use in each worker is created in the parent process
+    instead so that the workers start with it and share the memory
+    pages copy-on-write.  Transcoders take part by implementing the
+    optional ``preload`` method described in :func:`.add_transcoder`.
+    The content negotiation rankings for the default content type and
+    `accept_headers` are calculated as well.
+
+    """
+    settings = get_settings(application, force_instance=True)
+    settings.preload(accept_headers)
+    return settings
 
 
 def set_default_content_type(application, content_type, encoding=None):
@@ -257,6 +1338,244 @@ def set_default_content_type(application, content_type, encoding=None):
     settings.default_encoding = encoding
 
 
+def set_encode_cost_policy(application, policy):
+    """
+    Select among equally acceptable content types by encoding cost.
+
+    :param tornado.web.Application application: the application to modify
+    :param policy: the policy to install, usually a
+        :class:`.EncodeCostPolicy` instance, or :data:`None` to always
+        select the preferred content type
+
+    A policy implements :meth:`~.EncodeCostPolicy.select`,
+    :meth:`~.EncodeCostPolicy.record`, and the
+    :attr:`~.EncodeCostPolicy.clock` attribute.
+
+    """
+    settings = get_settings(application, force_instance=True)
+    settings.encode_cost_policy = policy
+
+
+def set_request_decode_executor(application, executor):
+    """
+    Decode request bodies on an executor as soon as they arrive.
+
+    :param tornado.web.Application application: the application to modify
+    :param concurrent.futures.Executor executor: the executor to decode
+        request bodies on or :data:`None` to decode them when
+        ``get_request_body`` is called
+
+    When an executor is installed, the :class:`.ContentMixin` submits
+    the request body to it in ``prepare`` so that decoding runs while
+    the handler is waiting on its own I/O.  ``get_request_body``
+    returns the result, waiting for it if necessary.
+
+    """
+    settings = get_settings(application, force_instance=True)
+    settings.request_decode_executor = executor
+
+
+def set_allocation_profiler(application, profiler):
+    """
+    Measure the memory that decoding and encoding bodies allocates.
+
+    :param tornado.web.Application application: the application to modify
+    :param AllocationProfiler profiler: the profiler that samples and
+        records the measurements or :data:`None` to stop measuring
+
+    .. code-block:: python
+
+       profiler = content.AllocationProfiler(sample_rate=0.001)
+       content.set_allocation_profiler(application, profiler)
+       ...
+       for key, stats in profiler.allocation_table.items():
+          print(key, stats['max_peak_bytes'])
+
+    """
+    settings = get_settings(application, force_instance=True)
+    settings.allocation_profiler = profiler
+
+
+def set_buffer_pool(application, pool):
+    """
+    Encode response bodies into buffers that are reused.
+
+    :param tornado.web.Application application: the application to modify
+    :param BufferPool pool: the pool to take buffers from or
+        :data:`None` to encode bodies with ``to_bytes``
+
+    .. code-block:: python
+
+       pool = content.BufferPool(max_buffers=32)
+       content.set_buffer_pool(application, pool)
+       ...
+       print(pool.stats['hits'], pool.stats['oversize'])
+
+    Only :meth:`.AsyncContentMixin.send_response` uses the pool since
+    the buffer can only be reused after the connection has sent it.
+    The :http:header:`Content-Length` header is set and the response
+    headers are sent when a body is written from a pooled buffer.
+    Transcoders that do not have a ``to_buffer`` method, the
+    asynchronous ``async_to_bytes`` coroutine, ``HEAD`` requests, and
+    applications that compress responses are not affected.
+
+    """
+    settings = get_settings(application, force_instance=True)
+    settings.buffer_pool = pool
+
+
+def format_sse_event(data, event=None, event_id=None, retry=None):
+    """
+    Frame an encoded body as a server-sent event.
+
+    :param bytes data: the encoded body which has to be UTF-8 text
+    :param str event: optional event type
+    :param str event_id: optional event ID that the client sends back
+        in the :http:header:`Last-Event-ID` header when it reconnects
+    :param int retry: optional reconnection delay in milliseconds
+    :returns: the event as :class:`bytes` in the ``text/event-stream``
+        format
+    :raises ValueError: if `data` is not UTF-8 text or `event` or
+        `event_id` contain line breaks
+
+    Each line of `data` becomes a ``data`` field so the client receives
+    `data` unchanged.  Use this as the `frame` argument of
+    :meth:`.ContentSettings.broadcast` to frame each encoded body once::
+
+       frame = functools.partial(format_sse_event, event='update')
+       for handler, _, data in settings.broadcast(
+             update, [(handler, handler.get_response_content_type())
+                      for handler in subscribers], frame=frame):
+          handler.write(data)
+          handler.flush()
+
+    """
+    data = _as_bytes(data)
+    data.decode('utf-8')  # raises ValueError for binary content types
+    lines = []
+    for name, value in (('event', event), ('id', event_id)):
+        if value is not None:
+            if _LINE_BREAK.search(value) or '\0' in value:
+                raise ValueError('{} cannot contain line breaks or null '
+                                 'characters'.format(name))
+            lines.append('{}: {}'.format(name, value).encode('utf-8'))
+    if retry is not None:
+        lines.append('retry: {:d}'.format(retry).encode('ascii'))
+    lines.extend(b'data: ' + line for line in _LINE_BREAK_BYTES.split(data))
+    lines.append(b'\n')
+    return b'\n'.join(lines)
+
+
+class EncodedBody:
+    """
+    A response body that is already encoded.
+
+    :param data: the encoded body as a bytes-like object, a
+        :class:`mmap.mmap` instance, or the path of a file to send
+    :param str content_type: the content type of `data` as it should
+        appear in the :http:header:`Content-Type` header
+    :param int chunk_size: size of the chunks to send memory mapped
+        data in
+
+    Pass an instance to :meth:`.ContentMixin.send_response` to send
+    pre-built documents without decoding and re-encoding them.  Files
+    are memory mapped when the response is written and are sent in
+    `chunk_size` chunks.  :meth:`.AsyncContentMixin.send_response`
+    waits for each chunk to be sent before it reads the next one so
+    that files and memory maps are never read into memory as a whole.
+    :meth:`.ContentMixin.send_response` cannot wait, so every chunk is
+    copied into the connection's write buffer before any of them is
+    sent and a slow client makes it hold the entire body.  Use the
+    asynchronous mixin to stream large files.  The data is only decoded
+    (using the transcoder registered for `content_type`) when the
+    client needs a different content type.
+
+    """
+
+    def __init__(self, data, content_type, chunk_size=64 * 1024):
+        self.data = data
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.media_type = _parse_content_type(content_type).media_type
+
+    def __len__(self):
+        if isinstance(self.data, (str, os.PathLike)):
+            return os.stat(self.data).st_size
+        return memoryview(self.data).nbytes
+
+    def __iter__(self):
+        if isinstance(self.data, (str, os.PathLike)):
+            with open(self.data, 'rb') as file:
+                if os.fstat(file.fileno()).st_size:
+                    with mmap.mmap(file.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as mapped:
+                        yield from self._chunks(mapped)
+        else:
+            yield from self._chunks(self.data)
+
+    def decode(self, settings):
+        """
+        Decode the body using the transcoder registered in `settings`.
+
+        :param ContentSettings settings: the content settings to
+            find the transcoder in
+        :raises KeyError: if no transcoder is registered for
+            :attr:`content_type`
+
+        """
+        return settings[self.media_type].from_bytes(b''.join(self))
+
+    def _chunks(self, data):
+        if not isinstance(data, mmap.mmap):  # slicing a mmap copies
+            data = memoryview(data).cast('B')
+        for offset in range(0, len(data), self.chunk_size):
+            yield data[offset:offset + self.chunk_size]
+
+
+class _LazyRequestBody(abc.Mapping):
+    """Report errors in a lazily decoded request body as bad requests."""
+
+    def __init__(self, document, logger):
+        self._document = document
+        self._logger = logger
+
+    def __getitem__(self, key):
+        try:
+            return self._document[key]
+        except KeyError:
+            raise
+        except Exception:
+            self._fail()
+
+    def __iter__(self):
+        try:
+            return iter(self._document)
+        except Exception:
+            self._fail()
+
+    def __len__(self):
+        try:
+            return len(self._document)
+        except Exception:
+            self._fail()
+
+    def __contains__(self, key):
+        try:
+            return key in self._document
+        except Exception:
+            self._fail()
+
+    def materialize(self):
+        try:
+            return self._document.materialize()
+        except Exception:
+            self._fail()
+
+    def _fail(self):
+        self._logger.error('failed to decode request body')
+        raise web.HTTPError(400, 'failed to decode request')
+
+
 class ContentMixin:
     """
     Mix this in to add some content handling methods.
@@ -276,72 +1595,476 @@ class ContentMixin:
     and the application :class:`ContentSettings`, and writes it out,
     using ``self.write()``.
 
+    If a request decode executor is installed by calling
+    :func:`.set_request_decode_executor`, then decoding starts in
+    :meth:`prepare` and :meth:`get_request_body` waits for the result.
+    Sub-classes that implement ``prepare`` need to call the
+    ``super()`` implementation for this to happen.
+
+    The application's content settings can be narrowed for a handler
+    by setting the :attr:`content_settings` class attribute or for a
+    route by passing a ``content_settings`` keyword to the handler:
+
+    .. code-block:: python
+
+       class JSONOnlyHandler(ContentMixin, web.RequestHandler):
+          content_settings = {'content_types': ['application/json']}
+
+       app = web.Application([
+          ('/json', JSONOnlyHandler),
+          ('/status', StatusHandler,
+           {'content_settings': {'default_content_type': 'text/plain'}}),
+       ])
+
+    See :meth:`.ContentSettings.for_handler` for the available settings.
+
     """
 
-    def initialize(self):
-        super().initialize()
+    content_settings = None
+    """:class:`dict` of content settings that apply to this handler."""
+
+    def initialize(self, content_settings=None, **kwargs):
+        super().initialize(**kwargs)
+        self._route_content_settings = content_settings
+        self._content_settings = None
         self._request_body = None
+        self._request_body_future = None
+        self._lazy_request_body = None
         self._best_response_match = None
+        self._server_timing = None
         self._logger = getattr(self, 'logger', logger)
 
+    def prepare(self):
+        maybe_future = super().prepare()
+        server_timing = self._get_content_settings().server_timing
+        if server_timing and (server_timing is True
+                              or server_timing in self.request.headers):
+            self._server_timing = {}
+        if self.request.body:
+            self._request_body_future = self._start_request_decode()
+        return maybe_future
+
+    def on_finish(self):
+        super().on_finish()
+        future = self._request_body_future
+        if future is not None and not future.done():
+            future.cancel()
+
     def get_response_content_type(self):
         """Figure out what content type will be used in the response."""
         if self._best_response_match is None:
-            settings = get_settings(self.application, force_instance=True)
-            acceptable = headers.parse_accept(
-                self.request.headers.get(
-                    'Accept',
-                    settings.default_content_type
-                    if settings.default_content_type else '*/*'))
-            try:
-                selected, _ = algorithms.select_content_type(
-                    acceptable, settings.available_content_types)
-                self._best_response_match = '/'.join(
-                    [selected.content_type, selected.content_subtype])
-                if selected.content_suffix is not None:
-                    self._best_response_match = '+'.join(
-                        [self._best_response_match, selected.content_suffix])
-            except errors.NoMatch:
-                self._best_response_match = settings.default_content_type
+            self._best_response_match = self._select_response_type()
 
         return self._best_response_match
 
-    def get_request_body(self):
+    def _select_response_type(self, preferred=None):
+        if self._server_timing is None:
+            return self._negotiate_response_type(preferred)
+        start = time.perf_counter_ns()
+        try:
+            return self._negotiate_response_type(preferred)
+        finally:
+            self._record_timing('negotiate', start)
+
+    def _negotiate_response_type(self, preferred):
+        settings = self._get_content_settings()
+        accept = self.request.headers.get(
+            'Accept',
+            settings.default_content_type
+            if settings.default_content_type else '*/*')
+        ranking = settings.simple_rankings.get(accept)
+        if ranking is None:
+            ranking = settings.negotiate(accept)
+        if preferred in ranking:
+            return preferred
+        policy = settings.encode_cost_policy
+        if len(ranking) > 1 and policy is not None:
+            return policy.select(_handler_name(self), ranking)
+        if ranking:
+            return ranking[0]
+        return settings.default_content_type
+
+    def get_request_body(self, lazy=False, schema=None):
         """
         Fetch (and cache) the request body as a dictionary.
 
+        :param bool lazy: return a mapping that decodes each value when
+            it is accessed instead of decoding the entire body
+        :param schema: validate the body against this
+            :class:`~sprockets.mixins.mediatype.schemas.Schema` or
+            schema :class:`dict`
         :raise web.HTTPError:
             - if the content type cannot be matched, then the status code
               is set to 415 Unsupported Media Type.
             - if decoding the content body fails, then the status code is
               set to 400 Bad Syntax.
+            - if the body does not match `schema` or the schema that was
+              registered for its content type, then the status code is
+              set to 400 Bad Syntax.
+
+        Lazy decoding helps handlers that only look at a few members of
+        large bodies.  The transcoder has to implement the optional
+        ``lazy_from_bytes`` method described in :func:`.add_transcoder`
+        and the body is decoded in full otherwise, or when it is already
+        being decoded in the background.  Errors in a lazily decoded body
+        are detected when the part of the body that contains them is
+        accessed and raise the same 400 Bad Syntax error.  Calling this
+        method without `lazy` afterwards decodes the remaining values.
+
+        The schema that was passed to :func:`.add_transcoder` is applied
+        in a single pass right after the body is decoded and before it
+        is cached.  `schema` is applied every time that it is passed so
+        create the :class:`~sprockets.mixins.mediatype.schemas.Schema`
+        once instead of passing a :class:`dict`.  Validation stops at
+        the first violation and the error is logged.  It is the cause
+        of the :exc:`~tornado.web.HTTPError` that ``write_error``
+        receives so handlers can report its ``pointer`` and ``message``.
+        Bodies that are validated are never decoded lazily.
 
         """
+        schema = _as_schema(schema)
         if self._request_body is None:
-            settings = get_settings(self.application, force_instance=True)
-            content_type_header = headers.parse_content_type(
-                self.request.headers.get('Content-Type',
-                                         settings.default_content_type))
-            content_type = '/'.join([content_type_header.content_type,
-                                     content_type_header.content_subtype])
-            if content_type_header.content_suffix is not None:
-                content_type = '+'.join([content_type,
-                                         content_type_header.content_suffix])
-            try:
-                handler = settings[content_type]
-            except KeyError:
-                raise web.HTTPError(415, 'cannot decode body of type %s',
+            body = self._get_lazy_request_body(schema) if lazy else None
+            if body is not None:
+                return body
+            with self._decoding_request_body():
+                body = self._decode_request_body()
+            self._cache_request_body(body)
+        return self._check_request_body(schema)
+
+    def get_request_body_as(self, content_type):
+        """
+        Fetch the request body encoded as `content_type`.
+
+        :param str content_type: the content type to return the body in
+        :returns: :class:`tuple` of the content type and the encoded
+            body just like a transcoder's ``to_bytes`` method
+        :raise web.HTTPError:
+            - if the content type cannot be matched, then the status code
+              is set to 415 Unsupported Media Type.
+            - if converting the content body fails, then the status code
+              is set to 400 Bad Syntax.
+
+        This is meant for handlers that forward the request body.  The
+        body is returned unchanged when it already has the requested
+        content type.  Otherwise it is translated by a converter that
+        was registered with :func:`.add_converter` without decoding it
+        into objects, or decoded and encoded again if there is none.
+
+        """
+        settings = self._get_content_settings()
+        header = self.request.headers.get('Content-Type',
+                                          settings.default_content_type)
+        source_type = _parse_content_type(header).media_type
+        if source_type == _parse_content_type(content_type).media_type:
+            return header, self.request.body
+        try:
+            return settings.convert(self.request.body, source_type,
                                     content_type)
+        except KeyError:
+            raise web.HTTPError(415, 'cannot convert body of type %s',
+                                source_type)
+        except Exception:
+            self._logger.error('failed to convert request body')
+            raise web.HTTPError(400, 'failed to convert request')
+
+    def send_response(self, body, set_content_type=True):
+        """
+        Serialize and send ``body`` in the response.
+
+        :param dict body: the body to serialize
+        :param bool set_content_type: should the :http:header:`Content-Type`
+            header be set?  Defaults to :data:`True`
+
+        If the transcoder returns a sequence of buffers, then the
+        :http:header:`Content-Length` header is set and each buffer is
+        flushed as it is written.  This means that the response headers
+        are sent by this method.  The flushes are not waited for, so
+        every buffer is held in memory until the client has read it.
+        :meth:`.AsyncContentMixin.send_response` waits for each flush.
+
+        `body` can also be a :class:`.EncodedBody` instance.  It is sent
+        as-is when its content type is one of the best matches for the
+        :http:header:`Accept` header.  Otherwise it is converted into the
+        negotiated content type using :meth:`.ContentSettings.convert`.
+
+        """
+        with self._encoding_response(body) as encoding:
+            encoding.result = encoding.encode(body)
+        content_type, data_bytes = encoding.result
+        self._set_response_headers(content_type, data_bytes, set_content_type)
+        if isinstance(data_bytes, bytes):
+            self.write(data_bytes)
+        else:
+            for buffer in data_bytes:
+                self.write(_as_bytes(buffer))
+                self.flush()
+
+    def _get_content_settings(self):
+        if self._content_settings is None:
+            settings = get_settings(self.application, force_instance=True)
+            self._content_settings = settings.for_handler(
+                type(self), self._route_content_settings)
+        return self._content_settings
+
+    def _start_request_decode(self):
+        settings = self._get_content_settings()
+        if settings.request_decode_executor is None:
+            return None
+        try:
+            transcoder = self._get_request_transcoder()
+        except web.HTTPError:  # reported by get_request_body
+            return None
+        return settings.request_decode_executor.submit(
+            transcoder.from_bytes, self.request.body)
 
+    def _get_lazy_request_body(self, schema):
+        # bodies that are validated are decoded in full
+        if schema is not None or self._get_request_schema() is not None:
+            return None
+        if self._lazy_request_body is None:
+            if self._request_body_future is not None:
+                return None
+            transcoder = self._get_request_transcoder()
+            lazy_from_bytes = getattr(transcoder, 'lazy_from_bytes', None)
+            if lazy_from_bytes is None:
+                return None
             try:
-                self._request_body = handler.from_bytes(self.request.body)
+                body = lazy_from_bytes(self.request.body)
             except Exception:
                 self._logger.error('failed to decode request body')
                 raise web.HTTPError(400, 'failed to decode request')
-
+            if not hasattr(body, 'materialize'):
+                self._request_body = body
+                return body
+            self._lazy_request_body = body
+        return _LazyRequestBody(self._lazy_request_body, self._logger)
+
+    @contextlib.contextmanager
+    def _decoding_request_body(self):
+        start = (None if self._server_timing is None
+                 else time.perf_counter_ns())
+        sample = (self._start_allocation_sample()
+                  if self._request_body_future is None else None)
+        try:
+            yield
+        except web.HTTPError:
+            raise
+        except Exception:
+            self._logger.error('failed to decode request body')
+            raise web.HTTPError(400, 'failed to decode request')
+        finally:
+            if sample is not None:
+                self._stop_allocation_sample(sample, 'decode')
+        if start is not None:
+            self._record_timing('decode', start, '{} bytes'.format(
+                len(self.request.body)))
+
+    def _decode_request_body(self):
+        if self._lazy_request_body is not None:
+            return self._lazy_request_body.materialize()
+        if self._request_body_future is not None:
+            return self._request_body_future.result()
+        return self._get_request_transcoder().from_bytes(self.request.body)
+
+    def _cache_request_body(self, body):
+        self._request_body = self._validate_request_body(
+            body, self._get_request_schema())
+
+    def _check_request_body(self, schema):
+        if schema is not None and schema is not self._get_request_schema():
+            self._validate_request_body(self._request_body, schema)
         return self._request_body
 
-    def send_response(self, body, set_content_type=True):
+    def _get_request_transcoder(self):
+        settings = self._get_content_settings()
+        content_type = self._get_request_media_type(settings)
+        try:
+            return settings[content_type]
+        except KeyError:
+            raise web.HTTPError(415, 'cannot decode body of type %s',
+                                content_type)
+
+    def _get_request_media_type(self, settings):
+        return _parse_content_type(
+            self.request.headers.get('Content-Type',
+                                     settings.default_content_type)
+        ).media_type
+
+    def _get_request_schema(self):
+        settings = self._get_content_settings()
+        if not settings._snapshot.schemas:
+            return None
+        return settings.schema_for(self._get_request_media_type(settings))
+
+    def _validate_request_body(self, body, schema):
+        if schema is not None:
+            try:
+                schema.validate(body)
+            except schemas.ValidationError as error:
+                self._logger.error('request body is invalid: %s', error)
+                raise web.HTTPError(400, 'invalid request body: %s',
+                                    error) from error
+        return body
+
+    @contextlib.contextmanager
+    def _encoding_response(self, body):
+        settings = self._get_content_settings()
+        passthrough = self._get_passthrough(settings, body)
+        policy = None
+        if passthrough is not None:
+            encoding = _ResponseEncoding(lambda body: passthrough)
+        else:
+            response_type = self.get_response_content_type()
+            if isinstance(body, EncodedBody):
+                encoding = _ResponseEncoding(
+                    lambda body: settings.convert(
+                        b''.join(body), body.media_type, response_type),
+                    response_type)
+            else:
+                encoding = _ResponseEncoding(
+                    self._get_response_encoder(settings,
+                                               settings[response_type]),
+                    response_type)
+                policy = settings.encode_cost_policy
+        encode_start = (None if self._server_timing is None
+                        else time.perf_counter_ns())
+        sample = (self._start_allocation_sample() if passthrough is None
+                  else None)
+        start = None if policy is None else policy.clock()
+        try:
+            yield encoding
+            if policy is not None:
+                cost = policy.clock() - start
+        finally:
+            if sample is not None:
+                self._stop_allocation_sample(sample, 'encode',
+                                             encoding.response_type)
+        content_type, data_bytes = encoding.result
+        encoding.result = content_type, _as_body(data_bytes)
+        length = _body_length(encoding.result[1])
+        if policy is not None:
+            policy.record(_handler_name(self), encoding.response_type,
+                          cost, length)
+        if encode_start is not None:
+            self._record_timing('encode', encode_start,
+                                '{} bytes'.format(length))
+            self.set_header('Server-Timing',
+                            _format_server_timing(self._server_timing))
+
+    def _get_response_encoder(self, settings, handler):
+        return handler.to_bytes
+
+    def _set_response_headers(self, content_type, data_bytes,
+                              set_content_type):
+        if set_content_type:
+            self._set_content_type_headers(content_type)
+        if not isinstance(data_bytes, bytes):
+            self.set_header('Content-Length', _body_length(data_bytes))
+
+    def _get_passthrough(self, settings, body):
+        if not isinstance(body, EncodedBody):
+            return None
+        if self._best_response_match is None:
+            self._best_response_match = self._select_response_type(
+                body.media_type)
+        if self._best_response_match != body.media_type:
+            return None
+        if isinstance(body.data, bytes):
+            return body.content_type, body.data
+        return body.content_type, body
+
+    def _start_allocation_sample(self):
+        profiler = self._get_content_settings().allocation_profiler
+        if profiler is None or not profiler.sample():
+            return None
+        return profiler, profiler.start()
+
+    def _stop_allocation_sample(self, sample, operation, content_type=None):
+        profiler, baseline = sample
+        if content_type is None:
+            content_type = _parse_content_type(self.request.headers.get(
+                'Content-Type',
+                self._get_content_settings().default_content_type)
+            ).media_type
+        profiler.stop(baseline, _handler_name(self), content_type, operation)
+
+    def _record_timing(self, name, start, description=None):
+        self._server_timing[name] = (time.perf_counter_ns() - start,
+                                     description)
+
+    def _set_content_type_headers(self, content_type):
+        self.set_header('Content-Type', content_type)
+        self.add_header('Vary', 'Accept')
+
+
+class AsyncContentMixin(ContentMixin):
+    """
+    Mix this in to add coroutine content handling methods.
+
+    .. code-block:: python
+
+       class MyHandler(AsyncContentMixin, web.RequestHandler):
+          async def post(self):
+             body = await self.get_request_body()
+             # do stuff --> response_dict
+             await self.send_response(response_dict)
+
+    This is the same as :class:`.ContentMixin` except that
+    :meth:`get_request_body` and :meth:`send_response` are coroutines.
+    Transcoders that implement the optional ``async_from_bytes`` and
+    ``async_to_bytes`` coroutines described in :func:`.add_transcoder`
+    are awaited instead of calling their blocking methods.
+
+    When the request body is decoded by ``async_from_bytes`` or a
+    request decode executor is installed, decoding starts in
+    :meth:`prepare` and runs concurrently with whatever the handler
+    awaits before it calls :meth:`get_request_body`.  Failures are
+    reported when :meth:`get_request_body` is called so handlers that
+    do not look at the body are unaffected.  Sub-classes that implement
+    ``prepare`` MUST call ``await super().prepare()``.
+
+    """
+
+    async def prepare(self):
+        maybe_future = super().prepare()
+        if maybe_future is not None:
+            await maybe_future
+
+    def on_finish(self):
+        future = self._request_body_future
+        super().on_finish()
+        if future is not None and future.done() and not future.cancelled():
+            future.exception()  # the failure was reported or ignored
+
+    async def get_request_body(self, lazy=False, schema=None):
+        """
+        Fetch (and cache) the request body as a dictionary.
+
+        :param bool lazy: return a mapping that decodes each value when
+            it is accessed.  See :meth:`.ContentMixin.get_request_body`.
+        :param schema: validate the body against this schema.  See
+            :meth:`.ContentMixin.get_request_body`.
+        :raise web.HTTPError:
+            - if the content type cannot be matched, then the status code
+              is set to 415 Unsupported Media Type.
+            - if decoding the content body fails, then the status code is
+              set to 400 Bad Syntax.
+            - if the body does not match a schema, then the status code
+              is set to 400 Bad Syntax.
+
+        """
+        schema = _as_schema(schema)
+        if self._request_body is None:
+            body = self._get_lazy_request_body(schema) if lazy else None
+            if body is not None:
+                return body
+            with self._decoding_request_body():
+                body = await self._decode_request_body()
+            self._cache_request_body(body)
+        return self._check_request_body(schema)
+
+    async def send_response(self, body, set_content_type=True):
         """
         Serialize and send ``body`` in the response.
 
@@ -349,11 +2072,153 @@ class ContentMixin:
         :param bool set_content_type: should the :http:header:`Content-Type`
             header be set?  Defaults to :data:`True`
 
+        If the transcoder returns a sequence of buffers, then each buffer
+        is flushed as it is written and the flush is awaited before the
+        next buffer is written.  Bodies that are encoded into a buffer
+        from the :class:`.BufferPool` are written to the connection as
+        a view and the write is awaited before the buffer is reused.
+        :class:`.EncodedBody` instances are handled as well.  See
+        :meth:`.ContentMixin.send_response`.
+
         """
-        settings = get_settings(self.application, force_instance=True)
-        handler = settings[self.get_response_content_type()]
-        content_type, data_bytes = handler.to_bytes(body)
-        if set_content_type:
-            self.set_header('Content-Type', content_type)
-            self.add_header('Vary', 'Accept')
-        self.write(data_bytes)
+        with self._encoding_response(body) as encoding:
+            encoding.result = encoding.encode(body)
+            if inspect.isawaitable(encoding.result):
+                encoding.result = await encoding.result
+        content_type, data_bytes = encoding.result
+        self._set_response_headers(content_type, data_bytes, set_content_type)
+        if isinstance(data_bytes, bytes):
+            self.write(data_bytes)
+        elif isinstance(data_bytes, _PooledBody):
+            await self.flush()
+            await data_bytes.send(self.request.connection)
+        else:
+            for buffer in data_bytes:
+                self.write(_as_bytes(buffer))
+                await self.flush()
+
+    def _get_response_encoder(self, settings, handler):
+        async_to_bytes = getattr(handler, 'async_to_bytes', None)
+        if async_to_bytes is not None:
+            return async_to_bytes
+        # pooled bodies are written to the connection directly so they
+        # cannot be used when Tornado would transform or drop the body
+        pool = settings.buffer_pool
+        if (self._transforms or self._headers_written
+                or self.request.method == 'HEAD'):
+            pool = None
+        return functools.partial(_encode, pool, handler)
+
+    def _start_request_decode(self):
+        try:
+            transcoder = self._get_request_transcoder()
+        except web.HTTPError:  # reported by get_request_body
+            return None
+        if hasattr(transcoder, 'async_from_bytes'):
+            return asyncio.ensure_future(
+                transcoder.async_from_bytes(self.request.body))
+        settings = self._get_content_settings()
+        if settings.request_decode_executor is None:
+            return None
+        return asyncio.get_running_loop().run_in_executor(
+            settings.request_decode_executor, transcoder.from_bytes,
+            self.request.body)
+
+    async def _decode_request_body(self):
+        if self._lazy_request_body is not None:
+            return self._lazy_request_body.materialize()
+        if self._request_body_future is not None:
+            return await self._request_body_future
+        transcoder = self._get_request_transcoder()
+        async_from_bytes = getattr(transcoder, 'async_from_bytes', None)
+        if async_from_bytes is None:
+            return transcoder.from_bytes(self.request.body)
+        return await async_from_bytes(self.request.body)
+
+
+class WebSocketContentMixin(ContentMixin):
+    """
+    Mix this in to negotiate the message format of a WebSocket.
+
+    .. code-block:: python
+
+       class EventsHandler(WebSocketContentMixin,
+                           websocket.WebSocketHandler):
+
+          def open(self):
+             self.send_message({'connected': True})
+
+          def on_message(self, message):
+             self.send_message(self.decode_message(message))
+
+    The format is negotiated from the :http:header:`Accept` header of
+    the handshake request using the same logic and settings as the
+    :class:`.ContentMixin`.  The default content type is used when none
+    of the registered content types is acceptable and the handshake
+    fails with a *406 Not Acceptable* response if there is no default.
+    :meth:`get_response_content_type` returns the negotiated type for
+    the lifetime of the connection so it can be used to tag the
+    connection for :meth:`.ContentSettings.broadcast`.
+
+    Content types that have a ``charset`` parameter are sent as text
+    messages and the others are sent as binary messages.
+
+    """
+
+    def prepare(self):
+        maybe_future = super().prepare()
+        if self.get_response_content_type() is None:
+            raise web.HTTPError(406, 'no acceptable message format')
+        return maybe_future
+
+    def send_message(self, body):
+        """
+        Encode `body` in the negotiated format and send it.
+
+        :param body: the object to send
+        :returns: the :class:`~asyncio.Future` returned by
+            :meth:`~tornado.websocket.WebSocketHandler.write_message`
+
+        """
+        settings = self._get_content_settings()
+        content_type, data = settings[
+            self.get_response_content_type()].to_bytes(body)
+        return self.send_encoded_message(content_type, _join_buffers(data))
+
+    def send_encoded_message(self, content_type, data):
+        """
+        Send a message that is already encoded.
+
+        :param str content_type: the content type of `data` as returned
+            by the transcoder
+        :param bytes data: the encoded message
+        :returns: the :class:`~asyncio.Future` returned by
+            :meth:`~tornado.websocket.WebSocketHandler.write_message`
+
+        This sends the messages produced by
+        :meth:`.ContentSettings.broadcast`.
+
+        """
+        parameters = _parse_content_type(content_type).parameters
+        binary = not any(name == 'charset' for name, _ in parameters)
+        return self.write_message(data, binary=binary)
+
+    def decode_message(self, message):
+        """
+        Decode a message that was received in the negotiated format.
+
+        :param message: the message passed to ``on_message``
+        :returns: the decoded object
+        :raises ValueError: if the message cannot be decoded
+
+        """
+        settings = self._get_content_settings()
+        transcoder = settings[self.get_response_content_type()]
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        try:
+            return transcoder.from_bytes(message)
+        except ValueError:
+            raise
+        except Exception as error:
+            raise ValueError('failed to decode message') from error
@@ -0,0 +1,276 @@
+"""
+Direct conversion between bundled content types.
+
+- :func:`.msgpack_to_json` converts a msgpack document into JSON
+- :func:`.json_to_msgpack` converts a JSON document into msgpack
+- :class:`.MsgPackToJSON` and :class:`.JSONToMsgPack` wrap the
+  functions so that they can be registered with
+  :func:`sprockets.mixins.mediatype.content.add_converter`
+
+Converting a document by decoding it with one transcoder and encoding
+the result with another builds the entire object graph in between.
+The functions in this module avoid that.  The msgpack document is
+walked token by token and written out as JSON text.  The JSON document
+is scanned by the standard library's C scanner and each object is
+packed into msgpack as soon as it is complete so only the packed bytes
+are kept.  The output is identical to what the
+:class:`~sprockets.mixins.mediatype.transcoders.JSONTranscoder` (with
+its default options) and
+:class:`~sprockets.mixins.mediatype.transcoders.MsgPackTranscoder`
+produce from the decoded document.
+
+"""
+import json
+import struct
+
+from sprockets.mixins.mediatype._msgpack import FIXED_WIDTH, LENGTHS
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+_CONSTANTS = {0xc0: 'null', 0xc2: 'false', 0xc3: 'true'}
+
+
+def msgpack_to_json(data):
+    """
+    Convert a msgpack document into compact JSON.
+
+    :param bytes data: the msgpack document
+    :returns: the ASCII encoded JSON document as :class:`bytes`
+    :raises ValueError: if `data` is not a valid msgpack document,
+        contains extension types, or contains binary values that are
+        not UTF-8 encoded
+    :raises TypeError: if a map key cannot be represented in JSON
+
+    Binary values are decoded as UTF-8 text just as the
+    :meth:`~sprockets.mixins.mediatype.transcoders.JSONTranscoder.to_bytes`
+    method does.
+
+    """
+    data = bytes(data)
+    parts = []
+    try:
+        offset = _msgpack_to_json(data, 0, parts, False)
+    except (IndexError, struct.error):
+        raise ValueError('truncated msgpack document')
+    if offset != len(data):
+        raise ValueError('extra data after msgpack document')
+    return ''.join(parts).encode('ascii')
+
+
+def _msgpack_to_json(data, offset, parts, is_key):
+    code = data[offset]
+    offset += 1
+    if code <= 0x7f:
+        token = str(code)
+    elif code >= 0xe0:
+        token = str(code - 0x100)
+    elif code in _CONSTANTS:
+        token = _CONSTANTS[code]
+    elif code in FIXED_WIDTH:
+        unpacker = FIXED_WIDTH[code]
+        value = unpacker.unpack_from(data, offset)[0]
+        offset += unpacker.size
+        token = _float_token(value) if code <= 0xcb else str(value)
+    else:
+        if 0xa0 <= code <= 0xbf:
+            family, length = 'str', code & 0x1f
+        elif 0x90 <= code <= 0x9f:
+            family, length = 'array', code & 0x0f
+        elif 0x80 <= code <= 0x8f:
+            family, length = 'map', code & 0x0f
+        elif code in LENGTHS:
+            family = ('bin' if code <= 0xc6 else 'str' if code <= 0xdb
+                      else 'array' if code <= 0xdd else 'map')
+            length = LENGTHS[code].unpack_from(data, offset)[0]
+            offset += LENGTHS[code].size
+        else:
+            raise ValueError(
+                'cannot convert msgpack type 0x{:02x} to JSON'.format(code))
+
+        if family in ('str', 'bin'):
+            if offset + length > len(data):
+                raise ValueError('truncated msgpack document')
+            parts.append(_encode_string(
+                data[offset:offset + length].decode('utf-8')))
+            return offset + length
+        if is_key:
+            raise TypeError('msgpack {} keys cannot be converted to '
+                            'JSON'.format(family))
+        if family == 'array':
+            parts.append('[')
+            for index in range(length):
+                if index:
+                    parts.append(',')
+                offset = _msgpack_to_json(data, offset, parts, False)
+            parts.append(']')
+            return offset
+        parts.append('{')
+        for index in range(length):
+            if index:
+                parts.append(',')
+            offset = _msgpack_to_json(data, offset, parts, True)
+            parts.append(':')
+            offset = _msgpack_to_json(data, offset, parts, False)
+        parts.append('}')
+        return offset
+
+    parts.append('"{}"'.format(token) if is_key else token)
+    return offset
+
+
+def _float_token(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+class _Packed(bytes):
+    """A msgpack encoded value."""
+
+
+def json_to_msgpack(data, encoding='utf-8'):
+    """
+    Convert a JSON document into msgpack.
+
+    :param bytes data: the JSON document
+    :param str encoding: character set of `data`
+    :returns: the msgpack document as :class:`bytes`
+    :raises ValueError: if `data` is not a valid JSON document or
+        contains an integer that msgpack cannot represent
+
+    Unlike decoding, converting keeps every member of objects that
+    contain the same name more than once.
+
+    """
+    value = json.loads(data.decode(encoding),
+                       object_pairs_hook=_pack_object)
+    if isinstance(value, _Packed):
+        return bytes(value)
+    parts = []
+    _pack(value, parts)
+    return b''.join(parts)
+
+
+def _pack_object(pairs):
+    parts = [_container_header(len(pairs), 0x80, 0xde, 0xdf)]
+    for key, value in pairs:
+        _pack(key, parts)
+        _pack(value, parts)
+    return _Packed(b''.join(parts))
+
+
+def _pack(value, parts):
+    if isinstance(value, _Packed):
+        parts.append(value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        length = len(encoded)
+        if length < 32:
+            parts.append(bytes([0xa0 | length]))
+        elif length < 2 ** 8:
+            parts.append(struct.pack('>BB', 0xd9, length))
+        elif length < 2 ** 16:
+            parts.append(struct.pack('>BH', 0xda, length))
+        else:
+            parts.append(struct.pack('>BI', 0xdb, length))
+        parts.append(encoded)
+    elif value is None:
+        parts.append(b'\xc0')
+    elif value is True:
+        parts.append(b'\xc3')
+    elif value is False:
+        parts.append(b'\xc2')
+    elif isinstance(value, int):
+        parts.append(_pack_int(value))
+    elif isinstance(value, float):
+        parts.append(struct.pack('>Bd', 0xcb, value))
+    else:
+        parts.append(_container_header(len(value), 0x90, 0xdc, 0xdd))
+        for item in value:
+            _pack(item, parts)
+
+
+def _container_header(length, fixed, code16, code32):
+    if length < 16:
+        return bytes([fixed | length])
+    if length < 2 ** 16:
+        return struct.pack('>BH', code16, length)
+    return struct.pack('>BI', code32, length)
+
+
+_INT_FAMILIES = ((0xcc, 0, 2 ** 8), (0xcd, 0, 2 ** 16),
+                 (0xce, 0, 2 ** 32), (0xcf, 0, 2 ** 64),
+                 (0xd0, -2 ** 7, 0), (0xd1, -2 ** 15, 0),
+                 (0xd2, -2 ** 31, 0), (0xd3, -2 ** 63, 0))
+
+
+def _pack_int(value):
+    if -32 <= value < 128:
+        return struct.pack('b' if value < 0 else 'B', value)
+    for code, low, high in _INT_FAMILIES:
+        if low <= value < high:
+            return bytes([code]) + FIXED_WIDTH[code].pack(value)
+    raise ValueError('{} is too large for msgpack'.format(value))
+
+
+class MsgPackToJSON:
+    """
+    Convert msgpack request or response bodies into JSON.
+
+    :param str source_type: the msgpack content type
+    :param str target_type: the JSON content type
+    :param str encoding: the character set to advertise in the
+        content type.  The generated JSON is always ASCII so any
+        ASCII compatible character set is correct.
+
+    """
+
+    def __init__(self, source_type='application/msgpack',
+                 target_type='application/json', encoding='utf-8'):
+        self.source_type = source_type
+        self.target_type = target_type
+        self.encoding = encoding
+
+    def convert(self, data):
+        """
+        Convert `data` into JSON.
+
+        :param bytes data: the msgpack document
+        :returns: :class:`tuple` of the content type and the
+            :class:`bytes` representation of the JSON document
+
+        """
+        return ('{0}; charset="{1}"'.format(self.target_type, self.encoding),
+                msgpack_to_json(data))
+
+
+class JSONToMsgPack:
+    """
+    Convert JSON request or response bodies into msgpack.
+
+    :param str source_type: the JSON content type
+    :param str target_type: the msgpack content type
+    :param str encoding: the character set of the JSON documents
+
+    """
+
+    def __init__(self, source_type='application/json',
+                 target_type='application/msgpack', encoding='utf-8'):
+        self.source_type = source_type
+        self.target_type = target_type
+        self.encoding = encoding
+
+    def convert(self, data):
+        """
+        Convert `data` into msgpack.
+
+        :param bytes data: the JSON document
+        :returns: :class:`tuple` of the content type and the
+            :class:`bytes` representation of the msgpack document
+
+        """
+        return self.target_type, json_to_msgpack(data, self.encoding)
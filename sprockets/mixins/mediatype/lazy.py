@@ -0,0 +1,239 @@
+"""
+Lazily decoded request bodies.
+
+- :class:`.LazyDocument` is a read-only mapping that decodes each
+  value the first time that it is accessed
+- :func:`.json_members` reads the members of a JSON object
+- :func:`.msgpack_members` reads the entries of a msgpack map
+
+The members of a document are read in order and only as far as
+necessary to find the key that is looked up.  msgpack values are
+skipped without creating objects for them and unpacked when they are
+accessed.  JSON values are decoded by the C scanner in the standard
+library as they are read since skipping them in Python is slower than
+decoding them.
+
+"""
+import json
+import re
+import struct
+from collections import abc
+
+from sprockets.mixins.mediatype._msgpack import (EXT_LENGTHS, FIXED_EXT,
+                                                 FIXED_WIDTH, LENGTHS)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_MISSING = object()
+
+
+class LazyDocument(abc.Mapping):
+    """
+    Read-only mapping that decodes values on access.
+
+    :param members: iterator of ``(key, encoded)`` pairs in document
+        order
+    :param decode: callable that decodes an encoded value.  If this
+        is omitted, then the members are already decoded.
+
+    Members are read from `members` until the key that is looked up
+    is found so keys near the start of a document are found without
+    reading the rest of it.  Iterating over the document or asking for
+    its length reads every member.  Decoded values are cached so each
+    value is decoded at most once.
+
+    Errors in the document are raised as :exc:`ValueError` when the
+    member that contains them is read or decoded.  When a key appears
+    more than once, looking it up can return an earlier value until the
+    later one has been read.
+
+    """
+
+    def __init__(self, members, decode=None):
+        self._members = members
+        self._decode = decode
+        self._encoded = {}
+        self._values = {}
+        self._error = None
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            if key not in self._encoded and not self._read(key):
+                raise
+        value = self._encoded[key]
+        if self._decode is not None:
+            value = self._decode(value)
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        self._read()
+        return iter(self._encoded)
+
+    def __len__(self):
+        self._read()
+        return len(self._encoded)
+
+    def __contains__(self, key):
+        return key in self._encoded or self._read(key)
+
+    def __repr__(self):
+        return '<{} keys={!r}{}>'.format(
+            self.__class__.__name__, list(self._encoded),
+            '' if self._members is None else '...')
+
+    def materialize(self):
+        """Decode every value and return the document as a :class:`dict`."""
+        return {key: self[key] for key in self}
+
+    def _read(self, key=_MISSING):
+        """Read members until `key` is found or every member is read."""
+        if self._error is not None:
+            raise self._error
+        while self._members is not None:
+            try:
+                member, encoded = next(self._members)
+            except StopIteration:
+                self._members = None
+                break
+            except Exception as error:
+                self._members, self._error = None, error
+                raise
+            self._encoded[member] = encoded
+            self._values.pop(member, None)
+            if member == key:
+                return True
+        return False
+
+
+def json_members(text, decoder):
+    """
+    Read the members of the top-level JSON object in `text`.
+
+    :param str text: the JSON document
+    :param json.JSONDecoder decoder: decodes the member values
+    :returns: iterator of the decoded ``(name, value)`` pairs or
+        :data:`None` if the document is not an object
+
+    The iterator raises :exc:`json.JSONDecodeError` when it reaches
+    an error in the document.
+
+    """
+    pos = _WHITESPACE.match(text).end()
+    if not text.startswith('{', pos):
+        return None
+    return _json_members(text, pos + 1, decoder)
+
+
+def _json_members(text, pos, decoder):
+    pos = _WHITESPACE.match(text, pos).end()
+    if not text.startswith('}', pos):
+        while True:
+            if not text.startswith('"', pos):
+                raise json.JSONDecodeError(
+                    'Expecting property name enclosed in double quotes',
+                    text, pos)
+            name, pos = json.decoder.scanstring(text, pos + 1)
+            pos = _WHITESPACE.match(text, pos).end()
+            if not text.startswith(':', pos):
+                raise json.JSONDecodeError("Expecting ':' delimiter",
+                                           text, pos)
+            pos = _WHITESPACE.match(text, pos + 1).end()
+            value, pos = decoder.raw_decode(text, pos)
+            yield name, value
+            pos = _WHITESPACE.match(text, pos).end()
+            if text.startswith('}', pos):
+                break
+            if not text.startswith(',', pos):
+                raise json.JSONDecodeError("Expecting ',' delimiter",
+                                           text, pos)
+            pos = _WHITESPACE.match(text, pos + 1).end()
+
+    pos = _WHITESPACE.match(text, pos + 1).end()
+    if pos != len(text):
+        raise json.JSONDecodeError('Extra data', text, pos)
+
+
+def msgpack_members(data, unpack_key):
+    """
+    Read the entries of the top-level msgpack map in `data`.
+
+    :param bytes data: the msgpack document
+    :param unpack_key: callable that decodes the :class:`bytes` of a key
+    :returns: iterator of ``(key, (start, end))`` pairs where `start`
+        and `end` are the offsets of the encoded value in `data` or
+        :data:`None` if the document is not a map
+
+    The iterator raises :exc:`ValueError` when it reaches a truncated
+    value, an invalid type code, or a key that appeared before.
+    Duplicate keys are rejected because :func:`umsgpack.unpackb`
+    rejects them when it decodes the whole document so a body is
+    accepted or rejected the same way whether it is decoded lazily.
+
+    """
+    if not data:
+        return None
+    code = data[0]
+    if 0x80 <= code <= 0x8f:
+        return _msgpack_members(data, code & 0x0f, 1, unpack_key)
+    if code in (0xde, 0xdf):
+        length = LENGTHS[code]
+        if len(data) >= 1 + length.size:
+            return _msgpack_members(data, length.unpack_from(data, 1)[0],
+                                    1 + length.size, unpack_key)
+    return None
+
+
+def _msgpack_members(data, count, pos, unpack_key):
+    seen = set()
+    for _ in range(count):
+        key_end = _skip_msgpack_value(data, pos)
+        value_end = _skip_msgpack_value(data, key_end)
+        key = unpack_key(data[pos:key_end])
+        if key in seen:
+            raise ValueError('duplicate key {!r}'.format(key))
+        seen.add(key)
+        yield key, (key_end, value_end)
+        pos = value_end
+
+
+def _skip_msgpack_value(data, pos):
+    remaining = 1
+    try:
+        while remaining:
+            remaining -= 1
+            code = data[pos]
+            pos += 1
+            if code <= 0x7f or code >= 0xe0 or code in (0xc0, 0xc2, 0xc3):
+                continue
+            if 0xa0 <= code <= 0xbf:
+                pos += code & 0x1f
+            elif 0x90 <= code <= 0x9f:
+                remaining += code & 0x0f
+            elif 0x80 <= code <= 0x8f:
+                remaining += 2 * (code & 0x0f)
+            elif code in FIXED_WIDTH:
+                pos += FIXED_WIDTH[code].size
+            elif code in LENGTHS:
+                length = LENGTHS[code].unpack_from(data, pos)[0]
+                pos += LENGTHS[code].size
+                if code <= 0xdb:  # bin and str
+                    pos += length
+                elif code <= 0xdd:  # array
+                    remaining += length
+                else:  # map
+                    remaining += 2 * length
+            elif code in FIXED_EXT:
+                pos += 1 + FIXED_EXT[code]
+            elif code in EXT_LENGTHS:
+                length = EXT_LENGTHS[code].unpack_from(data, pos)[0]
+                pos += EXT_LENGTHS[code].size + 1 + length
+            else:
+                raise ValueError('invalid msgpack type 0x{:02x}'.format(code))
+    except (IndexError, struct.error):
+        raise ValueError('truncated msgpack document')
+    if pos > len(data):
+        raise ValueError('truncated msgpack document')
+    return pos
@@ -0,0 +1,218 @@
+"""
+Compact representations of decoded documents.
+
+- :func:`.compact` shares map keys and replaces lists of records
+- :class:`.Record` is a read-only mapping that stores its values in a
+  :class:`tuple`
+- :class:`.Columns` is a read-only sequence of records that stores
+  each field as a :class:`tuple`
+
+Bulk documents are often lists of objects that have the same keys.
+Decoding gives each of them a :class:`dict` of its own.  The records
+made by :func:`.compact` share a single index of the keys and only
+keep their values so they use a fraction of the memory.  Both record
+types are converted back into objects by the bundled transcoders.
+
+"""
+import operator
+from collections import abc
+
+ROWS = 'rows'
+"""Replace lists of records with lists of :class:`.Record` instances."""
+
+COLUMNS = 'columns'
+"""Replace lists of records with :class:`.Columns` instances."""
+
+
+class Record(abc.Mapping):
+    """
+    Read-only mapping that is backed by a :class:`tuple`.
+
+    :param dict index: maps each key to the position of its value.
+        It is shared by every record that has the same keys.
+    :param tuple values: the values in the order of `index`
+
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, dict(self))
+
+    def __reduce__(self):
+        return self.__class__, (self._index, self._values)
+
+
+class Columns(abc.Sequence):
+    """
+    Read-only sequence of records that is stored column by column.
+
+    :param tuple fields: the keys of every record
+    :param columns: one :class:`tuple` of values for each field
+
+    Indexing returns a :class:`.Record` that is built on demand.  Use
+    :meth:`.column` to work with all of the values of one field.
+
+    """
+    __slots__ = ('_index', '_columns', '_length')
+
+    def __init__(self, fields, columns):
+        self._index = {field: position
+                       for position, field in enumerate(fields)}
+        self._columns = tuple(columns)
+        self._length = len(self._columns[0]) if self._columns else 0
+
+    @property
+    def fields(self):
+        """The keys of every record as a :class:`tuple`."""
+        return tuple(self._index)
+
+    def column(self, field):
+        """
+        Get the values of `field` for every record.
+
+        :param field: the key of the field
+        :returns: :class:`tuple` of the values in record order
+        :raises KeyError: if `field` is not one of the :attr:`fields`
+
+        """
+        return self._columns[self._index[field]]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[index]
+                    for index in range(*position.indices(self._length))]
+        if position < 0:
+            position += self._length
+        if not 0 <= position < self._length:
+            raise IndexError('record index out of range')
+        return Record(self._index,
+                      tuple(column[position] for column in self._columns))
+
+    def __len__(self):
+        return self._length
+
+    def __eq__(self, other):
+        if not isinstance(other, abc.Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            mine == theirs for mine, theirs in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<{} fields={!r} length={}>'.format(
+            self.__class__.__name__, self.fields, self._length)
+
+    def __reduce__(self):
+        return self.__class__, (self.fields, self._columns)
+
+
+def compact(value, records=None, intern_keys=True):
+    """
+    Share the keys in a decoded document and replace lists of records.
+
+    :param value: the decoded document
+    :param str records: :data:`.ROWS` to replace lists of objects that
+        have the same keys with :class:`.Record` instances,
+        :data:`.COLUMNS` to replace them with a :class:`.Columns`
+        instance, or :data:`None` to keep them
+    :param bool intern_keys: make keys that are equal the same object
+        by rebuilding each :class:`dict`.  This is not needed for
+        documents decoded by :mod:`json` since its scanner already
+        shares the keys within a document.
+    :returns: the compacted document.  Lists and dicts are modified in
+        place unless keys are interned.
+    :raises ValueError: if `records` is not one of the listed values
+
+    A list is replaced when it has at least two items and all of them
+    are objects with the same non-empty set of keys.  The keys are
+    ordered as they are in the first object.  Keys are interned through
+    a table that lives as long as the call so records from different
+    documents do not share state.
+
+    """
+    if records not in (None, ROWS, COLUMNS):
+        raise ValueError('records must be {!r} or {!r}, not {!r}'.format(
+            ROWS, COLUMNS, records))
+    return _Compactor(records, intern_keys).compact(value)
+
+
+class _Compactor:
+
+    def __init__(self, records, intern_keys):
+        self.records = records
+        self.intern_keys = intern_keys
+        self.keys = {}
+        self.layouts = {}
+
+    def compact(self, value):
+        value_type = type(value)
+        if value_type is dict:
+            if self.intern_keys:
+                intern, compact = self.keys.setdefault, self.compact
+                return {intern(key, key): (compact(item)
+                                           if type(item) in (dict, list)
+                                           else item)
+                        for key, item in value.items()}
+            for key, item in value.items():
+                if type(item) in (dict, list):
+                    value[key] = self.compact(item)
+            return value
+
+        if value_type is list:
+            for position, item in enumerate(value):
+                if type(item) in (dict, list):
+                    value[position] = self.compact(item)
+            if self.records is not None and len(value) > 1:
+                return self._compact_records(value)
+        return value
+
+    def _compact_records(self, items):
+        first = items[0]
+        if type(first) is not dict or not first:
+            return items
+        keys = first.keys()
+        for item in items:
+            if type(item) is not dict or item.keys() != keys:
+                return items
+
+        fields = tuple(first)
+        try:
+            index, getter = self.layouts[fields]
+        except KeyError:
+            index = {field: position
+                     for position, field in enumerate(fields)}
+            getter = (operator.itemgetter(*fields) if len(fields) > 1
+                      else _single_getter(fields[0]))
+            self.layouts[fields] = index, getter
+
+        if self.records == ROWS:
+            # replace the items one at a time so that each dict is
+            # released as soon as its record exists
+            for position, item in enumerate(items):
+                items[position] = Record(index, getter(item))
+            return items
+        return Columns(fields, [tuple(map(operator.itemgetter(field), items))
+                                for field in fields])
+
+
+def _single_getter(field):
+    def getter(item):
+        return item[field],
+    return getter
@@ -0,0 +1,396 @@
+"""
+Validation of decoded documents.
+
+- :class:`.Schema` compiles a schema into a validator
+- :exc:`.ValidationError` describes the first violation in a document
+
+Schemas are written in a subset of `JSON Schema`_ that covers the
+structure of typical request bodies.  The following keywords are
+supported:
+
+- ``type`` as a name or a list of names from ``object``, ``array``,
+  ``string``, ``integer``, ``number``, ``boolean`` and ``null``
+- ``enum`` and ``const``
+- ``properties``, ``required`` and ``additionalProperties``
+- ``items``, ``minItems`` and ``maxItems``
+- ``minLength``, ``maxLength`` and ``pattern``
+- ``minimum``, ``maximum``, ``exclusiveMinimum`` and ``exclusiveMaximum``
+
+The annotations ``title``, ``description``, ``default``, ``examples``,
+``$schema``, ``$id`` and ``$comment`` are ignored and any other
+keyword is rejected when the schema is compiled so that a constraint
+is never silently skipped.
+
+.. _JSON Schema: https://json-schema.org/
+
+"""
+import decimal
+import operator
+import re
+from collections import abc
+
+_ANNOTATIONS = frozenset(['title', 'description', 'default', 'examples',
+                          '$schema', '$id', '$comment'])
+
+
+class ValidationError(ValueError):
+    """
+    A document does not match a schema.
+
+    :param str message: what is wrong with the value
+    :param tuple path: the keys and indexes that lead to the value
+
+    """
+
+    def __init__(self, message, path=()):
+        super().__init__(message, path)
+        self.message = message
+        self.path = path
+
+    @property
+    def pointer(self):
+        """The location of the value as a JSON pointer."""
+        return ''.join('/' + str(part).replace('~', '~0').replace('/', '~1')
+                       for part in self.path)
+
+    def __str__(self):
+        return '{}: {}'.format(self.pointer or '/', self.message)
+
+
+class Schema:
+    """
+    Validator that is compiled from a schema.
+
+    :param dict spec: the schema.  See the module documentation for
+        the supported keywords.
+    :raises ValueError: if `spec` uses an unsupported keyword or
+        has an invalid value for one
+
+    The schema is translated into a tree of functions once so
+    validating a document is a single walk that only looks at the
+    constraints that apply to each value.  Validation stops at the
+    first violation.
+
+    Objects are any :class:`~collections.abc.Mapping` and arrays are any
+    :class:`~collections.abc.Sequence` that is not a string so documents
+    that were decoded into :mod:`~sprockets.mixins.mediatype.records`
+    are validated as well.
+
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._validate = _compile(spec)
+
+    def validate(self, value):
+        """
+        Check that `value` matches the schema.
+
+        :param value: the decoded document
+        :returns: `value`
+        :raises ValidationError: for the first part of `value` that
+            does not match
+
+        """
+        self._validate(value)
+        return value
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.spec)
+
+
+def _is_object(value):
+    return type(value) is dict or isinstance(value, abc.Mapping)
+
+
+def _is_array(value):
+    return type(value) is list or (isinstance(value, abc.Sequence)
+                                   and not isinstance(value, (str, bytes)))
+
+
+def _is_number(value):
+    return type(value) in (int, float) or (
+        isinstance(value, (int, float, decimal.Decimal))
+        and not isinstance(value, bool))
+
+
+def _is_integer(value):
+    if type(value) is int:
+        return True
+    if not _is_number(value):
+        return False
+    try:
+        return value == int(value)
+    except (OverflowError, ValueError):  # infinity and NaN
+        return False
+
+
+_TYPES = {
+    'object': _is_object,
+    'array': _is_array,
+    'string': lambda value: isinstance(value, str),
+    'integer': _is_integer,
+    'number': _is_number,
+    'boolean': lambda value: value is True or value is False,
+    'null': lambda value: value is None,
+}
+
+
+# the types that the decoders produce for each type name.  They are
+# checked first so that the full tests only run for other types.
+_EXACT_TYPES = {
+    'object': {dict},
+    'array': {list},
+    'string': {str},
+    'integer': {int},
+    'number': {int, float},
+    'boolean': {bool},
+    'null': {type(None)},
+}
+
+
+def _type_name(value):
+    for name in ('null', 'boolean', 'integer', 'number', 'string',
+                 'object', 'array'):
+        if _TYPES[name](value):
+            return name
+    return type(value).__name__
+
+
+def _compile(spec):
+    if spec is True or spec == {}:
+        return _accept
+    if spec is False:
+        return _reject
+    if not isinstance(spec, abc.Mapping):
+        raise ValueError('schema must be a mapping or a boolean, '
+                         'not {!r}'.format(spec))
+    unknown = set(spec) - _ANNOTATIONS - _OBJECT_KEYWORDS - set(_KEYWORDS)
+    if unknown:
+        raise ValueError('unsupported schema keywords: {}'.format(
+            ', '.join(sorted(unknown))))
+
+    checks = [compile_keyword(spec)
+              for keyword, compile_keyword in _KEYWORDS.items()
+              if keyword in spec]
+    if not _OBJECT_KEYWORDS.isdisjoint(spec):
+        checks.append(_compile_properties(spec))
+    checks = [check for check in checks if check is not None]
+    if not checks:
+        return _accept
+    if len(checks) == 1:
+        return checks[0]
+    if 'type' not in spec:
+        def validate(value):
+            for check in checks:
+                check(value)
+        return validate
+
+    # most values have one of the exact types so the type check is
+    # inlined to save a call for each value
+    check_type, exact, checks = checks[0], checks[0].exact, checks[1:]
+    if len(checks) == 1:
+        check = checks[0]
+
+        def validate(value):
+            if type(value) not in exact:
+                check_type(value)
+            check(value)
+    else:
+        def validate(value):
+            if type(value) not in exact:
+                check_type(value)
+            for check in checks:
+                check(value)
+    return validate
+
+
+def _accept(value):
+    pass
+
+
+def _reject(value):
+    raise ValidationError('no value is allowed')
+
+
+def _compile_type(spec):
+    names = spec['type']
+    names = [names] if isinstance(names, str) else list(names)
+    unknown = [name for name in names if name not in _TYPES]
+    if unknown or not names:
+        raise ValueError('unsupported type {!r}'.format(spec['type']))
+    exact = frozenset().union(*(_EXACT_TYPES[name] for name in names))
+    tests = [_TYPES[name] for name in names]
+    expected = ' or '.join(names)
+
+    def validate(value):
+        if type(value) not in exact and not any(test(value)
+                                                for test in tests):
+            raise ValidationError('expected {}, got {}'.format(
+                expected, _type_name(value)))
+    validate.exact = exact
+    return validate
+
+
+def _equal(value, expected):
+    # True == 1 in Python but JSON booleans are not numbers, also when
+    # they are nested in arrays and objects
+    if isinstance(value, bool) or isinstance(expected, bool):
+        return value is expected
+    if _is_object(value) and _is_object(expected):
+        return len(value) == len(expected) and all(
+            name in value and _equal(value[name], item)
+            for name, item in expected.items())
+    if _is_array(value) and _is_array(expected):
+        return len(value) == len(expected) and all(
+            _equal(item, other) for item, other in zip(value, expected))
+    return value == expected
+
+
+def _compile_enum(spec):
+    allowed = list(spec['enum'])
+
+    def validate(value):
+        if not any(_equal(value, option) for option in allowed):
+            raise ValidationError('{!r} is not one of {!r}'.format(
+                value, allowed))
+    return validate
+
+
+def _compile_const(spec):
+    expected = spec['const']
+
+    def validate(value):
+        if not _equal(value, expected):
+            raise ValidationError('expected {!r}'.format(expected))
+    return validate
+
+
+def _compile_properties(spec):
+    properties = {name: _compile(subschema)
+                  for name, subschema in spec.get('properties', {}).items()}
+    required = tuple(spec.get('required', ()))
+    additional = spec.get('additionalProperties', True)
+    additional = None if additional is True else _compile(additional)
+    if not properties and not required and additional is None:
+        return None
+    exact_types = {name: check.exact for name, check in properties.items()
+                   if hasattr(check, 'exact')}
+
+    def validate(value):
+        if not _is_object(value):
+            return
+        for name in required:
+            if name not in value:
+                raise ValidationError(
+                    'missing required property {!r}'.format(name))
+        for name, item in value.items():
+            exact = exact_types.get(name)
+            if exact is not None and type(item) in exact:
+                continue
+            check = properties.get(name, additional)
+            if check is None:
+                continue
+            if check is _reject and name not in properties:
+                raise ValidationError('unexpected property', (name,))
+            try:
+                check(item)
+            except ValidationError as error:
+                error.path = (name,) + error.path
+                raise
+    return validate
+
+
+def _compile_items(spec):
+    check = _compile(spec['items'])
+    if check is _accept:
+        return None
+    exact = getattr(check, 'exact', frozenset())
+
+    def validate(value):
+        if not _is_array(value):
+            return
+        for index, item in enumerate(value):
+            if type(item) in exact:
+                continue
+            try:
+                check(item)
+            except ValidationError as error:
+                error.path = (index,) + error.path
+                raise
+    return validate
+
+
+def _compile_size(keyword, is_kind, noun, unit, limit_test, comparison):
+    def compile_size(spec):
+        limit = spec[keyword]
+        if not isinstance(limit, int) or limit < 0:
+            raise ValueError('{} must be a non-negative integer'.format(
+                keyword))
+
+        def validate(value):
+            if is_kind(value) and not limit_test(len(value), limit):
+                raise ValidationError('{} must have {} {} {}'.format(
+                    noun, comparison, limit, unit))
+        return validate
+    return compile_size
+
+
+def _compile_pattern(spec):
+    try:
+        search = re.compile(spec['pattern']).search
+    except re.error as error:
+        raise ValueError('invalid pattern {!r}: {}'.format(
+            spec['pattern'], error)) from error
+
+    def validate(value):
+        if isinstance(value, str) and search(value) is None:
+            raise ValidationError('{!r} does not match {!r}'.format(
+                value, spec['pattern']))
+    return validate
+
+
+def _compile_bound(keyword, limit_test, comparison):
+    def compile_bound(spec):
+        limit = spec[keyword]
+        if isinstance(limit, bool) or not _is_number(limit):
+            raise ValueError('{} must be a number'.format(keyword))
+
+        def validate(value):
+            if _is_number(value) and not limit_test(value, limit):
+                raise ValidationError('{!r} is not {} {!r}'.format(
+                    value, comparison, limit))
+        return validate
+    return compile_bound
+
+
+_at_least, _at_most = operator.ge, operator.le
+_above, _below = operator.gt, operator.lt
+
+
+_OBJECT_KEYWORDS = frozenset(['properties', 'required',
+                              'additionalProperties'])
+
+# keywords other than the object keywords in the order that they are
+# checked in.  The object keywords are checked last by one function.
+_KEYWORDS = {
+    'type': _compile_type,
+    'const': _compile_const,
+    'enum': _compile_enum,
+    'items': _compile_items,
+    'minItems': _compile_size('minItems', _is_array, 'array', 'items',
+                              _at_least, 'at least'),
+    'maxItems': _compile_size('maxItems', _is_array, 'array', 'items',
+                              _at_most, 'at most'),
+    'minLength': _compile_size('minLength', lambda value: isinstance(
+        value, str), 'string', 'characters', _at_least, 'at least'),
+    'maxLength': _compile_size('maxLength', lambda value: isinstance(
+        value, str), 'string', 'characters', _at_most, 'at most'),
+    'pattern': _compile_pattern,
+    'minimum': _compile_bound('minimum', _at_least, 'at least'),
+    'maximum': _compile_bound('maximum', _at_most, 'at most'),
+    'exclusiveMinimum': _compile_bound('exclusiveMinimum', _above,
+                                       'greater than'),
+    'exclusiveMaximum': _compile_bound('exclusiveMaximum', _below,
+                                       'less than'),
+}
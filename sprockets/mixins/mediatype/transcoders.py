@@ -3,20 +3,228 @@ Bundled media type transcoders.
 
 - :class:`.JSONTranscoder` implements JSON encoding/decoding
 - :class:`.MsgPackTranscoder` implements msgpack encoding/decoding
+- :class:`.TypeRegistry` converts types that the formats do not support
+- :func:`.register_type` adds a conversion to the shared registry
+
+Optional libraries are imported when the transcoder that needs them
+is created so that importing this module stays cheap.  NumPy arrays
+are supported when NumPy is installed but it is never imported just
+to check whether an object is an array.
 
 """
 import base64
+import binascii
+import dataclasses
+import decimal
+import enum
+import functools
+import ipaddress
 import json
+import operator
+import pathlib
+import re
+import struct
+import sys
+import threading
 import uuid
 
 import collections
 
-try:
-    import umsgpack
-except ImportError:
-    umsgpack = None
+from tornado import escape
+
+from sprockets.mixins.mediatype import handlers, lazy, records
+
+umsgpack = None
+
+
+class TypeRegistry:
+    """
+    Converts values that a serialization format does not support.
+
+    :param TypeRegistry parent: registry to copy the conversions from
+
+    A converter is a callable that is given the value and returns a
+    replacement that the format supports or that is converted in
+    turn.  The converter for a type is found by looking for the first
+    registered class in the type's method resolution order and falling
+    back to the following rules:
+
+    - :mod:`dataclasses` are converted to a :class:`dict` of their fields
+    - objects with an ``isoformat`` method are converted by calling it
+    - NumPy arrays and scalars are converted by their ``tolist`` and
+      ``item`` methods
+
+    The converter is resolved once for each type and cached until
+    :meth:`.register` is called.  Both bundled transcoders use the
+    :data:`.default_type_registry` unless they are given another one.
 
-from sprockets.mixins.mediatype import handlers
+    """
+
+    def __init__(self, parent=None):
+        self._converters = {} if parent is None else dict(parent._converters)
+        self._cache = {}
+
+    def register(self, cls, converter):
+        """
+        Convert instances of `cls` and its sub-classes using `converter`.
+
+        :param type cls: the class to convert
+        :param converter: callable that is given an instance of `cls`
+            and returns its replacement
+
+        """
+        self._converters[cls] = converter
+        self._cache = {}
+
+    def converter_for(self, cls):
+        """
+        Find the converter for instances of `cls`.
+
+        :param type cls: the class to find the converter for
+        :returns: the converter or :data:`None` if `cls` is not
+            supported
+
+        """
+        try:
+            return self._cache[cls]
+        except KeyError:
+            converter = self._cache[cls] = self._resolve(cls)
+            return converter
+
+    def convert(self, obj):
+        """
+        Convert `obj` using the registered converter for its type.
+
+        :raises TypeError: if the type of `obj` is not supported
+
+        """
+        converter = self.converter_for(type(obj))
+        if converter is None:
+            raise TypeError('{} is not supported'.format(
+                obj.__class__.__name__))
+        return converter(obj)
+
+    def _resolve(self, cls):
+        for base in cls.__mro__:
+            if base in self._converters:
+                return self._converters[base]
+        if dataclasses.is_dataclass(cls):
+            return _dataclass_fields
+        if hasattr(cls, 'isoformat'):
+            return operator.methodcaller('isoformat')
+        numpy = sys.modules.get('numpy')
+        if numpy is not None:
+            if issubclass(cls, numpy.ndarray):
+                return operator.methodcaller('tolist')
+            if issubclass(cls, numpy.generic):
+                return operator.methodcaller('item')
+        return None
+
+
+def _dataclass_fields(obj):
+    return {field.name: getattr(obj, field.name)
+            for field in dataclasses.fields(obj)}
+
+
+def _base64(obj):
+    return base64.b64encode(obj).decode('ASCII')
+
+
+def _base64_chunks(obj, chunk_size):
+    view = memoryview(obj).cast('B')
+    return [binascii.b2a_base64(view[start:start + chunk_size],
+                                newline=False)
+            for start in range(0, len(view), chunk_size)]
+
+
+def _decode_base64(value):
+    try:
+        return binascii.a2b_base64(value)
+    except binascii.Error as error:
+        raise ValueError('invalid Base64 value: {}'.format(error))
+
+
+def _decode_binary_fields(value, fields):
+    if type(value) is dict:
+        for key, item in value.items():
+            if key in fields and type(item) is str:
+                value[key] = _decode_base64(item)
+            elif type(item) in (dict, list):
+                _decode_binary_fields(item, fields)
+    elif type(value) is list:
+        for item in value:
+            if type(item) in (dict, list):
+                _decode_binary_fields(item, fields)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _ascii_compatible(encoding):
+    return '{"a":1}'.encode(encoding) == b'{"a":1}'
+
+
+default_type_registry = TypeRegistry()
+"""
+The :class:`.TypeRegistry` shared by the bundled transcoders.
+
+It converts the following types.  :class:`bytes` and similar values
+are only converted by formats that do not support binary data.
+
++--------------------------------------+-------------------------------+
+| Type                                 | Conversion                    |
++--------------------------------------+-------------------------------+
+| :class:`bytes`, :class:`bytearray`,  | Base64 encoded string         |
+| :class:`memoryview`                  |                               |
++--------------------------------------+-------------------------------+
+| :class:`datetime.date`,              | ``value.isoformat()``         |
+| :class:`datetime.time`,              |                               |
+| :class:`datetime.datetime`           |                               |
++--------------------------------------+-------------------------------+
+| :class:`decimal.Decimal`             | ``str(value)``                |
++--------------------------------------+-------------------------------+
+| :class:`enum.Enum`                   | ``value.value``               |
++--------------------------------------+-------------------------------+
+| :mod:`ipaddress` addresses, networks | ``str(value)``                |
+| and interfaces                       |                               |
++--------------------------------------+-------------------------------+
+| :class:`pathlib.PurePath`            | ``str(value)``                |
++--------------------------------------+-------------------------------+
+| :class:`uuid.UUID`                   | ``str(value)``                |
++--------------------------------------+-------------------------------+
+| :class:`~sprockets.mixins.mediatype. | ``dict(value)``               |
+| records.Record`                      |                               |
++--------------------------------------+-------------------------------+
+| :class:`~sprockets.mixins.mediatype. | ``list(value)``               |
+| records.Columns`                     |                               |
++--------------------------------------+-------------------------------+
+
+"""
+for _cls in (bytes, bytearray, memoryview):
+    default_type_registry.register(_cls, _base64)
+for _cls in (decimal.Decimal, ipaddress.IPv4Address, ipaddress.IPv6Address,
+             ipaddress.IPv4Network, ipaddress.IPv6Network, pathlib.PurePath,
+             uuid.UUID):
+    default_type_registry.register(_cls, str)
+default_type_registry.register(enum.Enum, operator.attrgetter('value'))
+default_type_registry.register(records.Record, dict)
+default_type_registry.register(records.Columns, list)
+del _cls
+
+
+def register_type(cls, converter):
+    """
+    Add a conversion to the :data:`.default_type_registry`.
+
+    :param type cls: the class to convert
+    :param converter: callable that is given an instance of `cls`
+        and returns its replacement
+
+    .. code-block:: python
+
+       register_type(Money, lambda money: [money.currency, money.cents])
+
+    """
+    default_type_registry.register(cls, converter)
 
 
 class JSONTranscoder(handlers.TextContentHandler):
@@ -29,6 +237,14 @@ class JSONTranscoder(handlers.TextContentHandler):
     :param str default_encoding: the encoding to use if none is specified.
         If omitted, this defaults to ``utf-8``. This is passed directly to
         the ``TextContentHandler`` initializer.
+    :param TypeRegistry type_registry: converts types that JSON does not
+        support.  If omitted, :data:`.default_type_registry` is used.
+    :param str records: replace lists of objects that have the same
+        keys when decoding.  See :attr:`records`.
+    :param int binary_stream_threshold: stream binary values of at
+        least this many bytes.  See :attr:`binary_stream_threshold`.
+    :param binary_fields: names of the members that are decoded into
+        :class:`bytes`.  See :attr:`binary_fields`.
 
     This JSON encoder uses :func:`json.loads` and :func:`json.dumps` to
     implement JSON encoding/decoding.  The :meth:`dump_object` method is
@@ -37,26 +253,116 @@ class JSONTranscoder(handlers.TextContentHandler):
 
     .. attribute:: dump_options
 
-       Keyword parameters that are passed to :func:`json.dumps` when
-       :meth:`.dumps` is called.  By default, the :meth:`dump_object`
-       method is enabled as the default object hook.
+       Keyword parameters that are passed to :class:`json.JSONEncoder`
+       when :meth:`.dumps` is called.  By default, the :meth:`dump_object`
+       method is enabled as the default object hook.  The ``cls`` keyword
+       selects the encoder class just as it does for :func:`json.dumps`.
 
     .. attribute:: load_options
 
-       Keyword parameters that are passed to :func:`json.loads` when
-       :meth:`.loads` is called.
+       Keyword parameters that are passed to :class:`json.JSONDecoder`
+       when :meth:`.loads` is called.  The ``cls`` keyword selects the
+       decoder class just as it does for :func:`json.loads`.
+
+    .. attribute:: records
+
+       How lists of objects that have the same keys are decoded.
+       :data:`~sprockets.mixins.mediatype.records.ROWS` decodes them
+       as :class:`~sprockets.mixins.mediatype.records.Record` instances
+       and :data:`~sprockets.mixins.mediatype.records.COLUMNS` decodes
+       them as a :class:`~sprockets.mixins.mediatype.records.Columns`
+       instance.  They are decoded as lists of :class:`dict` when this
+       is :data:`None` which is the default.  The keys of each
+       document are already shared by the :mod:`json` scanner.
+
+    .. attribute:: binary_stream_threshold
+
+       :class:`bytearray` and :class:`memoryview` values that are at
+       least this many bytes long are Base64 encoded straight into the
+       buffers returned by :meth:`.to_bytes` instead of into the JSON
+       string.  The result is a list of buffers that is written one at
+       a time and the values are encoded in chunks of
+       :attr:`BINARY_CHUNK_SIZE` bytes so large blobs are never copied
+       into a :class:`str`.  :class:`bytes` values are decoded as text
+       by :meth:`.to_bytes` so they are not affected.  Binary values are
+       never streamed when this is :data:`None` which is the default or
+       when the character set is not a superset of ASCII.
+
+    .. attribute:: binary_fields
+
+       Object members with one of these names that have a string value
+       are Base64 decoded into :class:`bytes` by :meth:`.loads` and
+       :meth:`.lazy_from_bytes` wherever they appear in the document.
+       Invalid Base64 is reported as a :exc:`ValueError`.  This is
+       empty by default.
+
+    The encoder and decoder instances are created from the options on
+    first use and reused until the options change.  Either attribute
+    can be replaced or modified in place at any time.
 
     """
 
+    BINARY_CHUNK_SIZE = 3 * 64 * 1024
+    """Number of bytes that are Base64 encoded into each buffer."""
+
     def __init__(self, content_type='application/json',
-                 default_encoding='utf-8'):
+                 default_encoding='utf-8', type_registry=None, records=None,
+                 binary_stream_threshold=None, binary_fields=()):
         super().__init__(content_type, self.dumps, self.loads,
                          default_encoding)
+        self.type_registry = (default_type_registry if type_registry is None
+                              else type_registry)
+        self.records = records
+        self.binary_stream_threshold = binary_stream_threshold
+        self.binary_fields = frozenset(binary_fields)
         self.dump_options = {
             'default': self.dump_object,
             'separators': (',', ':'),
         }
         self.load_options = {}
+        self._encoder = ({}, None)
+        self._decoder = ({}, None)
+        self._blobs = threading.local()
+        self._blob_marker = 'binary-{}-'.format(uuid.uuid4().hex)
+        self._blob_pattern = re.compile(self._blob_marker + r'(\d+)')
+
+    def to_bytes(self, inst_data, encoding=None):
+        """
+        Transform an object into :class:`bytes`.
+
+        :param object inst_data: object to encode
+        :param str encoding: character set used to encode the JSON
+            document.  This defaults to :attr:`default_encoding`
+        :returns: :class:`tuple` of the selected content type and the
+            :class:`bytes` representation of `inst_data`.  The
+            representation is a :class:`list` of buffers when binary
+            values are streamed.  See :attr:`binary_stream_threshold`.
+
+        """
+        selected = encoding or self.default_encoding
+        if (self.binary_stream_threshold is None
+                or not _ascii_compatible(selected)):
+            return super().to_bytes(inst_data, encoding)
+
+        content_type = '{0}; charset="{1}"'.format(self.content_type, selected)
+        blobs = self._blobs.values = []
+        try:
+            dumped = self.dumps(escape.recursive_unicode(inst_data))
+        finally:
+            self._blobs.values = None
+        if not blobs:
+            return content_type, dumped.encode(selected)
+
+        # the dumped document contains a marker in place of each blob
+        # so it is split into text and blob indexes in turn
+        buffers = []
+        for position, part in enumerate(self._blob_pattern.split(dumped)):
+            if position % 2 == 0:
+                buffers.append(part.encode(selected))
+            else:
+                buffers.extend(_base64_chunks(blobs[int(part)],
+                                              self.BINARY_CHUNK_SIZE))
+        return content_type, buffers
 
     def dumps(self, obj):
         """
@@ -66,7 +372,10 @@ class JSONTranscoder(handlers.TextContentHandler):
         :return: the JSON representation of :class:`object`
 
         """
-        return json.dumps(obj, **self.dump_options)
+        options, encoder = self._encoder
+        if encoder is None or options != self.dump_options:
+            encoder = self._build_encoder()
+        return encoder.encode(obj)
 
     def loads(self, str_repr):
         """
@@ -76,7 +385,86 @@ class JSONTranscoder(handlers.TextContentHandler):
         :return: the decoded :class:`object` representation
 
         """
-        return json.loads(str_repr, **self.load_options)
+        if not self.load_options:
+            value = json.loads(str_repr)
+        else:
+            decoder = self._get_decoder()
+            if isinstance(str_repr, str) and str_repr.startswith('\ufeff'):
+                raise json.JSONDecodeError(
+                    'Unexpected UTF-8 BOM (decode using utf-8-sig)',
+                    str_repr, 0)
+            value = decoder.decode(str_repr)
+        if self.binary_fields:
+            value = _decode_binary_fields(value, self.binary_fields)
+        if self.records is not None:
+            value = records.compact(value, self.records, intern_keys=False)
+        return value
+
+    def lazy_from_bytes(self, data, encoding=None):
+        """
+        Get a lazily decoded object from :class:`bytes`
+
+        :param bytes data: stream of bytes to decode
+        :param str encoding: character set used to decode the incoming
+            bytes.  This defaults to :attr:`default_encoding`
+        :returns: :class:`~sprockets.mixins.mediatype.lazy.LazyDocument`
+            if the document is an object.  Other documents are decoded
+            immediately.
+
+        The members of the object are decoded in order when a member
+        is looked up and decoding stops as soon as it is found.  The
+        top-level object is decoded immediately when :attr:`load_options`
+        include an ``object_hook`` or ``object_pairs_hook`` since the hook
+        expects every member.
+
+        """
+        text = data.decode(encoding or self.default_encoding)
+        if ('object_hook' in self.load_options
+                or 'object_pairs_hook' in self.load_options):
+            return self.loads(text)
+        members = lazy.json_members(text, self._get_decoder())
+        if members is None:
+            return self.loads(text)
+        if self.binary_fields:
+            members = self._decode_binary_members(members)
+        if self.records is None:
+            return lazy.LazyDocument(members)
+        return lazy.LazyDocument(
+            members, lambda value: records.compact(value, self.records,
+                                                   intern_keys=False))
+
+    def preload(self):
+        """Create the encoder and decoder instances ahead of time."""
+        self._build_encoder()
+        if self.load_options:
+            self._build_decoder()
+
+    def _decode_binary_members(self, members):
+        fields = self.binary_fields
+        for key, value in members:
+            if key in fields and type(value) is str:
+                value = _decode_base64(value)
+            yield key, _decode_binary_fields(value, fields)
+
+    def _build_encoder(self):
+        options = dict(self.dump_options)
+        kwargs = dict(options)
+        encoder = (kwargs.pop('cls', None) or json.JSONEncoder)(**kwargs)
+        self._encoder = options, encoder
+        return encoder
+
+    def _get_decoder(self):
+        options, decoder = self._decoder
+        if decoder is None or options != self.load_options:
+            decoder = self._build_decoder()
+        return decoder
+
+    def _build_decoder(self):
+        options = dict(self.load_options)
+        kwargs = dict(options)
+        decoder = (kwargs.pop('cls', None) or json.JSONDecoder)(**kwargs)
+        self._decoder = options, decoder
+        return decoder
 
     def dump_object(self, obj):
         """
@@ -87,32 +475,22 @@ class JSONTranscoder(handlers.TextContentHandler):
         :raises TypeError: when `obj` cannot be encoded
 
         This method is passed as the ``default`` keyword parameter
-        to :func:`json.dumps`.  It provides default representations for
-        a number of Python language/standard library types.
-
-        +----------------------------+---------------------------------------+
-        | Python Type                | String Format                         |
-        +----------------------------+---------------------------------------+
-        | :class:`bytes`,            | Base64 encoded string.                |
-        | :class:`bytearray`,        |                                       |
-        | :class:`memoryview`        |                                       |
-        +----------------------------+---------------------------------------+
-        | :class:`datetime.datetime` | ISO8601 formatted timestamp in the    |
-        |                            | extended format including separators, |
-        |                            | milliseconds, and the timezone        |
-        |                            | designator.                           |
-        +----------------------------+---------------------------------------+
-        | :class:`uuid.UUID`         | Same as ``str(value)``                |
-        +----------------------------+---------------------------------------+
-
-        """
-        if isinstance(obj, uuid.UUID):
-            return str(obj)
-        if hasattr(obj, 'isoformat'):
-            return obj.isoformat()
-        if isinstance(obj, (bytes, bytearray, memoryview)):
-            return base64.b64encode(obj).decode('ASCII')
-        raise TypeError('{!r} is not JSON serializable'.format(obj))
+        to :func:`json.dumps`.  It converts `obj` using the
+        :attr:`type_registry` which provides default representations
+        for a number of Python language/standard library types.  See
+        :data:`.default_type_registry` for the details.
+
+        """
+        converter = self.type_registry.converter_for(obj.__class__)
+        if converter is None:
+            raise TypeError('{!r} is not JSON serializable'.format(obj))
+        if converter is _base64:
+            blobs = getattr(self._blobs, 'values', None)
+            if (blobs is not None and memoryview(obj).nbytes
+                    >= self.binary_stream_threshold):
+                blobs.append(obj)
+                return '{}{}'.format(self._blob_marker, len(blobs) - 1)
+        return converter(obj)
 
 
 class MsgPackTranscoder(handlers.BinaryContentHandler):
@@ -122,30 +500,116 @@ class MsgPackTranscoder(handlers.BinaryContentHandler):
     :param str content_type: the content type that this encoder instance
         implements. If omitted, ``application/msgpack`` is used. This
         is passed directly to the ``BinaryContentHandler`` initializer.
+    :param TypeRegistry type_registry: converts types that msgpack does
+        not support.  If omitted, :data:`.default_type_registry` is used.
+    :param bool intern_keys: share map keys that are equal when
+        decoding.  See :attr:`intern_keys`.
+    :param str records: replace lists of maps that have the same keys
+        when decoding.  See :attr:`records`.
 
     This transcoder uses the `umsgpack`_ library to encode and decode
     objects according to the `msgpack format`_.
 
+    NumPy arrays of booleans and numbers are packed as an extension type
+    (:attr:`NDARRAY_EXT_TYPE`) that contains the array's data type,
+    shape, and raw C-ordered data.  Such values are unpacked into
+    read-only arrays that share memory with the extension payload when
+    NumPy is installed and are left as :class:`umsgpack.Ext` instances
+    otherwise.  The payload starts with the length of the data type
+    string, the data type string (e.g., ``<f8``), the number of
+    dimensions, and each dimension as a big-endian 64-bit integer.
+
+    .. attribute:: intern_keys
+
+       :mod:`umsgpack` creates a new object for every map key that it
+       unpacks.  When this is enabled, equal keys in a document are
+       replaced by the first one so that a list of maps keeps one
+       copy of each key.  This rebuilds every map so it costs some
+       decoding time.
+
+    .. attribute:: records
+
+       How lists of maps that have the same keys are decoded.  See
+       :attr:`JSONTranscoder.records`.  The keys of the records are
+       shared whether or not :attr:`intern_keys` is enabled.
+
     .. _umsgpack: https://github.com/vsergeev/u-msgpack-python
     .. _msgpack format: http://msgpack.org/index.html
 
     """
     PACKABLE_TYPES = (bool, int, float)
 
-    def __init__(self, content_type='application/msgpack'):
+    NDARRAY_EXT_TYPE = 78
+    """msgpack extension type that NumPy arrays are packed as."""
+
+    def __init__(self, content_type='application/msgpack',
+                 type_registry=None, intern_keys=False, records=None):
+        global umsgpack
         if umsgpack is None:
-            raise RuntimeError('Cannot import MsgPackTranscoder, '
-                               'umsgpack is not available')
+            try:
+                import umsgpack
+            except ImportError:
+                raise RuntimeError('Cannot import MsgPackTranscoder, '
+                                   'umsgpack is not available')
 
         super().__init__(content_type, self.packb, self.unpackb)
+        self.type_registry = (default_type_registry if type_registry is None
+                              else type_registry)
+        self.intern_keys = intern_keys
+        self.records = records
+        self._ext_handlers = {self.NDARRAY_EXT_TYPE: self._unpack_ndarray}
 
     def packb(self, data):
         """Pack `data` into a :class:`bytes` instance."""
         return umsgpack.packb(self.normalize_datum(data))
 
+    def to_buffer(self, inst_data, buffer, encoding=None):
+        """
+        Pack an object straight into a reusable buffer.
+
+        :param object inst_data: object to encode
+        :param io.BytesIO buffer: buffer to write the packed
+            representation of `inst_data` to at its current position
+        :param str encoding: ignored
+        :returns: :class:`tuple` of the content type and the number of
+            bytes that were written to `buffer`
+
+        """
+        start = buffer.tell()
+        umsgpack.pack(self.normalize_datum(inst_data), buffer)
+        return self.content_type, buffer.tell() - start
+
     def unpackb(self, data):
         """Unpack a :class:`object` from a :class:`bytes` instance."""
-        return umsgpack.unpackb(data)
+        value = umsgpack.unpackb(data, ext_handlers=self._ext_handlers)
+        if self.intern_keys or self.records is not None:
+            value = records.compact(value, self.records, self.intern_keys)
+        return value
+
+    def lazy_from_bytes(self, data, encoding=None):
+        """
+        Get a lazily decoded object from :class:`bytes`
+
+        :param bytes data: stream of bytes to decode
+        :param str encoding: ignored
+        :returns: :class:`~sprockets.mixins.mediatype.lazy.LazyDocument`
+            if the document is a map.  Other documents are decoded
+            immediately.
+
+        The entries of the map are read in order when a key is looked
+        up.  Values are skipped over and unpacked when they are accessed.
+
+        """
+        members = lazy.msgpack_members(data, self._unpack_key)
+        if members is None:
+            return self.unpackb(data)
+        return lazy.LazyDocument(
+            members, lambda span: self.unpackb(data[span[0]:span[1]]))
+
+    def _unpack_key(self, data):
+        # umsgpack only makes array and map values hashable when they
+        # are unpacked as keys so unpack a map of one entry
+        return next(iter(self.unpackb(b'\x81' + data + b'\xc0')))
 
     def normalize_datum(self, datum):
         """
@@ -186,7 +650,13 @@ class MsgPackTranscoder(handlers.BinaryContentHandler):
         +-----------------------------------+-------------------------------+
         | :class:`collections.abc.Mapping`  | `map family`_                 |
         +-----------------------------------+-------------------------------+
-        | :class:`uuid.UUID`                | Converted to String           |
+        | :class:`numpy.ndarray` of numbers | :attr:`NDARRAY_EXT_TYPE`      |
+        | or booleans                       | `ext family`_                 |
+        +-----------------------------------+-------------------------------+
+        | Other :class:`numpy.ndarray`      | `array family`_               |
+        +-----------------------------------+-------------------------------+
+        | Types known to                    | Converted and normalized      |
+        | :attr:`type_registry`             |                               |
         +-----------------------------------+-------------------------------+
 
         .. _nil byte: https://github.com/msgpack/msgpack/blob/
@@ -208,6 +678,8 @@ class MsgPackTranscoder(handlers.BinaryContentHandler):
            #mapping-format-family
         .. _bin family: https://github.com/msgpack/msgpack/blob/
            0b8f5ac67cdd130f4d4d4fe6afb839b989fdb86a/spec.md#bin-format-family
+        .. _ext family: https://github.com/msgpack/msgpack/blob/
+           0b8f5ac67cdd130f4d4d4fe6afb839b989fdb86a/spec.md#ext-format-family
 
         """
         if datum is None:
@@ -216,21 +688,23 @@ class MsgPackTranscoder(handlers.BinaryContentHandler):
         if isinstance(datum, self.PACKABLE_TYPES):
             return datum
 
-        if isinstance(datum, uuid.UUID):
-            datum = str(datum)
-
         if isinstance(datum, bytearray):
             datum = bytes(datum)
 
         if isinstance(datum, memoryview):
             datum = datum.tobytes()
 
-        if hasattr(datum, 'isoformat'):
-            datum = datum.isoformat()
-
         if isinstance(datum, (bytes, str)):
             return datum
 
+        numpy = sys.modules.get('numpy')
+        if numpy is not None and isinstance(datum, numpy.ndarray):
+            return self._pack_ndarray(numpy, datum)
+
+        converter = self.type_registry.converter_for(datum.__class__)
+        if converter is not None:
+            return self.normalize_datum(converter(datum))
+
         if isinstance(datum, (collections.abc.Sequence, collections.abc.Set)):
             return [self.normalize_datum(item) for item in datum]
 
@@ -242,3 +716,41 @@ class MsgPackTranscoder(handlers.BinaryContentHandler):
 
         raise TypeError(
             '{} is not msgpackable'.format(datum.__class__.__name__))
+
+    def _pack_ndarray(self, numpy, array):
+        if array.dtype.kind not in _NDARRAY_KINDS:
+            return self.normalize_datum(array.tolist())
+        dtype = array.dtype.str.encode('ascii')
+        header = b''.join([
+            struct.pack('>B', len(dtype)), dtype,
+            struct.pack('>B{}Q'.format(array.ndim), array.ndim, *array.shape),
+        ])
+        return umsgpack.Ext(self.NDARRAY_EXT_TYPE,
+                            header + numpy.ascontiguousarray(array).tobytes())
+
+    def _unpack_ndarray(self, ext):
+        try:
+            import numpy
+        except ImportError:
+            return ext
+        data = ext.data
+        try:
+            offset = 1 + data[0]
+            dtype = numpy.dtype(data[1:offset].decode('ascii'))
+            ndim = data[offset]
+            shape = struct.unpack_from('>{}Q'.format(ndim), data, offset + 1)
+        except (IndexError, struct.error, TypeError):
+            raise ValueError('invalid ndarray extension')
+        if dtype.kind not in _NDARRAY_KINDS:
+            raise ValueError('cannot unpack ndarray of {}'.format(dtype))
+        offset += 1 + 8 * ndim
+        count = functools.reduce(operator.mul, shape, 1)
+        if len(data) - offset != count * dtype.itemsize:
+            raise ValueError('ndarray extension has the wrong length')
+        if not count:
+            return numpy.empty(shape, dtype)
+        return numpy.frombuffer(data, dtype, count, offset).reshape(shape)
+
+
+_NDARRAY_KINDS = frozenset('biufc')
+"""NumPy data type kinds that are packed as raw data."""
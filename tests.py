@@ -1,17 +1,43 @@
+import asyncio
 import base64
+import copy
+import dataclasses
 import datetime
+import decimal
+import enum
+import functools
+import io
+import ipaddress
+import itertools
 import json
+import mmap
 import os
+import pathlib
 import pickle
 import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from unittest import mock
 import uuid
+from concurrent import futures
 
-from tornado import testing
+from ietfparse import algorithms, errors, headers
+from tornado import httpclient, testing, web, websocket
 import umsgpack
-
-from sprockets.mixins.mediatype import content, handlers, transcoders
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sprockets.mixins.mediatype import (content, converters, handlers,
+                                        lazy, records, schemas, transcoders)
+import benchmarks
 import examples
+import loadtest
 
 
 class UTC(datetime.tzinfo):
@@ -27,6 +53,17 @@ class UTC(datetime.tzinfo):
         return 'UTC'
 
 
+class FakeClock:
+    """Clock that advances by `step` nanoseconds every time it is read"""
+    def __init__(self, step=1):
+        self.now = 0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
 class Context:
     """Super simple class to call setattr on"""
     def __init__(self):
@@ -113,6 +150,1170 @@ class SendResponseTests(testing.AsyncHTTPTestCase):
         self.assertEqual(response.headers['Content-Type'], 'expected/content')
 
 
+class EncodeCostTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.clock = FakeClock()
+        self.policy = content.EncodeCostPolicy(exploration=0.0,
+                                               clock=self.clock)
+        application = examples.make_application(debug=True)
+        content.set_encode_cost_policy(application, self.policy)
+        return application
+
+    def post_json(self, accept):
+        return self.fetch('/', method='POST', body='{"key":"value"}',
+                          headers={'Accept': accept,
+                                   'Content-Type': 'application/json'})
+
+    def test_that_unmeasured_types_are_selected_first(self):
+        response = self.post_json('application/msgpack, application/json')
+        first = response.headers['Content-Type']
+        response = self.post_json('application/msgpack, application/json')
+        self.assertNotEqual(response.headers['Content-Type'], first)
+        self.assertEqual(
+            {content_type for _, content_type in self.policy.cost_table},
+            {'application/json', 'application/msgpack'})
+
+    def test_that_cheapest_type_is_selected(self):
+        name = 'examples.SimpleHandler'
+        self.policy.record(name, 'application/msgpack', 5000, 10)
+        self.policy.record(name, 'application/json', 1000, 10)
+        response = self.post_json('application/msgpack, application/json')
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json; charset="utf-8"')
+
+    def test_that_client_preference_is_obeyed(self):
+        name = 'examples.SimpleHandler'
+        self.policy.record(name, 'application/msgpack', 5000, 10)
+        self.policy.record(name, 'application/json', 1000, 10)
+        response = self.post_json('application/msgpack')
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/msgpack')
+
+    def test_that_encoding_time_is_recorded(self):
+        self.clock.step = 40
+        response = self.post_json('application/msgpack')
+        key = 'examples.SimpleHandler', 'application/msgpack'
+        self.assertEqual(self.policy.cost_table[key],
+                         (40 / len(response.body), len(response.body)))
+
+
+class ServerTimingTests(testing.AsyncHTTPTestCase):
+
+    server_timing = True
+
+    def get_app(self):
+        application = web.Application([('/', examples.SimpleHandler),
+                                       ('/async', AsyncHandler)],
+                                      events=[])
+        content.install(application, 'application/json', 'utf-8',
+                        server_timing=self.server_timing)
+        content.add_transcoder(application, transcoders.JSONTranscoder())
+        content.add_transcoder(application, transcoders.MsgPackTranscoder())
+        return application
+
+    def post(self, path='/', **headers):
+        headers.update({'Accept': 'application/msgpack',
+                        'Content-Type': 'application/json'})
+        return self.fetch(path, method='POST', body='{"a": [1, 2, 3]}',
+                          headers=headers)
+
+    def parse_header(self, response):
+        metrics = {}
+        for entry in response.headers['Server-Timing'].split(', '):
+            name, *parameters = entry.split(';')
+            metrics[name] = dict(parameter.split('=', 1)
+                                 for parameter in parameters)
+        return metrics
+
+    def test_that_stages_are_reported(self):
+        for path in ('/', '/async'):
+            response = self.post(path)
+            self.assertEqual(response.code, 200)
+            metrics = self.parse_header(response)
+            self.assertEqual(set(metrics), {'negotiate', 'decode', 'encode'})
+            for parameters in metrics.values():
+                self.assertGreaterEqual(float(parameters['dur']), 0.0)
+            self.assertEqual(metrics['decode']['desc'], '"16 bytes"')
+            self.assertEqual(metrics['encode']['desc'], '"{} bytes"'.format(
+                len(response.body)))
+
+    def test_that_header_is_omitted_without_send_response(self):
+        response = self.fetch('/', method='POST', body='{',
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 400)
+        self.assertNotIn('Server-Timing', response.headers)
+
+
+class ServerTimingDebugHeaderTests(ServerTimingTests):
+
+    server_timing = 'X-Debug-Timing'
+
+    def post(self, path='/', **headers):
+        headers['X-Debug-Timing'] = '1'
+        return super().post(path, **headers)
+
+    def test_that_header_is_only_added_when_requested(self):
+        response = super().post()
+        self.assertEqual(response.code, 200)
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_that_format_is_stable(self):
+        self.assertEqual(
+            content._format_server_timing({'negotiate': (1500, None),
+                                           'encode': (2000000, '3 bytes')}),
+            'negotiate;dur=0.002, encode;dur=2.000;desc="3 bytes"')
+
+
+class AllocationProfilerTests(unittest.TestCase):
+
+    def test_that_measurements_are_aggregated(self):
+        profiler = content.AllocationProfiler(sample_rate=1.0)
+        for size in (100000, 300000):
+            self.assertTrue(profiler.sample())
+            baseline = profiler.start()
+            retained = bytearray(size)
+            temporary = bytearray(size)
+            del temporary
+            profiler.stop(baseline, 'Handler', 'application/json', 'encode')
+            del retained
+        self.assertFalse(tracemalloc.is_tracing())
+        stats = profiler.allocation_table[
+            'Handler', 'application/json', 'encode']
+        self.assertEqual(stats['samples'], 2)
+        self.assertGreaterEqual(stats['allocated_bytes'], 200000)
+        self.assertLess(stats['allocated_bytes'], 210000)
+        self.assertGreaterEqual(stats['max_peak_bytes'], 600000)
+        self.assertGreaterEqual(stats['peak_bytes'], 400000)
+        profiler.reset()
+        self.assertEqual(profiler.allocation_table, {})
+
+    def test_that_nested_measurements_share_tracing(self):
+        profiler = content.AllocationProfiler(sample_rate=1.0)
+        outer = profiler.start()
+        inner = profiler.start()
+        profiler.stop(inner, 'Handler', 'application/json', 'decode')
+        self.assertTrue(tracemalloc.is_tracing())
+        profiler.stop(outer, 'Handler', 'application/json', 'encode')
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_that_existing_tracing_is_left_running(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        profiler = content.AllocationProfiler(sample_rate=1.0)
+        profiler.stop(profiler.start(), 'Handler', 'text/plain', 'decode')
+        self.assertTrue(tracemalloc.is_tracing())
+
+    def test_that_peak_is_measured_without_reset_peak(self):
+        # tracemalloc.reset_peak was added in Python 3.9
+        with mock.patch.object(content, '_reset_peak', None):
+            profiler = content.AllocationProfiler(sample_rate=1.0)
+            for size in (300000, 100000):
+                baseline = profiler.start()
+                temporary = bytearray(size)
+                del temporary
+                profiler.stop(baseline, 'Handler', 'text/plain', 'encode')
+        self.assertFalse(tracemalloc.is_tracing())
+        stats = profiler.allocation_table['Handler', 'text/plain', 'encode']
+        self.assertEqual(stats['samples'], 2)
+        self.assertGreaterEqual(stats['peak_bytes'], 200000)
+        self.assertLess(stats['peak_bytes'], 210000)
+
+    def test_that_sample_rate_is_honored(self):
+        profiler = content.AllocationProfiler(sample_rate=0.25, seed=1)
+        samples = sum(profiler.sample() for _ in range(4000))
+        self.assertAlmostEqual(samples / 4000, 0.25, delta=0.03)
+        self.assertFalse(any(content.AllocationProfiler(0.0).sample()
+                             for _ in range(100)))
+        with self.assertRaises(ValueError):
+            content.AllocationProfiler(sample_rate=1.5)
+
+
+class AllocationProfilerHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.profiler = content.AllocationProfiler(sample_rate=1.0)
+        application = examples.make_application(events=[])
+        application.add_handlers(r'.*', [('/async', AsyncHandler)])
+        content.set_allocation_profiler(application, self.profiler)
+        return application
+
+    def test_that_decode_and_encode_are_measured(self):
+        for path, name in (('/', 'examples.SimpleHandler'),
+                           ('/async', 'tests.AsyncHandler')):
+            response = self.fetch(
+                path, method='POST', body=json.dumps({'a': 'x' * 10000}),
+                headers={'Accept': 'application/msgpack',
+                         'Content-Type': 'application/json'})
+            self.assertEqual(response.code, 200)
+            table = self.profiler.allocation_table
+            decode = table[name, 'application/json', 'decode']
+            encode = table[name, 'application/msgpack', 'encode']
+            self.assertEqual(decode['samples'], 1)
+            self.assertGreaterEqual(decode['allocated_bytes'], 10000)
+            self.assertGreaterEqual(encode['max_peak_bytes'], 10000)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_that_failed_decodes_stop_tracing(self):
+        response = self.fetch('/', method='POST', body='{',
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 400)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIn(('examples.SimpleHandler', 'application/json',
+                       'decode'), self.profiler.allocation_table)
+
+
+class BufferPoolTests(unittest.TestCase):
+
+    def test_that_released_buffers_are_reused(self):
+        pool = content.BufferPool(buffer_size=16)
+        buffer = pool.acquire()
+        self.assertEqual(buffer.getvalue(), bytes(16))
+        buffer.write(b'abc')
+        pool.release(buffer)
+        self.assertIs(pool.acquire(), buffer)
+        self.assertEqual(buffer.tell(), 0)
+        self.assertEqual(pool.stats, {'hits': 1, 'misses': 1,
+                                      'oversize': 0, 'available': 0})
+
+    def test_that_pool_is_bounded(self):
+        pool = content.BufferPool(max_buffers=1, buffer_size=16,
+                                  max_buffer_size=32)
+        first, second, large = pool.acquire(), pool.acquire(), pool.acquire()
+        large.write(bytes(48))
+        pool.release(large)
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(pool.stats, {'hits': 0, 'misses': 3,
+                                      'oversize': 1, 'available': 1})
+        self.assertIs(pool.acquire(), first)
+
+    def test_that_buffers_with_views_are_discarded(self):
+        pool = content.BufferPool(buffer_size=16)
+        buffer = pool.acquire()
+        view = buffer.getbuffer()
+        pool.release(buffer)
+        view.release()
+        self.assertEqual(pool.stats['available'], 0)
+        self.assertIsNot(pool.acquire(), buffer)
+
+    def test_that_msgpack_packs_into_buffers(self):
+        buffer = io.BytesIO(b'x' * 4)
+        buffer.seek(2)
+        transcoder = transcoders.MsgPackTranscoder()
+        content_type, length = transcoder.to_buffer({'key': 'value'},
+                                                    buffer)
+        self.assertEqual(content_type, 'application/msgpack')
+        self.assertEqual(buffer.getvalue()[2:],
+                         umsgpack.packb({'key': 'value'}))
+        self.assertEqual(length, len(umsgpack.packb({'key': 'value'})))
+
+
+class PooledHandler(content.AsyncContentMixin, web.RequestHandler):
+
+    async def head(self):
+        await self.send_response({'key': 'value'})
+
+    async def post(self):
+        await self.send_response(await self.get_request_body())
+
+
+class BufferPoolHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.pool = content.BufferPool(max_buffers=2, buffer_size=128)
+        application = examples.make_application()
+        application.add_handlers(r'.*', [
+            ('/async', PooledHandler),
+            ('/buffers', AsyncBufferSequenceHandler)])
+        application.settings['flushes'] = 0
+        content.add_transcoder(application, BufferSequenceTranscoder())
+        content.set_buffer_pool(application, self.pool)
+        return application
+
+    def test_that_responses_are_encoded_into_pooled_buffers(self):
+        body = {'name': 'x' * 100000, 'values': list(range(50))}
+        for _ in range(2):
+            response = self.fetch(
+                '/async', method='POST', body=json.dumps(body),
+                headers={'Accept': 'application/msgpack',
+                         'Content-Type': 'application/json'})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(umsgpack.unpackb(response.body), body)
+        stats = self.pool.stats
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['available'], 1)
+
+    def test_that_transcoders_without_to_buffer_do_not_use_the_pool(self):
+        response = self.fetch(
+            '/async', method='POST', body='{"key":"value"}',
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {'key': 'value'})
+
+        response = self.fetch('/buffers', headers={
+            'Accept': 'application/vnd.buffers'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'first,second,third')
+        self.assertEqual(self.pool.stats['misses'], 0)
+
+    def test_that_to_buffer_can_return_buffer_sequences(self):
+        transcoder = content.get_settings(
+            self._app)['application/vnd.buffers']
+        with mock.patch.object(
+                transcoder, 'to_buffer', create=True,
+                new=lambda body, buffer: transcoder.to_bytes(body)):
+            response = self.fetch('/buffers', headers={
+                'Accept': 'application/vnd.buffers'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'first,second,third')
+        self.assertEqual(self.pool.stats, {'hits': 0, 'misses': 1,
+                                           'oversize': 0, 'available': 1})
+
+    def test_that_sync_handlers_do_not_use_the_pool(self):
+        response = self.fetch('/', method='POST', body='{"key":"value"}',
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {'key': 'value'})
+        self.assertEqual(self.pool.stats['misses'], 0)
+
+    def test_that_head_requests_do_not_use_the_pool(self):
+        response = self.fetch('/async', method='HEAD',
+                              headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/msgpack')
+        self.assertEqual(self.pool.stats['misses'], 0)
+
+
+class EncodeCostPolicyTests(unittest.TestCase):
+
+    def test_that_moving_averages_are_updated(self):
+        policy = content.EncodeCostPolicy(alpha=0.5)
+        policy.record('handler', 'application/json', 100, 10)
+        policy.record('handler', 'application/json', 300, 10)
+        self.assertEqual(policy.cost_table,
+                         {('handler', 'application/json'): (20.0, 10.0)})
+        self.assertEqual(policy.expected_cost('handler', 'application/json'),
+                         200.0)
+
+    def test_that_costs_are_tracked_per_handler(self):
+        policy = content.EncodeCostPolicy(exploration=0.0)
+        policy.record('one', 'application/json', 100, 10)
+        policy.record('one', 'application/msgpack', 10, 10)
+        policy.record('two', 'application/json', 10, 10)
+        policy.record('two', 'application/msgpack', 100, 10)
+        types = ['application/json', 'application/msgpack']
+        self.assertEqual(policy.select('one', types), 'application/msgpack')
+        self.assertEqual(policy.select('two', types), 'application/json')
+
+    def test_that_exploration_is_reproducible(self):
+        def selections(seed):
+            policy = content.EncodeCostPolicy(exploration=0.5, seed=seed)
+            policy.record('handler', 'a/a', 10, 10)
+            policy.record('handler', 'b/b', 100, 10)
+            return [policy.select('handler', ['a/a', 'b/b'])
+                    for _ in range(50)]
+
+        self.assertEqual(selections(42), selections(42))
+        self.assertIn('b/b', selections(42))
+
+    def test_that_default_clock_is_perf_counter_ns(self):
+        self.assertIs(content.EncodeCostPolicy().clock, time.perf_counter_ns)
+
+
+class AsyncJSONTranscoder(transcoders.JSONTranscoder):
+    """JSONTranscoder that implements the coroutine protocol"""
+    def __init__(self, content_type='application/vnd.async+json'):
+        super().__init__(content_type)
+        self.events = []
+
+    async def async_from_bytes(self, data, encoding=None):
+        self.events.append('decode started')
+        await asyncio.sleep(0)
+        self.events.append('decode finished')
+        return self.from_bytes(data, encoding)
+
+    async def async_to_bytes(self, inst_data, encoding=None):
+        self.events.append('encode')
+        return self.to_bytes(inst_data, encoding)
+
+
+class AsyncHandler(content.AsyncContentMixin, web.RequestHandler):
+
+    async def post(self):
+        events = self.settings['events']
+        events.append('handler started')
+        await asyncio.sleep(0)
+        events.append('handler resumed')
+        body = await self.get_request_body()
+        events.append('body retrieved')
+        await self.send_response(body)
+
+
+class AsyncContentMixinTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.transcoder = AsyncJSONTranscoder()
+        application = examples.make_application(
+            debug=True, events=self.transcoder.events)
+        application.add_handlers(r'.*', [('/async', AsyncHandler)])
+        content.add_transcoder(application, self.transcoder)
+        return application
+
+    def test_that_sync_transcoders_are_used(self):
+        response = self.fetch('/async', method='POST',
+                              body=umsgpack.packb({'key': 'value'}),
+                              headers={'Accept': 'application/msgpack',
+                                       'Content-Type': 'application/msgpack'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/msgpack')
+        self.assertEqual(umsgpack.unpackb(response.body), {'key': 'value'})
+        self.assertEqual(self.transcoder.events,
+                         ['handler started', 'handler resumed',
+                          'body retrieved'])
+
+    def test_that_async_decode_starts_in_prepare(self):
+        response = self.fetch(
+            '/async', method='POST', body='{"key":"value"}',
+            headers={'Accept': 'application/vnd.async+json',
+                     'Content-Type': 'application/vnd.async+json'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body.decode()), {'key': 'value'})
+        self.assertEqual(self.transcoder.events,
+                         ['handler started', 'decode started',
+                          'handler resumed', 'decode finished',
+                          'body retrieved', 'encode'])
+
+    def test_that_async_decode_failure_returns_400(self):
+        response = self.fetch(
+            '/async', method='POST', body='not json',
+            headers={'Content-Type': 'application/vnd.async+json'})
+        self.assertEqual(response.code, 400)
+
+    def test_that_unhandled_type_returns_415(self):
+        response = self.fetch('/async', method='POST', body='<xml/>',
+                              headers={'Content-Type': 'application/xml'})
+        self.assertEqual(response.code, 415)
+
+
+class ThreadRecordingTranscoder(transcoders.JSONTranscoder):
+    """JSONTranscoder that records the thread that decodes"""
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def from_bytes(self, data, encoding=None):
+        self.threads.append(threading.current_thread())
+        return super().from_bytes(data, encoding)
+
+
+class EagerHandler(content.ContentMixin, web.RequestHandler):
+
+    async def post(self):
+        await asyncio.sleep(0.01)
+        self.settings['decoded_before_access'] = bool(
+            self.settings['transcoder'].threads)
+        body = self.get_request_body()
+        self.settings['body_cached'] = self.get_request_body() is body
+        self.send_response(body)
+
+
+class AsyncEagerHandler(content.AsyncContentMixin, web.RequestHandler):
+
+    async def post(self):
+        await asyncio.sleep(0.01)
+        self.settings['decoded_before_access'] = bool(
+            self.settings['transcoder'].threads)
+        await self.send_response(await self.get_request_body())
+
+
+class RequestDecodeExecutorTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.executor = futures.ThreadPoolExecutor(1)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+
+    def get_app(self):
+        self.transcoder = ThreadRecordingTranscoder()
+        application = web.Application(
+            [('/', EagerHandler), ('/async', AsyncEagerHandler)],
+            transcoder=self.transcoder)
+        content.install(application, 'application/json', 'utf-8')
+        content.add_transcoder(application, self.transcoder)
+        content.set_request_decode_executor(application, self.executor)
+        return application
+
+    def post(self, path, body):
+        return self.fetch(path, method='POST', body=body,
+                          headers={'Content-Type': 'application/json'})
+
+    def test_that_body_is_decoded_in_prepare(self):
+        for path in ('/', '/async'):
+            self.transcoder.threads.clear()
+            response = self.post(path, '{"key":"value"}')
+            self.assertEqual(response.code, 200)
+            self.assertEqual(json.loads(response.body.decode()),
+                             {'key': 'value'})
+            self.assertTrue(self._app.settings['decoded_before_access'])
+            self.assertEqual(len(self.transcoder.threads), 1)
+            self.assertIsNot(self.transcoder.threads[0],
+                             threading.current_thread())
+
+    def test_that_decoded_body_is_cached(self):
+        self.post('/', '{"key":"value"}')
+        self.assertTrue(self._app.settings['body_cached'])
+
+    def test_that_body_is_decoded_lazily_without_executor(self):
+        content.set_request_decode_executor(self._app, None)
+        for path in ('/', '/async'):
+            self.transcoder.threads.clear()
+            response = self.post(path, '{"key":"value"}')
+            self.assertEqual(response.code, 200)
+            self.assertFalse(self._app.settings['decoded_before_access'])
+            self.assertEqual(self.transcoder.threads,
+                             [threading.current_thread()])
+
+    def test_that_decode_failures_return_400(self):
+        for path in ('/', '/async'):
+            self.assertEqual(self.post(path, 'not json').code, 400)
+
+
+class BufferSequenceTranscoder(handlers.BinaryContentHandler):
+    """Transcoder that returns the response as several buffers"""
+    def __init__(self):
+        super().__init__('application/vnd.buffers', self.pack, bytes)
+
+    @staticmethod
+    def pack(data):
+        return [b'first,', bytearray(b'second,'), memoryview(b'third')]
+
+
+class FlushCountingMixin:
+
+    def flush(self, *args, **kwargs):
+        self.settings['flushes'] += 1
+        return super().flush(*args, **kwargs)
+
+
+class BufferSequenceHandler(FlushCountingMixin, content.ContentMixin,
+                            web.RequestHandler):
+
+    def get(self):
+        self.send_response({})
+
+    head = get
+
+
+class AsyncBufferSequenceHandler(FlushCountingMixin,
+                                 content.AsyncContentMixin,
+                                 web.RequestHandler):
+
+    async def get(self):
+        await self.send_response({})
+
+
+class BufferSequenceTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        application = web.Application(
+            [('/', BufferSequenceHandler),
+             ('/async', AsyncBufferSequenceHandler)], flushes=0)
+        content.install(application, 'application/vnd.buffers')
+        content.add_transcoder(application, BufferSequenceTranscoder())
+        for media_type, data in (('bytearray', bytearray(b'body')),
+                                 ('memoryview', memoryview(b'body')),
+                                 ('text', 'body')):
+            content.add_transcoder(application, handlers.BinaryContentHandler(
+                'application/vnd.' + media_type,
+                functools.partial(lambda data, _: data, data), bytes))
+        return application
+
+    def test_that_single_buffers_are_written_once(self):
+        for media_type in ('bytearray', 'memoryview', 'text'):
+            for path in ('/', '/async'):
+                with self.subTest(media_type=media_type, path=path):
+                    self._app.settings['flushes'] = 0
+                    response = self.fetch(path, headers={
+                        'Accept': 'application/vnd.' + media_type})
+                    self.assertEqual(response.code, 200)
+                    self.assertEqual(response.body, b'body')
+                    self.assertEqual(self._app.settings['flushes'], 1)
+
+    def test_that_each_buffer_is_flushed(self):
+        for path in ('/', '/async'):
+            self._app.settings['flushes'] = 0
+            response = self.fetch(path)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, b'first,second,third')
+            self.assertEqual(response.headers['Content-Length'], '18')
+            self.assertEqual(response.headers['Content-Type'],
+                             'application/vnd.buffers')
+            self.assertGreaterEqual(self._app.settings['flushes'], 3)
+
+    def test_that_head_requests_are_supported(self):
+        response = self.fetch('/', method='HEAD')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'')
+
+
+class EncodedBodyHandler(content.ContentMixin, web.RequestHandler):
+
+    def get(self):
+        self.send_response(self.settings['encoded_body'])
+
+
+class AsyncEncodedBodyHandler(content.AsyncContentMixin, web.RequestHandler):
+
+    async def get(self):
+        await self.send_response(self.settings['encoded_body'])
+
+
+class EncodedBodyTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.document = {'items': list(range(100)), 'name': 'value'}
+        self.encoded = json.dumps(self.document).encode('utf-8')
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'document.json')
+        with open(self.path, 'wb') as f:
+            f.write(self.encoded)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tempdir.cleanup()
+
+    def get_app(self):
+        application = examples.make_application()
+        application.add_handlers(r'.*', [('/', EncodedBodyHandler),
+                                         ('/async', AsyncEncodedBodyHandler)])
+        return application
+
+    def send(self, data, accept, path='/', **kwargs):
+        self._app.settings['encoded_body'] = content.EncodedBody(
+            data, 'application/json; charset=utf-8', **kwargs)
+        return self.fetch(path, headers={'Accept': accept})
+
+    def test_that_matching_body_is_sent_as_is(self):
+        settings = content.get_settings(self._app)
+        with mock.patch.object(settings['application/json'],
+                               'to_bytes') as to_bytes:
+            for path in ('/', '/async'):
+                for data in (self.encoded, bytearray(self.encoded),
+                             self.path, pathlib.Path(self.path)):
+                    response = self.send(data, 'application/json', path,
+                                         chunk_size=100)
+                    self.assertEqual(response.code, 200)
+                    self.assertEqual(response.body, self.encoded)
+                    self.assertEqual(response.headers['Content-Type'],
+                                     'application/json; charset=utf-8')
+                    self.assertEqual(response.headers['Vary'], 'Accept')
+            to_bytes.assert_not_called()
+
+    def test_that_memory_maps_are_sent_as_is(self):
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                response = self.send(data, 'application/*', chunk_size=64)
+        self.assertEqual(response.body, self.encoded)
+        self.assertEqual(response.headers['Content-Length'],
+                         str(len(self.encoded)))
+
+    def test_that_body_is_preferred_over_equal_alternatives(self):
+        response = self.send(self.path,
+                             'application/msgpack, application/json')
+        self.assertEqual(response.body, self.encoded)
+
+    def test_that_body_is_reencoded_when_necessary(self):
+        for path in ('/', '/async'):
+            response = self.send(self.path, 'application/msgpack', path)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.headers['Content-Type'],
+                             'application/msgpack')
+            self.assertEqual(umsgpack.unpackb(response.body), self.document)
+
+    def test_that_empty_file_is_sent(self):
+        open(self.path, 'wb').close()
+        response = self.send(self.path, 'application/json')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'')
+
+
+class ConverterTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.json = transcoders.JSONTranscoder()
+        self.msgpack = transcoders.MsgPackTranscoder()
+        self.document = {
+            'null': None, 'flags': [True, False], 'small': [0, 127, -32],
+            'ints': [128, -33, 2 ** 16, -2 ** 31 - 1, 2 ** 64 - 1],
+            'floats': [0.1, -1.5e300], 'text': 'caf\u00e9 \U0001f600',
+            'long': 'x' * 70000, 'list': list(range(20)),
+            'nested': {str(index): {'v': [{}]} for index in range(17)},
+        }
+
+    def test_that_msgpack_to_json_matches_transcoders(self):
+        for document in (self.document, [], 'text', 1, None,
+                         {b'key': 'caf\u00e9'.encode('utf-8') * 200}):
+            with self.subTest(document=document):
+                _, packed = self.msgpack.to_bytes(document)
+                _, expected = self.json.to_bytes(
+                    self.msgpack.from_bytes(packed))
+                self.assertEqual(converters.msgpack_to_json(packed),
+                                 expected)
+
+    def test_that_msgpack_keys_are_quoted_like_json(self):
+        packed = umsgpack.packb({1: 'a', None: 'b', 1.5: 'c'})
+        self.assertEqual(json.loads(converters.msgpack_to_json(packed)),
+                         {'1': 'a', 'null': 'b', '1.5': 'c'})
+
+    def test_that_json_to_msgpack_matches_transcoders(self):
+        for document in (self.document, [], 'text', 1, None):
+            with self.subTest(document=document):
+                _, encoded = self.json.to_bytes(document)
+                _, expected = self.msgpack.to_bytes(
+                    self.json.from_bytes(encoded))
+                self.assertEqual(converters.json_to_msgpack(encoded),
+                                 expected)
+
+    def test_that_invalid_msgpack_is_rejected(self):
+        _, packed = self.msgpack.to_bytes(self.document)
+        for data in (packed[:-1], packed + b'\xc0', b'\xd4\x01\x00',
+                     umsgpack.packb(b'\xff')):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    converters.msgpack_to_json(data)
+        with self.assertRaises(TypeError):
+            converters.msgpack_to_json(umsgpack.packb({(1, 2): 3}))
+
+    def test_that_invalid_json_is_rejected(self):
+        for data in (b'{"a":', json.dumps(2 ** 64).encode('ascii')):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    converters.json_to_msgpack(data)
+
+    def test_that_settings_use_registered_converter(self):
+        settings = content.ContentSettings()
+        settings['application/json'] = self.json
+        settings['application/msgpack'] = self.msgpack
+        _, packed = self.msgpack.to_bytes(self.document)
+        expected = self.json.to_bytes(self.document)
+        self.assertEqual(settings.convert(packed, 'application/msgpack',
+                                          'application/json'), expected)
+
+        settings.add_converter(converters.MsgPackToJSON())
+        with mock.patch.object(self.msgpack, 'from_bytes') as from_bytes:
+            self.assertEqual(
+                settings.convert(packed, 'application/msgpack',
+                                 'application/json; charset=utf-8'),
+                expected)
+        from_bytes.assert_not_called()
+
+
+class ConvertingHandler(content.ContentMixin, web.RequestHandler):
+
+    def post(self, target_type):
+        content_type, body = self.get_request_body_as(
+            target_type.replace('-', '/'))
+        self.set_header('Content-Type', content_type)
+        self.write(body)
+
+
+class ConversionTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        application = examples.make_application()
+        content.add_converter(application, converters.MsgPackToJSON())
+        content.add_converter(application, converters.JSONToMsgPack())
+        application.add_handlers(r'.*', [('/encoded', EncodedBodyHandler),
+                                         ('/(.*)', ConvertingHandler)])
+        return application
+
+    def test_that_request_body_is_converted(self):
+        document = {'name': 'value', 'items': [1, 2.5, None]}
+        response = self.fetch('/application-json', method='POST',
+                              body=umsgpack.packb(document),
+                              headers={'Content-Type': 'application/msgpack'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json; charset="utf-8"')
+        self.assertEqual(json.loads(response.body), document)
+
+        response = self.fetch('/application-msgpack', method='POST',
+                              body=response.body,
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(umsgpack.unpackb(response.body), document)
+
+    def test_that_matching_request_body_is_returned_unchanged(self):
+        response = self.fetch('/application-json', method='POST',
+                              body=b'{ "spaced" : 1 }',
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.body, b'{ "spaced" : 1 }')
+
+    def test_that_conversion_failures_are_reported(self):
+        response = self.fetch('/application-json', method='POST',
+                              body=b'\xc1',
+                              headers={'Content-Type': 'application/msgpack'})
+        self.assertEqual(response.code, 400)
+        response = self.fetch('/application-json', method='POST',
+                              body=b'<xml/>',
+                              headers={'Content-Type': 'application/xml'})
+        self.assertEqual(response.code, 415)
+
+    def test_that_encoded_body_uses_converter(self):
+        document = {'items': list(range(10))}
+        self._app.settings['encoded_body'] = content.EncodedBody(
+            umsgpack.packb(document), 'application/msgpack')
+        with mock.patch.object(converters, 'msgpack_to_json',
+                               wraps=converters.msgpack_to_json) as convert:
+            response = self.fetch('/encoded',
+                                  headers={'Accept': 'application/json'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), document)
+        convert.assert_called_once()
+
+
+class BroadcastTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.json = transcoders.JSONTranscoder()
+        self.msgpack = transcoders.MsgPackTranscoder()
+        self.settings = content.ContentSettings()
+        self.settings['application/json'] = self.json
+        self.settings['application/msgpack'] = self.msgpack
+
+    def test_that_body_is_encoded_once_per_content_type(self):
+        recipients = [(index, content_type) for index, content_type in
+                      enumerate(['application/json', 'application/msgpack',
+                                 'application/json; charset=utf-8'] * 2)]
+        with mock.patch.object(self.json, 'to_bytes',
+                               wraps=self.json.to_bytes) as to_bytes:
+            sent = list(self.settings.broadcast({'event': 1}, recipients))
+        to_bytes.assert_called_once_with({'event': 1})
+        self.assertEqual([recipient for recipient, _, _ in sent],
+                         list(range(6)))
+        self.assertEqual(sent[1][1:], self.msgpack.to_bytes({'event': 1}))
+        for recipient, content_type, data in sent:
+            expected = sent[1] if recipient % 3 == 1 else sent[0]
+            self.assertIs(data, expected[2])
+
+    def test_that_frame_is_applied_once_per_content_type(self):
+        frame = mock.Mock(side_effect=content.format_sse_event)
+        sent = list(self.settings.broadcast(
+            [1], [(None, 'application/json')] * 3, frame=frame))
+        frame.assert_called_once_with(b'[1]')
+        self.assertEqual(sent[2][2], b'data: [1]\n\n')
+
+    def test_that_buffer_sequences_are_joined(self):
+        transcoder = BufferSequenceTranscoder()
+        self.settings['application/octet-stream'] = transcoder
+        (_, _, data), = self.settings.broadcast(
+            None, [(None, 'application/octet-stream')])
+        self.assertEqual(data, b'first,second,third')
+
+    def test_that_unknown_content_types_raise_key_error(self):
+        with self.assertRaises(KeyError):
+            list(self.settings.broadcast({}, [(None, 'text/plain')]))
+
+
+class ServerSentEventTests(unittest.TestCase):
+
+    def test_that_fields_are_formatted(self):
+        self.assertEqual(
+            content.format_sse_event(b'{"a":1}', event='update',
+                                     event_id='42', retry=1000),
+            b'event: update\nid: 42\nretry: 1000\ndata: {"a":1}\n\n')
+
+    def test_that_each_line_of_data_is_a_data_field(self):
+        self.assertEqual(content.format_sse_event(b'one\r\ntwo\rthree\n'),
+                         b'data: one\ndata: two\ndata: three\ndata: \n\n')
+        self.assertEqual(content.format_sse_event(b''), b'data: \n\n')
+
+    def test_that_invalid_events_are_rejected(self):
+        with self.assertRaises(ValueError):
+            content.format_sse_event(b'\x81\xa1a\x01')
+        with self.assertRaises(ValueError):
+            content.format_sse_event(b'{}', event='one\ntwo')
+        with self.assertRaises(ValueError):
+            content.format_sse_event(b'{}', event_id='1\0')
+
+
+class EchoWebSocketHandler(content.WebSocketContentMixin,
+                           websocket.WebSocketHandler):
+
+    connections = []
+
+    def open(self):
+        self.connections.append(self)
+
+    def on_message(self, message):
+        try:
+            body = self.decode_message(message)
+        except ValueError:
+            self.close(1003, 'invalid message')
+        else:
+            self.send_message({'echo': body})
+
+
+class WebSocketContentTests(testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        EchoWebSocketHandler.connections = []
+        super().setUp()
+
+    def get_app(self):
+        application = examples.make_application()
+        application.add_handlers(r'.*', [
+            ('/ws', EchoWebSocketHandler),
+            ('/strict', EchoWebSocketHandler,
+             {'content_settings': {'default_content_type': None}})])
+        return application
+
+    def connect(self, accept, path='/ws'):
+        request = httpclient.HTTPRequest(
+            self.get_url(path).replace('http', 'ws', 1),
+            headers={'Accept': accept})
+        return websocket.websocket_connect(request)
+
+    @testing.gen_test
+    async def test_that_json_is_sent_as_text_messages(self):
+        connection = await self.connect('application/json')
+        await connection.write_message('{"a":1}')
+        self.assertEqual(await connection.read_message(),
+                         '{"echo":{"a":1}}')
+        connection.close()
+
+    @testing.gen_test
+    async def test_that_msgpack_is_sent_as_binary_messages(self):
+        connection = await self.connect('application/msgpack')
+        await connection.write_message(umsgpack.packb([1, 2]), binary=True)
+        self.assertEqual(umsgpack.unpackb(await connection.read_message()),
+                         {'echo': [1, 2]})
+        connection.close()
+
+    @testing.gen_test
+    async def test_that_invalid_messages_close_the_connection(self):
+        connection = await self.connect('application/json')
+        await connection.write_message('{')
+        self.assertIsNone(await connection.read_message())
+        self.assertEqual(connection.close_code, 1003)
+
+    @testing.gen_test
+    async def test_that_unacceptable_handshake_uses_default_type(self):
+        connection = await self.connect('text/plain')
+        await connection.write_message('[]')
+        self.assertEqual(await connection.read_message(), '{"echo":[]}')
+        connection.close()
+
+    @testing.gen_test
+    async def test_that_unacceptable_handshake_fails_without_default(self):
+        with self.assertRaises(httpclient.HTTPClientError) as context:
+            await self.connect('text/plain', '/strict')
+        self.assertEqual(context.exception.code, 406)
+
+    @testing.gen_test
+    async def test_that_broadcast_reaches_every_format(self):
+        json_connection = await self.connect('application/json')
+        msgpack_connection = await self.connect('application/msgpack')
+        settings = content.get_settings(self._app)
+        for handler, content_type, data in settings.broadcast(
+                {'event': 'ping'},
+                [(handler, handler.get_response_content_type())
+                 for handler in EchoWebSocketHandler.connections]):
+            handler.send_encoded_message(content_type, data)
+        self.assertEqual(await json_connection.read_message(),
+                         '{"event":"ping"}')
+        self.assertEqual(
+            umsgpack.unpackb(await msgpack_connection.read_message()),
+            {'event': 'ping'})
+        json_connection.close()
+        msgpack_connection.close()
+
+
+class LazyDocumentTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.document = {
+            'id': 42, 'action': 'update', 'nothing': None,
+            'tricky': 'quote " brace } bracket ] comma , \u2731',
+            'items': [{'name': '[{', 'values': [1.5, -2e10, True]}] * 20,
+        }
+
+    def test_that_json_members_are_read_on_access(self):
+        transcoder = transcoders.JSONTranscoder()
+        for text in (json.dumps(self.document),
+                     json.dumps(self.document, indent=3)):
+            document = transcoder.lazy_from_bytes(text.encode('utf-8'))
+            self.assertIsInstance(document, lazy.LazyDocument)
+            self.assertEqual(document['action'], 'update')
+            self.assertIn('tricky', document)
+            self.assertNotIn('missing', document)
+            self.assertEqual(document.materialize(), self.document)
+            self.assertEqual(list(document), list(self.document))
+
+        document = transcoder.lazy_from_bytes(b'{"id": 42, "rest": [1, 2')
+        self.assertEqual(document['id'], 42)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                document.materialize()
+
+    def test_that_json_load_options_are_used(self):
+        transcoder = transcoders.JSONTranscoder()
+        transcoder.load_options['parse_float'] = decimal.Decimal
+        document = transcoder.lazy_from_bytes(b'{"ratio": 0.25}')
+        self.assertEqual(document['ratio'], decimal.Decimal('0.25'))
+
+    def test_that_msgpack_values_are_decoded_on_access(self):
+        transcoder = transcoders.MsgPackTranscoder()
+        document = dict(self.document, bytes=b'\x00' * 300,
+                        ext=umsgpack.Ext(5, b'1234'))
+        document[1, 2] = 'tuple key'
+        data = umsgpack.packb(document)
+        decoded = transcoder.lazy_from_bytes(data)
+        self.assertIsInstance(decoded, lazy.LazyDocument)
+        with mock.patch.object(transcoder, 'unpackb',
+                               wraps=transcoder.unpackb) as unpackb:
+            self.assertEqual(decoded['action'], 'update')
+            self.assertEqual(decoded['action'], 'update')
+            unpackb.assert_called_with(transcoder.packb('update'))
+            self.assertEqual(unpackb.call_count, 1 + list(document).index(
+                'action') + 1)  # keys up to 'action' and its value
+        self.assertEqual(decoded.materialize(), transcoder.from_bytes(data))
+
+    def test_that_other_documents_are_decoded_immediately(self):
+        json_transcoder = transcoders.JSONTranscoder()
+        msgpack_transcoder = transcoders.MsgPackTranscoder()
+        self.assertEqual(json_transcoder.lazy_from_bytes(b' [1, 2]'), [1, 2])
+        self.assertEqual(msgpack_transcoder.lazy_from_bytes(b'\x92\x01\x02'),
+                         [1, 2])
+        json_transcoder.load_options['object_pairs_hook'] = list
+        self.assertEqual(json_transcoder.lazy_from_bytes(b'{"a": 1}'),
+                         [('a', 1)])
+
+    def test_that_duplicate_keys_are_decoded_like_eager_bodies(self):
+        transcoder = transcoders.JSONTranscoder()
+        data = b'{"a": 1, "b": 2, "a": 3}'
+        self.assertEqual(transcoder.from_bytes(data), {'a': 3, 'b': 2})
+        self.assertEqual(transcoder.lazy_from_bytes(data).materialize(),
+                         {'a': 3, 'b': 2})
+
+        transcoder = transcoders.MsgPackTranscoder()
+        data = b'\x83\xa1a\x01\xa1b\x02\xa1a\x03'
+        with self.assertRaises(umsgpack.DuplicateKeyException):
+            transcoder.from_bytes(data)
+        with self.assertRaises(ValueError):
+            transcoder.lazy_from_bytes(data).materialize()
+
+    def test_that_invalid_documents_are_rejected(self):
+        json_transcoder = transcoders.JSONTranscoder()
+        for data in (b'{"a": [1, 2}', b'{"a" 1}', b'{"a": 1,}', b'{a: 1}',
+                     b'{"a": "1}', b'{"a": 1} []'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    json_transcoder.lazy_from_bytes(data).materialize()
+
+        msgpack_transcoder = transcoders.MsgPackTranscoder()
+        for data in (b'\x82\x01\x02', b'\x81\x01\xc1',
+                     b'\x81\x01\xda\x00\x05abc', b'\x82\x01\x02\x01\x03'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    msgpack_transcoder.lazy_from_bytes(data).materialize()
+
+
+class LazyBodyHandler(content.ContentMixin, web.RequestHandler):
+
+    def post(self):
+        body = self.get_request_body(lazy=True)
+        response = {'action': body['action'],
+                    'lazy': not isinstance(body, dict)}
+        if self.get_query_argument('materialize', None):
+            response['body'] = self.get_request_body()
+        self.send_response(response)
+
+
+class AsyncLazyBodyHandler(content.AsyncContentMixin, web.RequestHandler):
+
+    async def post(self):
+        body = await self.get_request_body(lazy=True)
+        response = {'action': body['action'],
+                    'lazy': not isinstance(body, dict)}
+        if self.get_query_argument('materialize', None):
+            response['body'] = await self.get_request_body()
+        await self.send_response(response)
+
+
+class LazyRequestBodyTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        application = examples.make_application()
+        application.add_handlers(r'.*', [('/lazy', LazyBodyHandler),
+                                         ('/async', AsyncLazyBodyHandler)])
+        return application
+
+    def test_that_lazy_body_is_returned(self):
+        body = {'action': 'go', 'payload': list(range(100))}
+        for path in ('/lazy', '/async'):
+            for content_type, data in (
+                    ('application/json', json.dumps(body)),
+                    ('application/msgpack', umsgpack.packb(body))):
+                response = self.fetch(
+                    path + '?materialize=1', method='POST', body=data,
+                    headers={'Content-Type': content_type})
+                self.assertEqual(response.code, 200)
+                self.assertEqual(json.loads(response.body),
+                                 {'action': 'go', 'lazy': True,
+                                  'body': body})
+
+    def test_that_transcoders_without_lazy_decoding_are_supported(self):
+        content.add_text_content_type(self._app, 'application/x-json',
+                                      'utf-8', json.dumps, json.loads)
+        for path in ('/lazy', '/async'):
+            response = self.fetch(path, method='POST',
+                                  body=json.dumps({'action': 'go'}),
+                                  headers={'Content-Type':
+                                           'application/x-json'})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(json.loads(response.body),
+                             {'action': 'go', 'lazy': False})
+
+    def test_that_duplicate_keys_are_decoded_like_eager_bodies(self):
+        data = (b'\x83' + umsgpack.packb('action') + umsgpack.packb('go')
+                + umsgpack.packb('payload') + umsgpack.packb(1)
+                + umsgpack.packb('payload') + umsgpack.packb(2))
+        for path in ('/', '/lazy', '/async'):
+            response = self.fetch(
+                path + '?materialize=1', method='POST', body=data,
+                headers={'Content-Type': 'application/msgpack'})
+            self.assertEqual(response.code, 400)
+
+        data = b'{"action": "go", "payload": 1, "payload": 2}'
+        for path in ('/', '/lazy', '/async'):
+            response = self.fetch(
+                path + '?materialize=1', method='POST', body=data,
+                headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.code, 200)
+            decoded = json.loads(response.body)
+            self.assertEqual(decoded.get('body', decoded)['payload'], 2)
+
+    def test_that_invalid_lazy_body_returns_400(self):
+        for path in ('/lazy', '/async'):
+            for body in ('{"action" []}', '{"action": [}'):
+                response = self.fetch(path, method='POST', body=body,
+                                      headers={'Content-Type':
+                                               'application/json'})
+                self.assertEqual(response.code, 400)
+
+
 class GetRequestBodyTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
@@ -198,6 +1399,475 @@ class JSONTranscoderTests(unittest.TestCase):
         with self.assertRaises(TypeError):
             self.transcoder.dumps(object())
 
+    def test_that_encoder_is_reused_between_calls(self):
+        self.transcoder.dumps({})
+        _, encoder = self.transcoder._encoder
+        self.transcoder.dumps({'key': 'value'})
+        self.assertIs(self.transcoder._encoder[1], encoder)
+
+    def test_that_dump_options_changes_are_honored(self):
+        self.assertEqual(self.transcoder.dumps({'a': 1}), '{"a":1}')
+        self.transcoder.dump_options['separators'] = (', ', ': ')
+        self.assertEqual(self.transcoder.dumps({'a': 1}), '{"a": 1}')
+        self.transcoder.dump_options = {'sort_keys': True}
+        self.assertEqual(self.transcoder.dumps({'b': 1, 'a': 2}),
+                         '{"a": 2, "b": 1}')
+
+    def test_that_load_options_changes_are_honored(self):
+        self.assertEqual(self.transcoder.loads('{"a":1.5}'), {'a': 1.5})
+        self.transcoder.load_options['parse_float'] = str
+        self.assertEqual(self.transcoder.loads('{"a":1.5}'), {'a': '1.5'})
+        self.transcoder.load_options['parse_float'] = decimal.Decimal
+        self.assertEqual(self.transcoder.loads('{"a":1.5}'),
+                         {'a': decimal.Decimal('1.5')})
+
+    def test_that_cls_option_is_honored(self):
+        class Decoder(json.JSONDecoder):
+            def decode(self, s, *args, **kwargs):
+                return 'decoded'
+
+        self.transcoder.load_options = {'cls': Decoder}
+        self.assertEqual(self.transcoder.loads('{}'), 'decoded')
+
+    def test_that_byte_order_mark_is_rejected(self):
+        self.transcoder.load_options = {'parse_float': float}
+        with self.assertRaises(ValueError):
+            self.transcoder.loads('\ufeff{}')
+
+
+class BinaryFieldTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.transcoder = transcoders.JSONTranscoder(
+            binary_stream_threshold=64, binary_fields={'blob'})
+        self.transcoder.BINARY_CHUNK_SIZE = 30
+        self.blob = bytearray(os.urandom(100))
+
+    def test_that_large_values_are_streamed_in_chunks(self):
+        content_type, buffers = self.transcoder.to_bytes(
+            {'blob': self.blob, 'small': memoryview(b'small')})
+        self.assertEqual(content_type, 'application/json; charset="utf-8"')
+        self.assertIsInstance(buffers, list)
+        self.assertEqual(b''.join(buffers),
+                         transcoders.JSONTranscoder().to_bytes(
+                             {'blob': self.blob,
+                              'small': memoryview(b'small')})[1])
+        self.assertIn(base64.b64encode(self.blob[:30]), buffers)
+
+    def test_that_small_values_are_not_streamed(self):
+        _, body = self.transcoder.to_bytes({'blob': self.blob[:63]})
+        self.assertEqual(body, b'{"blob":"%s"}'
+                         % base64.b64encode(self.blob[:63]))
+
+    def test_that_streaming_is_disabled_by_default(self):
+        transcoder = transcoders.JSONTranscoder()
+        _, body = transcoder.to_bytes({'blob': self.blob})
+        self.assertIsInstance(body, bytes)
+
+    def test_that_streaming_requires_an_ascii_compatible_charset(self):
+        _, body = self.transcoder.to_bytes({'blob': self.blob}, 'utf-16')
+        self.assertEqual(body.decode('utf-16'), '{"blob":"%s"}'
+                         % base64.b64encode(self.blob).decode('ASCII'))
+
+    def test_that_streamed_documents_round_trip(self):
+        doc = {'items': [{'name': 'first', 'blob': self.blob},
+                         {'name': 'second', 'blob': bytearray(b'xy')}]}
+        _, buffers = self.transcoder.to_bytes(doc)
+        decoded = self.transcoder.from_bytes(b''.join(buffers))
+        self.assertEqual(decoded['items'][0]['blob'], bytes(self.blob))
+        self.assertEqual(decoded['items'][1], {'name': 'second',
+                                               'blob': b'xy'})
+
+    def test_that_unmarked_fields_are_left_as_strings(self):
+        self.assertEqual(self.transcoder.loads('{"other":"eHk="}'),
+                         {'other': 'eHk='})
+
+    def test_that_lazy_documents_decode_marked_fields(self):
+        doc = self.transcoder.lazy_from_bytes(
+            b'{"blob":"eHk=","nested":{"blob":"eXo="},"other":"eHk="}')
+        self.assertEqual(doc['blob'], b'xy')
+        self.assertEqual(doc['nested'], {'blob': b'yz'})
+        self.assertEqual(doc['other'], 'eHk=')
+
+    def test_that_invalid_base64_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            self.transcoder.loads('{"blob":"abc"}')
+
+
+class Color(enum.Enum):
+    RED = 'red'
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+class Money:
+
+    def __init__(self, currency, cents):
+        self.currency, self.cents = currency, cents
+
+
+class TypeRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.registry = transcoders.TypeRegistry(
+            transcoders.default_type_registry)
+        self.json = transcoders.JSONTranscoder(type_registry=self.registry)
+        self.msgpack = transcoders.MsgPackTranscoder(
+            type_registry=self.registry)
+
+    def test_that_builtin_types_are_converted(self):
+        dumped = self.json.dumps({
+            'amount': decimal.Decimal('1.10'), 'color': Color.RED,
+            'point': Point(1, 2), 'ip': ipaddress.ip_address('10.0.0.1'),
+            'net': ipaddress.ip_network('10.0.0.0/8'),
+            'path': pathlib.PurePosixPath('/tmp/file'),
+            'day': datetime.date(2020, 1, 2)})
+        self.assertEqual(json.loads(dumped), {
+            'amount': '1.10', 'color': 'red', 'point': {'x': 1, 'y': 2},
+            'ip': '10.0.0.1', 'net': '10.0.0.0/8', 'path': '/tmp/file',
+            'day': '2020-01-02'})
+
+    def test_that_msgpack_shares_the_conversions(self):
+        self.registry.register(Money, lambda m: [m.currency, m.cents])
+        _, packed = self.msgpack.to_bytes({
+            'color': Color.RED, 'price': Money('USD', 150),
+            'point': Point(1, 2)})
+        self.assertEqual(umsgpack.unpackb(packed), {
+            'color': 'red', 'price': ['USD', 150],
+            'point': {'x': 1, 'y': 2}})
+        self.assertEqual(json.loads(self.json.dumps(Money('EUR', 5))),
+                         ['EUR', 5])
+
+    def test_that_subclasses_use_the_closest_converter(self):
+        class Euro(Money):
+            pass
+
+        self.registry.register(Money, lambda m: m.cents)
+        self.assertEqual(self.json.dumps(Euro('EUR', 5)), '5')
+        self.registry.register(Euro, lambda m: 'EUR')
+        self.assertEqual(self.json.dumps(Euro('EUR', 5)), '"EUR"')
+        self.assertEqual(self.json.dumps(Money('USD', 5)), '5')
+
+    def test_that_registrations_do_not_leak_into_the_parent(self):
+        self.registry.register(Money, lambda m: m.cents)
+        self.assertIsNone(
+            transcoders.default_type_registry.converter_for(Money))
+        with self.assertRaises(TypeError):
+            transcoders.JSONTranscoder().dumps(Money('USD', 5))
+
+    def test_that_unsupported_types_raise_type_error(self):
+        with self.assertRaises(TypeError):
+            self.json.dumps(Money('USD', 5))
+        with self.assertRaises(TypeError):
+            self.msgpack.to_bytes(Money('USD', 5))
+        with self.assertRaises(TypeError):
+            self.registry.convert(Money('USD', 5))
+
+    def test_that_register_type_updates_the_default_registry(self):
+        registry = transcoders.default_type_registry
+        self.addCleanup(setattr, registry, '_converters',
+                        dict(registry._converters))
+        self.addCleanup(setattr, registry, '_cache', {})
+        transcoders.register_type(Money, lambda m: m.currency)
+        self.assertEqual(transcoders.JSONTranscoder().dumps(Money('USD', 5)),
+                         '"USD"')
+
+
+class RecordTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.document = {'items': [{'id': index, 'name': str(index)}
+                                   for index in range(3)],
+                         'mixed': [{'id': 1}, {'name': 'x'}],
+                         'single': [{'id': 1}]}
+
+    def test_that_rows_are_read_only_mappings(self):
+        compacted = records.compact(self.document, records.ROWS)
+        rows = compacted['items']
+        self.assertIsInstance(rows[0], records.Record)
+        self.assertEqual(rows, [{'id': index, 'name': str(index)}
+                                for index in range(3)])
+        self.assertIs(rows[0]._index, rows[2]._index)
+        self.assertEqual(list(rows[1]), ['id', 'name'])
+        self.assertEqual(rows[1].get('missing', 'default'), 'default')
+        with self.assertRaises(TypeError):
+            rows[1]['id'] = 0
+
+    def test_that_columns_store_each_field_together(self):
+        compacted = records.compact(self.document, records.COLUMNS)
+        columns = compacted['items']
+        self.assertIsInstance(columns, records.Columns)
+        self.assertEqual(columns.fields, ('id', 'name'))
+        self.assertEqual(columns.column('id'), (0, 1, 2))
+        self.assertEqual(columns[-1], {'id': 2, 'name': '2'})
+        self.assertEqual(columns[:2], [{'id': 0, 'name': '0'},
+                                       {'id': 1, 'name': '1'}])
+        self.assertEqual(columns, self.document['items'])
+        with self.assertRaises(IndexError):
+            columns[3]
+
+    def test_that_heterogeneous_and_single_items_are_kept(self):
+        for layout in (records.ROWS, records.COLUMNS):
+            compacted = records.compact(self.document, layout)
+            self.assertIs(type(compacted['mixed'][0]), dict)
+            self.assertIs(type(compacted['single'][0]), dict)
+
+    def test_that_keys_are_interned(self):
+        keys = [''.join(['na', 'me']) for _ in range(2)]
+        self.assertIsNot(keys[0], keys[1])
+        compacted = records.compact([{keys[0]: 1}, {keys[1]: 2}])
+        self.assertIs(next(iter(compacted[0])), next(iter(compacted[1])))
+
+    def test_that_invalid_layout_is_rejected(self):
+        with self.assertRaises(ValueError):
+            records.compact([], 'tuples')
+
+    def test_that_records_can_be_pickled(self):
+        compacted = records.compact(self.document, records.COLUMNS)
+        self.assertEqual(pickle.loads(pickle.dumps(compacted)), compacted)
+        row = records.compact(self.document['items'], records.ROWS)[0]
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+
+    def test_that_transcoders_decode_and_encode_records(self):
+        for layout in (records.ROWS, records.COLUMNS):
+            json_transcoder = transcoders.JSONTranscoder(records=layout)
+            msgpack_transcoder = transcoders.MsgPackTranscoder(
+                intern_keys=True, records=layout)
+            for transcoder in (json_transcoder, msgpack_transcoder):
+                with self.subTest(layout=layout, transcoder=transcoder):
+                    _, data = transcoder.to_bytes(self.document)
+                    decoded = transcoder.from_bytes(data)
+                    self.assertEqual(decoded, self.document)
+                    _, encoded = transcoder.to_bytes(decoded)
+                    self.assertEqual(encoded, data)
+
+    def test_that_lazy_documents_decode_records(self):
+        transcoder = transcoders.JSONTranscoder(records=records.ROWS)
+        _, data = transcoder.to_bytes(self.document)
+        document = transcoder.lazy_from_bytes(data)
+        self.assertIsInstance(document['items'][0], records.Record)
+
+
+ORDER_SCHEMA = {
+    'type': 'object',
+    'required': ['id', 'items'],
+    'additionalProperties': False,
+    'properties': {
+        'id': {'type': 'integer', 'minimum': 1},
+        'note': {'type': ['string', 'null'], 'maxLength': 10},
+        'items': {
+            'type': 'array',
+            'minItems': 1,
+            'items': {
+                'type': 'object',
+                'required': ['sku', 'price'],
+                'properties': {
+                    'sku': {'type': 'string', 'pattern': '^[A-Z]+-[0-9]+$'},
+                    'price': {'type': 'number', 'exclusiveMinimum': 0},
+                    'status': {'enum': ['new', 'shipped']},
+                },
+            },
+        },
+    },
+}
+
+
+class SchemaTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.schema = schemas.Schema(ORDER_SCHEMA)
+        self.order = {'id': 7, 'note': None,
+                      'items': [{'sku': 'AB-1', 'price': 2.5},
+                                {'sku': 'CD-2', 'price': 1,
+                                 'status': 'new'}]}
+
+    def assert_invalid(self, value, expected):
+        with self.assertRaises(schemas.ValidationError) as context:
+            self.schema.validate(value)
+        self.assertEqual(str(context.exception), expected)
+        return context.exception
+
+    def test_that_valid_documents_are_returned(self):
+        self.assertIs(self.schema.validate(self.order), self.order)
+        self.order['id'] = 7.0
+        self.schema.validate(self.order)
+
+    def test_that_first_violation_is_reported_with_its_location(self):
+        self.order['items'][1]['price'] = '1'
+        self.order['items'][1]['sku'] = 'invalid'
+        error = self.assert_invalid(
+            self.order, "/items/1/sku: 'invalid' does not match "
+                        "'^[A-Z]+-[0-9]+$'")
+        self.assertEqual(error.path, ('items', 1, 'sku'))
+        self.assertIsInstance(error, ValueError)
+
+    def test_that_object_keywords_are_enforced(self):
+        del self.order['id']
+        self.assert_invalid(self.order, "/: missing required property 'id'")
+        self.order['id'] = 1
+        self.order['extra/key'] = True
+        self.assert_invalid(self.order, '/extra~1key: unexpected property')
+        self.assert_invalid([], '/: expected object, got array')
+
+    def test_that_value_keywords_are_enforced(self):
+        cases = [
+            (('id',), True, '/id: expected integer, got boolean'),
+            (('id',), 0, '/id: 0 is not at least 1'),
+            (('note',), 'x' * 11, '/note: string must have at most 10 '
+                                  'characters'),
+            (('items',), [], '/items: array must have at least 1 items'),
+            (('items', 0, 'price'), 0, '/items/0/price: 0 is not greater '
+                                       'than 0'),
+            (('items', 0, 'status'), 'lost', "/items/0/status: 'lost' is not "
+                                             "one of ['new', 'shipped']"),
+        ]
+        for path, value, expected in cases:
+            with self.subTest(path=path, value=value):
+                order = copy.deepcopy(self.order)
+                target = order
+                for part in path[:-1]:
+                    target = target[part]
+                target[path[-1]] = value
+                self.assert_invalid(order, expected)
+
+    def test_that_booleans_do_not_match_numbers(self):
+        schema = schemas.Schema({'const': 1})
+        schema.validate(1.0)
+        with self.assertRaises(schemas.ValidationError):
+            schema.validate(True)
+        with self.assertRaises(schemas.ValidationError):
+            schemas.Schema({'enum': [0]}).validate(False)
+
+    def test_that_compacted_records_are_validated(self):
+        document = records.compact(copy.deepcopy(self.order), records.COLUMNS)
+        self.schema.validate(document)
+        document = records.compact({'id': 1, 'items': [{'sku': 'A-1'},
+                                                       {'sku': 'B-2'}]},
+                                   records.ROWS)
+        self.assert_invalid(document,
+                            "/items/0: missing required property 'price'")
+
+    def test_that_unsupported_keywords_are_rejected(self):
+        with self.assertRaises(ValueError):
+            schemas.Schema({'type': 'object', 'patternProperties': {}})
+        with self.assertRaises(ValueError):
+            schemas.Schema({'type': 'float'})
+        with self.assertRaises(ValueError):
+            schemas.Schema({'minLength': -1})
+        with self.assertRaises(ValueError) as context:
+            schemas.Schema({'type': 'string', 'pattern': '[a-'})
+        self.assertNotIsInstance(context.exception, schemas.ValidationError)
+        schemas.Schema({'title': 'Anything', 'description': 'goes'})
+
+    def test_that_nested_booleans_are_not_numbers(self):
+        schema = schemas.Schema({'const': [1, {'flag': 0}]})
+        schema.validate([1, {'flag': 0}])
+        schema.validate([1.0, {'flag': 0}])
+        for value in ([True, {'flag': 0}], [1, {'flag': False}],
+                      [1], [1, {'flag': 0, 'other': 0}], [1, {}]):
+            with self.subTest(value=value):
+                with self.assertRaises(schemas.ValidationError):
+                    schema.validate(value)
+
+        schema = schemas.Schema({'enum': [[True], {'on': False}]})
+        schema.validate([True])
+        schema.validate({'on': False})
+        for value in ([1], {'on': 0}, [[True]]):
+            with self.subTest(value=value):
+                with self.assertRaises(schemas.ValidationError):
+                    schema.validate(value)
+
+
+class SchemaHandler(content.ContentMixin, web.RequestHandler):
+
+    schema = schemas.Schema({'type': 'object', 'required': ['name']})
+
+    def post(self, mode):
+        if mode == 'explicit':
+            body = self.get_request_body(lazy=True, schema=self.schema)
+        else:
+            body = self.get_request_body(lazy=True)
+        self.send_response(dict(body))
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs['exc_info'][1].__cause__
+        if isinstance(error, schemas.ValidationError):
+            self.finish({'pointer': error.pointer, 'error': error.message})
+        else:
+            super().write_error(status_code, **kwargs)
+
+
+class AsyncSchemaHandler(content.AsyncContentMixin, web.RequestHandler):
+
+    async def post(self, mode):
+        body = await self.get_request_body(schema=SchemaHandler.schema)
+        await self.send_response(body)
+
+
+class SchemaHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        application = web.Application([('/(\\w+)', SchemaHandler),
+                                       ('/async/(\\w+)', AsyncSchemaHandler)])
+        content.set_default_content_type(application, 'application/json')
+        content.add_transcoder(application, transcoders.JSONTranscoder(),
+                               schema={'type': 'object',
+                                       'properties': {'id': {
+                                           'type': 'integer'}}})
+        content.add_transcoder(application, transcoders.MsgPackTranscoder())
+        return application
+
+    def post(self, path, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode()
+        else:
+            body = umsgpack.packb(body)
+        return self.fetch(path, method='POST', body=body,
+                          headers={'Content-Type': content_type,
+                                   'Accept': 'application/json'})
+
+    def test_that_registered_schema_is_applied(self):
+        response = self.post('/registered', {'id': 1})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {'id': 1})
+        response = self.post('/registered', {'id': 'one'})
+        self.assertEqual(response.code, 400)
+        self.assertEqual(json.loads(response.body),
+                         {'pointer': '/id',
+                          'error': 'expected integer, got string'})
+
+    def test_that_registered_schema_only_applies_to_its_content_type(self):
+        response = self.post('/registered', {'id': 'one'},
+                             'application/msgpack')
+        self.assertEqual(response.code, 200)
+
+    def test_that_explicit_schema_is_applied(self):
+        for path in ('/explicit', '/async/explicit'):
+            with self.subTest(path=path):
+                response = self.post(path, {'id': 1, 'name': 'x'},
+                                     'application/msgpack')
+                self.assertEqual(response.code, 200)
+                response = self.post(path, {'id': 1}, 'application/msgpack')
+                self.assertEqual(response.code, 400)
+                response = self.post(path, {'id': 'one', 'name': 'x'})
+                self.assertEqual(response.code, 400)
+
+    def test_that_schema_is_copied_into_handler_views(self):
+        settings = content.get_settings(self._app)
+        view = settings.for_handler(SchemaHandler, {
+            'content_types': ['application/json']})
+        self.assertIs(view.schema_for('application/json'),
+                      settings.schema_for('application/json'))
+        self.assertIsNone(view.schema_for('application/msgpack'))
+
 
 class ContentSettingsTests(unittest.TestCase):
 
@@ -237,6 +1907,439 @@ class ContentSettingsTests(unittest.TestCase):
         self.assertEqual(settings['application/json; charset=utf-8'], handler)
 
 
+class SettingsOverrideTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.settings = content.ContentSettings()
+        self.settings.default_content_type = 'application/json'
+        self.settings['application/json'] = transcoders.JSONTranscoder()
+        self.settings.register('application/msgpack',
+                               transcoders.MsgPackTranscoder(), qs=0.5)
+
+    def test_that_settings_are_shared_without_overrides(self):
+        self.assertIs(self.settings.for_handler(web.RequestHandler),
+                      self.settings)
+
+    def test_that_overrides_are_merged_and_cached(self):
+        class Handler:
+            content_settings = {'content_types': ['application/msgpack'],
+                                'default_encoding': 'latin-1'}
+
+        route = {'default_content_type': 'application/msgpack'}
+        view = self.settings.for_handler(Handler, route)
+        self.assertIs(self.settings.for_handler(Handler, route), view)
+        self.assertIsNot(self.settings.for_handler(Handler), view)
+        self.assertEqual([str(c) for c in view.available_content_types],
+                         ['application/msgpack'])
+        self.assertEqual(view.default_content_type, 'application/msgpack')
+        self.assertEqual(view.default_encoding, 'latin-1')
+        self.assertIs(view['application/msgpack'],
+                      self.settings['application/msgpack'])
+        self.assertEqual(view.negotiate('*/*'), ('application/msgpack',))
+
+    def test_that_equal_overrides_share_a_view(self):
+        view = self.settings.for_handler(
+            web.RequestHandler, {'content_types': ['application/msgpack']})
+        for _ in range(3):
+            self.assertIs(self.settings.for_handler(
+                web.RequestHandler,
+                {'content_types': ('application/msgpack',)}), view)
+        self.assertEqual(len(self.settings._snapshot.views), 1)
+
+    def test_that_views_follow_changes(self):
+        class Handler:
+            content_settings = {'default_encoding': 'latin-1'}
+
+        view = self.settings.for_handler(Handler)
+        self.settings.default_content_type = 'application/msgpack'
+        view = self.settings.for_handler(Handler)
+        self.assertEqual(view.default_content_type, 'application/msgpack')
+
+        self.settings['text/plain'] = object()
+        self.assertIn('text/plain',
+                      [str(c) for c in self.settings.for_handler(
+                          Handler).available_content_types])
+
+    def test_that_default_content_type_is_one_of_the_content_types(self):
+        view = self.settings.for_handler(
+            web.RequestHandler, {'content_types': ['application/msgpack']})
+        self.assertEqual(view.default_content_type, 'application/msgpack')
+        self.assertIs(view[view.default_content_type],
+                      self.settings['application/msgpack'])
+
+    def test_that_invalid_overrides_are_rejected(self):
+        for overrides in ({'content_types': ['text/plain']},
+                          {'content_types': ['application/msgpack'],
+                           'default_content_type': 'application/json'},
+                          {'unknown': True}):
+            with self.subTest(overrides=overrides):
+                with self.assertRaises(ValueError):
+                    self.settings.for_handler(web.RequestHandler, overrides)
+
+
+class JSONOnlyHandler(content.ContentMixin, web.RequestHandler):
+    content_settings = {'content_types': ['application/json']}
+
+    def post(self):
+        self.send_response(self.get_request_body())
+
+    put = post
+
+
+class SettingsOverrideHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        application = examples.make_application()
+        application.add_handlers(r'.*', [
+            ('/json', JSONOnlyHandler),
+            web.url('/msgpack', examples.SimpleHandler,
+                    {'content_settings': {
+                        'default_content_type': 'application/msgpack'}}),
+        ])
+        return application
+
+    def test_that_handler_overrides_are_applied(self):
+        body = {'name': 'value'}
+        response = self.fetch('/json', method='POST', body=json.dumps(body),
+                              headers={'Content-Type': 'application/json',
+                                       'Accept': 'application/msgpack'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json; charset="utf-8"')
+        self.assertEqual(json.loads(response.body), body)
+
+        response = self.fetch('/json', method='POST',
+                              body=umsgpack.packb(body),
+                              headers={'Content-Type': 'application/msgpack'})
+        self.assertEqual(response.code, 415)
+
+    def test_that_route_overrides_are_applied(self):
+        body = {'name': 'value'}
+        response = self.fetch('/msgpack', method='POST',
+                              body=umsgpack.packb(body),
+                              headers={'Content-Type': 'application/msgpack'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/msgpack')
+        self.assertEqual(umsgpack.unpackb(response.body), body)
+
+    def test_that_excluded_application_default_is_not_used(self):
+        content.get_settings(self._app).default_content_type = (
+            'application/msgpack')
+        response = self.fetch('/json', method='POST', body='{"a":1}',
+                              headers={'Content-Type': 'application/json',
+                                       'Accept': 'text/html'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json; charset="utf-8"')
+
+        response = self.fetch('/json', method='PUT', body='{"a":1}')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), {'a': 1})
+
+    def test_that_settings_are_resolved_once_per_request(self):
+        settings = content.get_settings(self._app)
+        with mock.patch.object(settings, 'for_handler',
+                               wraps=settings.for_handler) as for_handler:
+            self.fetch('/json', method='POST', body='{}',
+                       headers={'Content-Type': 'application/json'})
+        for_handler.assert_called_once_with(JSONOnlyHandler, None)
+
+
+class NegotiationTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.settings = content.ContentSettings()
+
+    def test_that_ietfparse_selects_without_qs(self):
+        self.settings['application/json'] = object()
+        self.settings['application/msgpack'] = object()
+        accept = 'application/json, application/msgpack'
+        selected, _ = algorithms.select_content_type(
+            headers.parse_accept(accept),
+            self.settings.available_content_types)
+        ranking = self.settings.negotiate(accept)
+        self.assertEqual(ranking[0], str(selected))
+        self.assertEqual(set(ranking),
+                         {'application/json', 'application/msgpack'})
+
+    def test_that_qs_steers_equally_acceptable_types(self):
+        self.settings.register('application/json', object(), qs=0.9)
+        self.settings.register('application/msgpack', object())
+        self.assertEqual(
+            self.settings.negotiate('application/json, application/msgpack'),
+            ('application/msgpack',))
+        self.assertEqual(self.settings.negotiate('*/*'),
+                         ('application/msgpack',))
+
+    def test_that_client_quality_outweighs_qs(self):
+        self.settings.register('application/json', object(), qs=0.9)
+        self.settings.register('application/msgpack', object())
+        self.assertEqual(
+            self.settings.negotiate(
+                'application/json, application/msgpack;q=0.5'),
+            ('application/json',))
+
+    def test_that_most_specific_media_range_is_used(self):
+        self.settings.register('application/json', object(), qs=0.9)
+        self.settings.register('application/msgpack', object())
+        self.assertEqual(
+            self.settings.negotiate('*/*, application/msgpack;q=0'),
+            ('application/json',))
+
+    def test_that_zero_qs_is_never_selected(self):
+        self.settings.register('application/json', object())
+        self.settings.register('application/msgpack', object(), qs=0.0)
+        self.assertEqual(self.settings.negotiate('application/msgpack'), ())
+
+    def test_that_unmatched_accept_returns_empty_ranking(self):
+        self.settings['application/json'] = object()
+        self.assertEqual(self.settings.negotiate('application/xml'), ())
+
+    def test_that_out_of_range_qs_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.settings.register('application/json', object(), qs=1.5)
+        self.assertEqual(self.settings.available_content_types, [])
+
+    def test_that_rankings_are_cached_per_header(self):
+        self.settings['application/json'] = object()
+        ranking = self.settings.negotiate('application/*')
+        self.assertIs(self.settings.negotiate('application/*'), ranking)
+
+    def test_that_registration_clears_cached_rankings(self):
+        self.settings['application/json'] = object()
+        self.assertEqual(self.settings.negotiate('application/msgpack'), ())
+        self.settings['application/msgpack'] = object()
+        self.assertEqual(self.settings.negotiate('application/msgpack'),
+                         ('application/msgpack',))
+
+    def test_that_ranking_cache_is_bounded(self):
+        self.settings.max_rankings = 2
+        self.settings['application/json'] = object()
+        for accept in ('application/json', 'application/*', '*/*'):
+            self.settings.negotiate(accept)
+        self.assertEqual(list(self.settings._snapshot.rankings),
+                         ['application/*', '*/*'])
+
+
+class ConcurrentSettingsTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        self.settings = content.ContentSettings()
+        self.settings['application/json'] = transcoders.JSONTranscoder()
+        self.failures = []
+
+    def run_threads(self, *targets):
+        def run(target):
+            try:
+                target()
+            except Exception as error:
+                self.failures.append(error)
+
+        threads = [threading.Thread(target=run, args=(target,))
+                   for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.failures, [])
+
+    def test_that_readers_see_complete_registrations(self):
+        done = threading.Event()
+        content_types = ['application/vnd.type{}+json'.format(index)
+                         for index in range(200)]
+
+        def write():
+            try:
+                for content_type in content_types:
+                    self.settings.register(content_type, object())
+                    self.settings.add_converter(converters.MsgPackToJSON(
+                        source_type=content_type))
+            finally:
+                done.set()
+
+        def read():
+            registered = ['application/json'] + content_types
+            seen = 1
+            for index in itertools.count():
+                if done.is_set():
+                    break
+                for ranking in (self.settings.simple_rankings['*/*'],
+                                self.settings.negotiate(
+                                    '*/*, text/x-{}'.format(index))):
+                    # every ranking covers a complete set of registrations
+                    self.assertGreaterEqual(len(ranking), seen)
+                    seen = len(ranking)
+                    self.assertEqual(set(ranking), set(registered[:seen]))
+                    for content_type in ranking:
+                        self.assertIsNotNone(self.settings[content_type])
+                view = self.settings.for_handler(
+                    JSONOnlyHandler, {'default_content_type': None})
+                self.assertEqual(
+                    [str(c) for c in view.available_content_types],
+                    ['application/json'])
+
+        self.run_threads(write, read, read, read)
+        self.assertEqual(len(self.settings.available_content_types), 201)
+        self.assertEqual(len(self.settings.negotiate('*/*')), 201)
+
+    def test_that_readers_do_not_take_the_lock(self):
+        self.settings.add_converter(converters.JSONToMsgPack())
+        self.settings._lock = mock.MagicMock()
+        self.settings._lock.__enter__.side_effect = AssertionError(
+            'lock taken')
+        self.assertEqual(self.settings.negotiate('application/*'),
+                         ('application/json',))
+        self.assertIn('*/*', self.settings.simple_rankings)
+        self.assertIsNotNone(self.settings['application/json'])
+        self.assertIs(self.settings.for_handler(JSONOnlyHandler).get(
+            'application/json'), self.settings['application/json'])
+        self.assertEqual(self.settings.convert(b'[]', 'application/json',
+                                               'application/msgpack'),
+                         ('application/msgpack', b'\x90'))
+
+    def test_that_concurrent_registrations_are_serialized(self):
+        barrier = threading.Barrier(8)
+        transcoders_ = [transcoders.JSONTranscoder() for _ in range(8)]
+
+        def register(transcoder):
+            def target():
+                barrier.wait()
+                self.settings.register('application/msgpack', transcoder)
+            return target
+
+        with self.assertLogs(content.logger, 'WARNING') as context:
+            self.run_threads(*[register(transcoder)
+                               for transcoder in transcoders_])
+        self.assertEqual(len(context.records), 7)
+        self.assertEqual(
+            [str(c) for c in self.settings.available_content_types],
+            ['application/json', 'application/msgpack'])
+        self.assertIn(self.settings['application/msgpack'], transcoders_)
+
+
+class SimpleAcceptTests(unittest.TestCase):
+
+    REGISTRATIONS = [
+        [('application/json', 1.0), ('application/msgpack', 1.0)],
+        [('application/msgpack', 1.0), ('application/json', 0.9)],
+        [('application/json', 1.0), ('application/vendor+json', 1.0),
+         ('application/json; version=2', 0.5), ('text/plain', 0.8)],
+        [('application/vendor+msgpack', 0.0), ('text/html', 1.0),
+         ('text/plain', 1.0), ('application/json', 1.0)],
+    ]
+
+    def test_that_simple_rankings_match_full_algorithm(self):
+        for registrations in self.REGISTRATIONS:
+            settings = content.ContentSettings()
+            for content_type, qs in registrations:
+                settings.register(content_type, object(), qs=qs)
+            self.assertIn('*/*', settings.simple_rankings)
+            for accept, ranking in settings.simple_rankings.items():
+                with self.subTest(accept=accept,
+                                  registrations=registrations):
+                    self.assertEqual(
+                        ranking,
+                        settings._rank(settings._snapshot,
+                                       headers.parse_accept(accept)))
+                    self.assertEqual(ranking,
+                                     settings.negotiate(accept.upper()))
+
+    def test_that_simple_rankings_match_select_content_type(self):
+        for registrations in (
+                ['application/json', 'application/msgpack'],
+                ['application/msgpack', 'application/json'],
+                ['application/json', 'application/vendor+json',
+                 'text/plain', 'application/json; version=2']):
+            settings = content.ContentSettings()
+            for content_type in registrations:
+                settings.register(content_type, object())
+            for accept, ranking in settings.simple_rankings.items():
+                with self.subTest(accept=accept,
+                                  registrations=registrations):
+                    try:
+                        selected, _ = algorithms.select_content_type(
+                            headers.parse_accept(accept),
+                            settings.available_content_types)
+                    except errors.NoMatch:
+                        self.assertEqual(ranking, ())
+                        continue
+                    expected = '{}/{}'.format(selected.content_type,
+                                              selected.content_subtype)
+                    if selected.content_suffix:
+                        expected += '+' + selected.content_suffix
+                    self.assertEqual(ranking[0], expected)
+
+    def test_that_registration_recalculates_simple_rankings(self):
+        settings = content.ContentSettings()
+        settings['application/json'] = object()
+        self.assertNotIn('application/msgpack', settings.simple_rankings)
+        settings['application/msgpack'] = object()
+        self.assertEqual(settings.simple_rankings['application/msgpack'],
+                         ('application/msgpack',))
+
+
+class SimpleAcceptHandlerTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return examples.make_application(debug=True)
+
+    def test_that_simple_accept_headers_are_not_parsed(self):
+        settings = content.get_settings(self._app)
+        with mock.patch.object(settings, 'negotiate') as negotiate:
+            for accept in ('*/*', 'application/*', 'application/msgpack'):
+                response = self.fetch(
+                    '/', method='POST', body='{}',
+                    headers={'Accept': accept,
+                             'Content-Type': 'application/json'})
+                self.assertEqual(response.code, 200)
+            negotiate.assert_not_called()
+
+    def test_that_other_accept_headers_are_negotiated(self):
+        response = self.fetch(
+            '/', method='POST', body='{}',
+            headers={'Accept': 'text/html, application/msgpack;q=0.5',
+                     'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/msgpack')
+
+
+class ContentTypeInterningTests(unittest.TestCase):
+
+    def test_that_equal_headers_share_parsed_instance(self):
+        header = ''.join(['application/json', '; charset=utf-8'])
+        self.assertIs(content._parse_content_type(header),
+                      content._parse_content_type('application/json; '
+                                                  'charset=utf-8'))
+
+    def test_that_parsed_content_type_is_compact(self):
+        parsed = content._parse_content_type(
+            'Application/Vendor+JSON; Version=2; charset=utf-8')
+        self.assertIsInstance(parsed, tuple)
+        self.assertEqual(parsed.media_type, 'application/vendor+json')
+        self.assertEqual(parsed.parameters,
+                         (('charset', 'utf-8'), ('version', '2')))
+        self.assertEqual(parsed.normalized,
+                         'application/vendor+json; charset=utf-8; version=2')
+
+    def test_that_parsed_content_type_is_immutable(self):
+        parsed = content._parse_content_type('application/json')
+        with self.assertRaises(AttributeError):
+            parsed.media_type = 'text/plain'
+        with self.assertRaises(AttributeError):
+            parsed.extra = True
+
+    def test_that_interning_cache_is_bounded(self):
+        info = content._parse_content_type.cache_info()
+        self.assertIsNotNone(info.maxsize)
+
+
 class ContentFunctionTests(unittest.TestCase):
 
     def setUp(self):
@@ -291,6 +2394,32 @@ class ContentFunctionTests(unittest.TestCase):
         self.assertIsNotNone(settings)
         self.assertIs(content.get_settings(self.context), settings)
 
+    def test_that_add_transcoder_sets_server_quality(self):
+        settings = content.install(self.context, 'application/json')
+        content.add_transcoder(self.context, transcoders.JSONTranscoder(),
+                               qs=0.5)
+        content.add_transcoder(self.context, transcoders.MsgPackTranscoder())
+        self.assertEqual(settings.negotiate('*/*'), ('application/msgpack',))
+
+    def test_that_preload_ranks_accept_headers(self):
+        settings = content.install(self.context, 'application/json')
+        content.add_transcoder(self.context, transcoders.JSONTranscoder())
+        content.preload(self.context, ['application/*'])
+        self.assertEqual(set(settings._snapshot.rankings),
+                         {'application/json', 'application/*'})
+
+    def test_that_preload_calls_transcoder_preload(self):
+        transcoder = transcoders.JSONTranscoder()
+        transcoder.load_options = {'parse_float': float}
+        content.add_transcoder(self.context, transcoder)
+        content.add_binary_content_type(self.context,
+                                        'application/vnd.python.pickle',
+                                        pickle.dumps, pickle.loads)
+        settings = content.preload(self.context)
+        self.assertIs(settings, content.get_settings(self.context))
+        self.assertIsNotNone(transcoder._encoder[1])
+        self.assertIsNotNone(transcoder._decoder[1])
+
 
 class MsgPackTranscoderTests(unittest.TestCase):
 
@@ -390,3 +2519,138 @@ class MsgPackTranscoderTests(unittest.TestCase):
         dumped = self.transcoder.packb(data)
         self.assertEqual(self.transcoder.unpackb(dumped), data)
         self.assertEqual(dumped, pack_bytes(data))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class NumPyTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.json = transcoders.JSONTranscoder()
+        self.msgpack = transcoders.MsgPackTranscoder()
+
+    def test_that_json_encodes_arrays_and_scalars(self):
+        body = {'matrix': numpy.arange(6, dtype='i4').reshape(2, 3),
+                'flags': numpy.array([True, False]),
+                'mean': numpy.float32(0.5), 'count': numpy.int64(3)}
+        _, data = self.json.to_bytes(body)
+        self.assertEqual(json.loads(data),
+                         {'matrix': [[0, 1, 2], [3, 4, 5]],
+                          'flags': [True, False], 'mean': 0.5, 'count': 3})
+
+    def test_that_msgpack_round_trips_typed_arrays(self):
+        arrays = [numpy.linspace(0, 1, 1000).reshape(10, 100),
+                  numpy.array([True, False]), numpy.array(1 + 2j),
+                  numpy.arange(6, dtype='>i2').reshape(3, 2).T,
+                  numpy.zeros((0, 3), dtype='u1')]
+        for array in arrays:
+            with self.subTest(array=array):
+                _, data = self.msgpack.to_bytes({'array': array})
+                decoded = self.msgpack.from_bytes(data)['array']
+                self.assertEqual(decoded.dtype, array.dtype)
+                self.assertEqual(decoded.shape, array.shape)
+                self.assertTrue((decoded == array).all())
+
+    def test_that_msgpack_arrays_are_compact(self):
+        array = numpy.linspace(0, 1, 10000)
+        _, data = self.msgpack.to_bytes(array)
+        self.assertLess(len(data), array.nbytes + 64)
+        self.assertFalse(self.msgpack.from_bytes(data).flags.writeable)
+
+    def test_that_other_arrays_are_packed_as_lists(self):
+        _, data = self.msgpack.to_bytes(numpy.array(['a', 'b']))
+        self.assertEqual(umsgpack.unpackb(data), ['a', 'b'])
+        _, data = self.msgpack.to_bytes(numpy.int64(3))
+        self.assertEqual(umsgpack.unpackb(data), 3)
+
+    def test_that_invalid_extensions_are_rejected(self):
+        _, data = self.msgpack.to_bytes(numpy.arange(4))
+        payload = umsgpack.unpackb(data).data
+        for invalid in (payload[:-1], b'\x02|O\x00', b'\x03xyz\x00',
+                        b'\x03<f8\x01\x00'):
+            with self.subTest(payload=invalid):
+                with self.assertRaises(ValueError):
+                    self.msgpack.from_bytes(umsgpack.packb(umsgpack.Ext(
+                        self.msgpack.NDARRAY_EXT_TYPE, invalid)))
+
+
+class NumPyExtensionTests(unittest.TestCase):
+
+    def test_that_arrays_are_left_packed_without_numpy(self):
+        transcoder = transcoders.MsgPackTranscoder()
+        ext = umsgpack.Ext(transcoder.NDARRAY_EXT_TYPE, b'\x03<f8\x00' * 2)
+        with mock.patch.dict(sys.modules, {'numpy': None}):
+            self.assertEqual(transcoder.from_bytes(umsgpack.packb([ext])),
+                             [ext])
+
+
+class ImportTimeTests(unittest.TestCase):
+
+    def test_that_package_import_does_not_import_content(self):
+        profile = benchmarks.import_profile('sprockets.mixins.mediatype')
+        self.assertIn('sprockets.mixins.mediatype', profile)
+        self.assertNotIn('sprockets.mixins.mediatype.content', profile)
+        self.assertNotIn('tornado.web', profile)
+        self.assertNotIn('ietfparse', profile)
+
+    def test_that_transcoders_import_does_not_import_backends(self):
+        profile = benchmarks.import_profile(
+            'sprockets.mixins.mediatype.transcoders')
+        self.assertIn('sprockets.mixins.mediatype.transcoders', profile)
+        self.assertNotIn('umsgpack', profile)
+        self.assertNotIn('numpy', profile)
+        self.assertNotIn('tornado.web', profile)
+
+    def test_that_package_exports_are_resolved_on_access(self):
+        from sprockets.mixins import mediatype
+        self.assertIs(mediatype.ContentMixin, content.ContentMixin)
+        self.assertIs(mediatype.set_default_content_type,
+                      content.set_default_content_type)
+        with self.assertRaises(AttributeError):
+            getattr(mediatype, 'not_exported')
+
+
+class LoadTestTests(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return loadtest.make_application()
+
+    def test_that_mix_is_parsed(self):
+        self.assertEqual(
+            loadtest.parse_mix('json=3, msgpack', loadtest.FORMATS),
+            [('json', 3.0), ('msgpack', 1.0)])
+        for value in ('xml', 'json=0', 'json=x'):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    loadtest.parse_mix(value, loadtest.FORMATS)
+
+    def test_that_percentiles_use_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 0.5), 50)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile(values, 1.0), 100)
+        self.assertEqual(loadtest.percentile([7], 0.99), 7)
+
+    def test_that_histogram_buckets_double(self):
+        self.assertEqual(loadtest.histogram([10, 15, 25, 70, 10 ** 9],
+                                            num_buckets=4),
+                         [(20, 2), (40, 1), (80, 1), (160, 1)])
+        self.assertEqual(loadtest.histogram([]), [])
+
+    @testing.gen_test
+    async def test_that_planned_requests_are_made(self):
+        plan = loadtest.make_plan(
+            40, loadtest.parse_mix('json,msgpack', loadtest.FORMATS),
+            loadtest.parse_mix('small,medium', loadtest.PAYLOADS), 0.5,
+            seed=1)
+        samples, elapsed = await loadtest.run_load(
+            self.get_url('').rstrip('/'), plan, concurrency=4)
+        self.assertEqual(len(samples), 40)
+        self.assertEqual({sample.status for sample in samples}, {200})
+        self.assertEqual(sorted(sample[:3] for sample in samples),
+                         sorted(plan))
+
+        out = io.StringIO()
+        loadtest.report(samples, elapsed, out)
+        self.assertIn('40 requests', out.getvalue())
+        self.assertIn('latency histogram', out.getvalue())